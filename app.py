@@ -1,16 +1,157 @@
+import base64
+import binascii
+import csv
+import functools
+import hashlib
+import io
 import json
+import mimetypes
+import os
 import re
+import threading
+from bisect import bisect_right
 from pathlib import Path
-from datetime import datetime, timedelta
-from collections import Counter
-from flask import Flask, request, session, redirect, url_for, render_template, jsonify, send_from_directory, Response
+from datetime import date, datetime, timedelta
+from flask import Flask, request, session, redirect, url_for, jsonify, render_template, send_file, send_from_directory, Response, stream_with_context
+from itsdangerous import BadSignature, URLSafeSerializer
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
+import media
+import profiling
+import taskmodel
+from assets import AssetPipeline
+from blobs import BlobStore, OffsetMismatch, UploadTooLarge
+from chatlog import ChatLog
+from events import EventBus
+from indexes import (
+    CompactTasks, CreatedOrder, FeedVersions, TaskIds, TaskOrder, UserStats, created_key,
+)
+from jobs import JobQueue
+from rendercache import RenderCache
+from search import MessageSearch, TaskSearch
+from storage import (
+    JSONStorage, JournalStorage, SQLiteStorage, TieredStorage, assign_task_ids, migrate_json_to_sqlite,
+    new_task_id,
+)
 
 app = Flask(__name__)
 app.secret_key = "supersecret"
 DATA_PATH = Path('data/users.json')
 CHAT_PATH = Path('data/messages.json')
+# Attachments stored before BLOB_PATH existed; still served as static files.
 UPLOAD_FOLDER = Path('static/uploads')
+# Content-addressed attachment blobs; see blobs.py.
+BLOB_PATH = Path(os.environ.get('TASKS_BLOB_PATH', 'data/blobs'))
+# Request bodies above this are refused from Content-Length, before anything
+# is read.  Larger files go through resumable uploads in smaller chunks.
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('TASKS_MAX_REQUEST_BYTES', 16 * 1024 * 1024))
+UPLOAD_MAX_BYTES = int(os.environ.get('TASKS_UPLOAD_MAX_BYTES', 1024 ** 3))
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+# Resumable uploads that receive nothing for this long are deleted.
+UPLOAD_EXPIRE_SECONDS = int(os.environ.get('TASKS_UPLOAD_EXPIRE_HOURS', '24')) * 3600
+# Downloads shown in the browser; every other type, SVG included, is sent as
+# an attachment so uploaded markup never runs on this origin.
+INLINE_TYPES = frozenset({'image/png', 'image/jpeg', 'image/gif', 'image/webp'})
+# Threads computing attachment metadata and thumbnails off the request path.
+ATTACHMENT_WORKERS = int(os.environ.get('TASKS_ATTACHMENT_WORKERS', '2'))
+# 'json' keeps everything in DATA_PATH; 'journal' appends task operations to a
+# log next to DATA_PATH and compacts it in the background; 'tiered' keeps
+# completed tasks in compressed per-user files under ARCHIVE_PATH; 'sqlite'
+# stores rows in SQLITE_PATH.
+STORAGE_BACKEND = os.environ.get('TASKS_STORAGE', 'json')
+SQLITE_PATH = Path(os.environ.get('TASKS_SQLITE_PATH', 'data/tasks.db'))
+ARCHIVE_PATH = Path(os.environ.get('TASKS_ARCHIVE_PATH', 'data/archive'))
+# Content-hashed, precompressed copies of styles.css and dragdrop.js, served
+# from /assets/ with immutable caching; see assets.py.
+ASSET_PATH = Path(os.environ.get('TASKS_ASSET_PATH', 'build/assets'))
+_storages = {}
+_asset_pipelines = {}
+_chat_logs = {}
+_message_searches = {}
+_blob_stores = {}
+# Chat history is kept in data/messages/ as segments of CHAT_SEGMENT_SIZE
+# messages; all but the newest CHAT_HOT_SEGMENTS are gzipped, and archived
+# segments older than CHAT_RETAIN_DAYS (if set) are deleted.  See chatlog.py.
+CHAT_SEGMENT_SIZE = int(os.environ.get('TASKS_CHAT_SEGMENT_SIZE', '10000'))
+CHAT_HOT_SEGMENTS = int(os.environ.get('TASKS_CHAT_HOT_SEGMENTS', '4'))
+CHAT_RETAIN_DAYS = (int(os.environ['TASKS_CHAT_RETAIN_DAYS'])
+                    if os.environ.get('TASKS_CHAT_RETAIN_DAYS') else None)
+# Operations accepted by one POST /tasks/batch.
+BATCH_MAX_OPS = 500
+TASK_STATUSES = ('Incomplete', 'Doing', 'Done')
+TASK_PRIORITIES = ('High', 'Mid', 'Low')
+# Memory budget, in characters, for rendered /tasks, /dashboard and /graph
+# pages and fragments; see rendercache.py.
+RENDER_CACHE_BYTES = int(os.environ.get('TASKS_RENDER_CACHE_BYTES', 32 * 1024 * 1024))
+# Results per page of /search and /api/search.
+SEARCH_PAGE_SIZE = 20
+# Upper bound on messages returned by one GET /chat/messages.
+CHAT_PAGE_LIMIT = 200
+# Seconds between keep-alive comments on idle /events streams.
+EVENTS_HEARTBEAT = 15
+MANAGER_ROLES = {'Owner', 'Leader', 'IT'}
+# Tasks per page in the managers' all-users view and /api/tasks.
+MANAGER_PAGE_SIZE = 20
+# User sections rendered with the page; the rest load when scrolled to.
+MANAGER_EAGER_SECTIONS = 6
+# Per-route timings on /metrics; see profiling.py.  Requests are run under
+# cProfile with probability PROFILE_SAMPLE_RATE and dumped to PROFILE_DIR when
+# slower than PROFILE_SLOW_SECONDS.
+PROFILING = os.environ.get('TASKS_PROFILING') == '1'
+PROFILE_SAMPLE_RATE = float(os.environ.get('TASKS_PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_SECONDS = float(os.environ.get('TASKS_PROFILE_SLOW_SECONDS', '1.0'))
+PROFILE_DIR = Path(os.environ.get('TASKS_PROFILE_DIR', 'profiles'))
+profiler = profiling.Profiler()
+
+
+def _observe_job(kind, seconds):
+    profiler.metrics.observe('taskmanager_job_latency_seconds',
+                             'Background job time from submission to completion.',
+                             profiling.DURATION_BUCKETS, {'job': kind}, seconds)
+
+
+render_cache = RenderCache(RENDER_CACHE_BYTES)
+attachment_jobs = JobQueue(workers=ATTACHMENT_WORKERS, name='attachments', observe=_observe_job)
+event_bus = EventBus(queue_size=100)
+user_stats = UserStats()
+task_order = TaskOrder()
+task_ids = TaskIds()
+feed_versions = FeedVersions()
+task_search = TaskSearch()
+created_order = CreatedOrder()
+compact_tasks = CompactTasks()
+# Materialized views updated by apply_ops; see indexes.py.
+VIEWS = [user_stats, task_order, task_ids, feed_versions, task_search, created_order,
+         compact_tasks]
+_views_lock = threading.RLock()
+_users_cache = {'key': None, 'users': None}
+_users_cache_lock = threading.Lock()
+_users_cache_stats = {'hits': 0, 'misses': 0}
+# Bumped on every in-process write so the cache never outlives our own saves,
+# even when the file's mtime/size happen not to change.
+_users_generation = 0
+
+
+def render_page(*args, **kwargs):
+    """``render_template``, with the time charged to the render phase."""
+    with profiling.phase('render'):
+        return render_template(*args, **kwargs)
+
+
+@app.before_request
+def start_profiling():
+    if PROFILING:
+        profiler.sample_rate = PROFILE_SAMPLE_RATE
+        profiler.slow_seconds = PROFILE_SLOW_SECONDS
+        profiler.profile_dir = PROFILE_DIR
+        profiler.start()
+
+
+@app.teardown_request
+def finish_profiling(exc=None):
+    # Runs even when the view raised; a no-op for unprofiled requests.
+    rule = request.url_rule
+    profiler.finish(rule.rule if rule is not None else 'unmatched')
 
 
 @app.template_filter('priority_class')
@@ -21,26 +162,388 @@ def priority_class(priority):
         'Low': 'bg-success',
     }.get(priority, 'bg-secondary')
 
+def get_storage():
+    """Return the storage backend selected by ``STORAGE_BACKEND``."""
+    if STORAGE_BACKEND == 'sqlite':
+        key = ('sqlite', SQLITE_PATH)
+    elif STORAGE_BACKEND == 'tiered':
+        key = ('tiered', DATA_PATH, ARCHIVE_PATH)
+    else:
+        key = (STORAGE_BACKEND, DATA_PATH)
+    storage = _storages.get(key)
+    if storage is None:
+        if key[0] == 'sqlite':
+            storage = SQLiteStorage(SQLITE_PATH)
+        elif key[0] == 'journal':
+            storage = JournalStorage(DATA_PATH)
+        elif key[0] == 'tiered':
+            storage = TieredStorage(DATA_PATH, ARCHIVE_PATH)
+        else:
+            storage = JSONStorage(DATA_PATH)
+        _storages[key] = storage
+    return storage
+
+
+def get_assets():
+    """Return the asset pipeline writing to ``ASSET_PATH``."""
+    pipeline = _asset_pipelines.get(ASSET_PATH)
+    if pipeline is None:
+        pipeline = _asset_pipelines[ASSET_PATH] = AssetPipeline(app.static_folder, ASSET_PATH)
+    return pipeline
+
+
+def asset_version():
+    """Return a token that changes with any hashed asset ('static' if unbuilt)."""
+    try:
+        return get_assets().version()
+    except OSError:
+        return 'static'
+
+
+@app.template_global()
+def asset_url(name):
+    """Return the URL of the content-hashed copy of static file ``name``.
+
+    Falls back to the plain static URL when the copy cannot be built (for
+    example on a read-only checkout without a prebuilt ``ASSET_PATH``).
+    """
+    try:
+        return url_for('asset', filename=get_assets().hashed(name))
+    except OSError:
+        return url_for('static', filename=name)
+
+
+class FrozenDict(dict):
+    """Read-only dict handed out by the user cache."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('cached user data is read-only; use thaw() for a mutable copy')
+
+    __setitem__ = __delitem__ = _readonly
+    setdefault = pop = popitem = clear = update = __ior__ = _readonly
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class FrozenList(list):
+    """Read-only list handed out by the user cache."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('cached user data is read-only; use thaw() for a mutable copy')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(obj):
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj):
+    """Return a mutable deep copy of (possibly frozen) user data."""
+    if isinstance(obj, dict):
+        return {k: thaw(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [thaw(v) for v in obj]
+    return obj
+
+
 def load_users():
-    with DATA_PATH.open() as f:
-        return json.load(f)
+    """Return a read-only view of the user store.
+
+    The parsed store is shared between calls and only re-read when the
+    backend's version token (mtime/size for JSON) or our write generation
+    changes, so a request parses the data at most once.
+    """
+    profiling.count('load_users')
+    storage = get_storage()
+    key = (id(storage), storage.version(), _users_generation)
+    if _users_cache['key'] == key:
+        _users_cache_stats['hits'] += 1
+        return _users_cache['users']
+    with _users_cache_lock, profiling.phase('load'):
+        if _users_cache['key'] == key:
+            _users_cache_stats['hits'] += 1
+            return _users_cache['users']
+        _users_cache_stats['misses'] += 1
+        users = storage.load()
+        if assign_task_ids(users):
+            # Backfill IDs for tasks written before they existed.  Redone
+            # under the storage lock so concurrent writes are not lost.
+            storage.update(assign_task_ids)
+            users = storage.load()
+            key = (id(storage), storage.version(), _users_generation)
+        users = freeze(users)
+        _users_cache['users'] = users
+        _users_cache['key'] = key
+    return users
+
+
+def past_tasks(users, username):
+    """Return ``username``'s completed tasks.
+
+    With the tiered store these are read from the user's archive, so only
+    call this where old detail is actually shown or counted.
+    """
+    return get_storage().past_tasks(users, username)
+
+
+def load_full_users():
+    """Return ``load_users()`` with every user's ``past_tasks`` filled in.
+
+    The same snapshot when the store keeps completed tasks in the main file;
+    with the tiered store it reads every archive, for the views that need
+    all history.
+    """
+    users = load_users()
+    storage = get_storage()
+    if not storage.tiered:
+        return users
+    with profiling.phase('load'):
+        return FrozenDict(
+            (uname, FrozenDict(udata, past_tasks=freeze(storage.past_tasks(users, uname))))
+            for uname, udata in users.items()
+        )
+
+
+def users_cache_stats():
+    """Return hit/miss counters for the shared user cache."""
+    return dict(_users_cache_stats)
+
+
+def _invalidate_users():
+    global _users_generation
+    with _users_cache_lock:
+        _users_generation += 1
+
 
 def save_users(users):
-    with DATA_PATH.open('w') as f:
-        json.dump(users, f, indent=2)
+    get_storage().save(thaw(users))
+    _invalidate_users()
+
+
+def view_path(view):
+    return DATA_PATH.with_name(f'{DATA_PATH.stem}.{view.name}.json')
+
+
+def sync_view(view):
+    """Bring ``view`` up to date with the store and return it."""
+    storage = get_storage()
+    version = storage.version()
+    with _views_lock:
+        if view.version != (id(storage), version) or not view.is_fresh():
+            if view.name is None or not view.restore(view_path(view), version):
+                view.rebuild(load_full_users() if view.archived else load_users())
+                if view.name is not None:
+                    view.persist(view_path(view), version)
+            view.version = (id(storage), version)
+    return view
+
+
+def apply_ops(ops, atomic=False):
+    """Persist a list of task operations (see ``storage.apply_op``).
+
+    All operations are applied in one storage transaction; with ``atomic``
+    none of them are kept unless all succeed.  Views that were current
+    before the write are updated incrementally; stale ones are left to
+    ``sync_view``.  Successful operations are published on ``event_bus`` to
+    the users involved and to managers.
+    """
+    storage = get_storage()
+    try:
+        with profiling.phase('save'):
+            results, base, after = storage.apply_versioned(ops, atomic)
+    finally:
+        _invalidate_users()
+    # Views are only brought forward from the exact version the operations
+    # were applied to; writes from other processes in between make them stale.
+    before = (id(storage), base)
+    applied = [(op, result) for op, result in zip(ops, results) if result['ok']]
+    with _views_lock:
+        for view in VIEWS:
+            if view.version == before and applied:
+                for op, result in applied:
+                    view.apply(op, result)
+                view.version = (id(storage), after)
+                if view.name is not None:
+                    view.persist(view_path(view), after)
+    if applied:
+        # Cached pages are keyed on data versions and would not be served
+        # again anyway; dropping them now frees the memory straight away.
+        render_cache.invalidate('*')
+        for user in {u for op, _ in applied for u in (op['user'], op.get('to')) if u}:
+            render_cache.invalidate(user)
+    for op, result in applied:
+        publish_task_event(op, result['task'])
+    return results
+
+
+def publish_task_event(op, task):
+    users = {op['user']}
+    if op.get('to'):
+        users.add(op['to'])
+    event_bus.publish('task', {
+        'id': task.get('id'),
+        'op': op['op'],
+        'user': op['user'],
+        'to': op.get('to'),
+        'task': {k: task.get(k) for k in ('description', 'priority', 'status', 'due_date')},
+    }, users=users, managers=True)
+
+
+def get_chat_log():
+    """Return the segmented message log stored next to ``CHAT_PATH``.
+
+    On first use any messages in the single-file ``messages.jsonl`` log, or
+    failing that the legacy ``messages.json`` array, are imported.
+    """
+    log = _chat_logs.get(CHAT_PATH)
+    if log is None:
+        legacy = next((p for p in (CHAT_PATH.with_suffix('.jsonl'), CHAT_PATH) if p.exists()), None)
+        log = ChatLog(CHAT_PATH.with_suffix(''), legacy_path=legacy,
+                      segment_size=CHAT_SEGMENT_SIZE, hot_segments=CHAT_HOT_SEGMENTS,
+                      retain_days=CHAT_RETAIN_DAYS)
+        _chat_logs[CHAT_PATH] = log
+    return log
+
+
+def get_message_search():
+    """Return the search index over the chat log, built on first use."""
+    search_index = _message_searches.get(CHAT_PATH)
+    if search_index is None:
+        search_index = _message_searches[CHAT_PATH] = MessageSearch(get_chat_log())
+    return search_index
+
+
+def get_blob_store():
+    store = _blob_stores.get(BLOB_PATH)
+    if store is None:
+        store = _blob_stores[BLOB_PATH] = BlobStore(BLOB_PATH, upload_ttl=UPLOAD_EXPIRE_SECONDS)
+    return store
+
+
+def attachment_for(digest, name):
+    """Return the attachment record stored in chat messages for a blob."""
+    name = secure_filename(name or '') or 'file'
+    return {
+        'hash': digest,
+        'name': name,
+        'size': get_blob_store().size(digest),
+        'type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+    }
+
+
+def process_attachment(store, digest, name, recipients):
+    """Background job: record a blob's metadata and thumbnail variants.
+
+    Clients are told through an ``attachment`` event; messages pick the
+    metadata up when they are next read (see ``with_attachment_meta``).
+    """
+    if store.read_meta(digest) is None:
+        with store.open(digest) as f:
+            meta = media.describe(f, name)
+            variants = []
+            for edge, width, height, mimetype, data in media.thumbnails(f):
+                thumb, size = store.put_stream(io.BytesIO(data))
+                variants.append({'hash': thumb, 'edge': edge, 'width': width, 'height': height,
+                                 'type': mimetype, 'size': size})
+        meta['variants'] = variants
+        store.write_meta(digest, meta)
+    event_bus.publish('attachment', dict(store.read_meta(digest), hash=digest),
+                      users=recipients or None)
+
+
+def with_attachment_meta(messages):
+    """Merge computed metadata into the messages' attachment records."""
+    store = get_blob_store()
+    for message in messages:
+        if message.get('attachments'):
+            message['attachments'] = [
+                dict(a, **(store.read_meta(a['hash']) or {})) if isinstance(a, dict) else a
+                for a in message['attachments']
+            ]
+    return messages
+
+
+_branch_index = {'users': None, 'members': {}}
+
+
+def branch_members(users):
+    """Return a branch -> set of usernames index for the ``users`` snapshot.
+
+    The index is rebuilt only when ``load_users`` hands out a new snapshot.
+    """
+    if _branch_index['users'] is not users:
+        members = {}
+        for uname, udata in users.items():
+            for branch in udata.get('branches', []):
+                members.setdefault(branch, set()).add(uname)
+        _branch_index['members'] = members
+        _branch_index['users'] = users
+    return _branch_index['members']
 
 
 def load_messages():
-    if CHAT_PATH.exists():
-        with CHAT_PATH.open() as f:
-            return json.load(f)
-    return []
+    return get_chat_log().read_since(0)[0]
+
 
+def locate_task(task_id):
+    """Return ``(owner, 'tasks' or 'past_tasks', task)`` for a task ID, or None.
+
+    A completed task is looked up in its owner's completed tasks only, so
+    with the tiered store at most that one archive is read.
+    """
+    with _views_lock:
+        found = sync_view(task_ids).locate(task_id)
+        if found is None:
+            return None
+        owner, key = found
+        if key == 'tasks':
+            task = sync_view(task_order).get(task_id)
+        else:
+            task = next((t for t in past_tasks(load_users(), owner) if t.get('id') == task_id),
+                        None)
+    return None if task is None else (owner, key, task)
 
-def save_messages(messages):
-    CHAT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with CHAT_PATH.open('w') as f:
-        json.dump(messages, f, indent=2)
+
+def task_ref(form, default_user):
+    """Return the owner and the op fields addressing the task named in ``form``.
+
+    Forms send the stable ``task_id``; ``task_index`` (a position in the
+    owner's active list) is still accepted from old pages.
+    """
+    if form.get('task_id'):
+        found = locate_task(form['task_id'])
+        owner = found[0] if found else default_user
+        return form.get('user') or owner, {'id': form['task_id']}
+    return form.get('user', default_user), {'index': int(form['task_index'])}
+
+
+def new_task(description, priority='Mid', due_date=None, task_id=None):
+    """Return a freshly created task record."""
+    now = datetime.utcnow().isoformat()
+    return {
+        'id': task_id or new_task_id(),
+        'description': description,
+        'priority': priority,
+        'status': 'Incomplete',
+        'notes': [],
+        'due_date': due_date,
+        'created_at': now,
+        'history': [{
+            'status': 'Incomplete',
+            'timestamp': now,
+            'action': 'created'
+        }],
+    }
 
 
 def get_user_tasks(username):
@@ -52,112 +555,173 @@ def get_user_tasks(username):
 def get_all_tasks(username):
     """Return active and past tasks for stats/trends."""
     users = load_users()
-    udata = users.get(username, {})
-    return udata.get('tasks', []) + udata.get('past_tasks', [])
+    return users.get(username, {}).get('tasks', []) + past_tasks(users, username)
+
 
+def get_compact_tasks(username):
+    """Return active and past tasks as ``taskmodel.Task`` objects, parsed once."""
+    with _views_lock:
+        return sync_view(compact_tasks).tasks(username, get_all_tasks)
 
+
+@profiling.phase('compute')
 def get_user_performance(username):
     """Calculate task statistics for the user."""
-    tasks = get_all_tasks(username)
-    total = len(tasks)
-    done = sum(1 for t in tasks if t.get('status') == 'Done')
-    pending = total - done
-    priorities = {"High": 0, "Mid": 0, "Low": 0}
-    for t in tasks:
-        p = t.get('priority', 'Mid')
-        priorities[p] = priorities.get(p, 0) + 1
-    completion = (done / total * 100) if total else 0
-    return {
-        'total': total,
-        'done': done,
-        'pending': pending,
-        'completion_rate': completion,
-        'priority': priorities,
-    }
+    return sync_view(user_stats).performance(username)
 
 
+@profiling.phase('compute')
 def build_trend(tasks):
-    """Return cumulative task creation/completion counts by date."""
-    created_counts = Counter()
-    done_counts = Counter()
-    for t in tasks:
-        created = datetime.fromisoformat(t.get('created_at')).date().isoformat()
-        created_counts[created] += 1
-        for h in t.get('history', []):
-            if h.get('status') == 'Done':
-                finished = datetime.fromisoformat(h['timestamp']).date().isoformat()
-                done_counts[finished] += 1
-    dates = sorted(set(created_counts) | set(done_counts))
-    trend = []
-    cumulative_created = 0
-    cumulative_done = 0
-    for d in dates:
-        cumulative_created += created_counts.get(d, 0)
-        cumulative_done += done_counts.get(d, 0)
-        trend.append({'date': d, 'created': cumulative_created, 'done': cumulative_done})
-    return trend
+    """Return cumulative task creation/completion counts by date.
+
+    ``tasks`` are ``taskmodel.Task`` objects (see ``get_compact_tasks``).
+    """
+    return taskmodel.trend(tasks)
 
 
+@profiling.phase('compute')
 def weekly_completion(tasks, days: int = 7):
-    """Return counts of completed tasks for each of the past ``days`` days."""
-    today = datetime.utcnow().date()
-    labels = []
-    counts = []
-    for i in range(days):
-        day = today - timedelta(days=days - i - 1)
-        labels.append(day.isoformat())
-        done = 0
-        for t in tasks:
-            for h in t.get('history', []):
-                if h.get('status') == 'Done':
-                    ts = datetime.fromisoformat(h['timestamp']).date()
-                    if ts == day:
-                        done += 1
-        counts.append(done)
-    return {'labels': labels, 'data': counts}
+    """Return counts of completed ``taskmodel.Task`` objects for each of the past ``days`` days."""
+    return taskmodel.weekly(tasks, days, datetime.utcnow().date())
+
+
+@profiling.phase('compute')
+def top_tasks(username, k):
+    """Return the user's ``k`` most urgent active tasks by priority and due date."""
+    return sync_view(task_order).top_tasks(username, k)
+
+
+@profiling.phase('compute')
+def due_between(username, start=None, end=None):
+    """Return the user's active tasks due between ``start`` and ``end`` (inclusive)."""
+    return sync_view(task_order).due_between(username, start, end)
 
 
 def top_three_tasks(username):
     """Return the top three tasks for a user sorted by priority and due date."""
-    tasks = get_user_tasks(username)
-    priority_order = {'High': 0, 'Mid': 1, 'Low': 2}
-    def sort_key(t):
-        p = priority_order.get(t.get('priority', 'Mid'), 1)
-        due = t.get('due_date') or '9999-12-31'
-        return (p, due)
-    tasks_sorted = sorted(tasks, key=sort_key)
-    return tasks_sorted[:3]
+    return top_tasks(username, 3)
 
 
+@profiling.phase('compute')
 def progress_today(username):
     """Return number of tasks updated and completed today."""
-    tasks = get_all_tasks(username)
-    today = datetime.utcnow().date()
-    total = 0
-    done = 0
-    for t in tasks:
-        for h in t.get('history', []):
-            ts = datetime.fromisoformat(h['timestamp']).date()
-            if ts == today:
-                total += 1
-                if h.get('status') == 'Done':
-                    done += 1
-                break
-    return {'total': total, 'done': done}
+    return sync_view(user_stats).progress_today(username)
 
 @app.template_filter('overdue_class')
 def overdue_class(task):
-    due = task.get('due_date')
-    if not due:
-        return ''
-    try:
-        due_date = datetime.fromisoformat(due).date()
-    except ValueError:
+    due = _due_day(task.get('due_date'))
+    if due is None or task.get('status') == 'Done':
         return ''
-    if due_date < datetime.utcnow().date() and task.get('status') != 'Done':
+    if due < datetime.utcnow().date().toordinal() - taskmodel.EPOCH_DAY:
         return 'list-group-item-danger'
     return ''
 
+
+def _due_day(due):
+    # Stored due dates predating validation can be anything, lists included.
+    if not due or not isinstance(due, str):
+        return None
+    return _parse_due_day(due)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_due_day(due):
+    try:
+        return taskmodel.parse_day(due)
+    except ValueError:
+        return None
+
+
+_DUE_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def check_due_date(value):
+    """Return ``value`` if it is a ``YYYY-MM-DD`` date (or empty, as None).
+
+    Raises ``ValueError`` with a message for the client otherwise.
+    """
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str) or not _DUE_DATE.match(value):
+        raise ValueError('due_date must be a YYYY-MM-DD date')
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{value!r} is not a valid date') from None
+    return value
+
+def encode_cursor(username, task):
+    raw = json.dumps([username, *created_key(task)]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    """Return ``(username, created_at, id)`` for a cursor from ``encode_cursor``."""
+    try:
+        username, created, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        raise ValueError(f'Invalid cursor {cursor!r}')
+    return username, created, task_id
+
+
+@profiling.phase('compute')
+def query_tasks(users, usernames, status=None, priority=None, past=False, after=None,
+                limit=MANAGER_PAGE_SIZE):
+    """Return one keyset page of ``(owner, task)`` pairs and the next cursor.
+
+    Tasks are ordered by owner, then creation time, then ID.  ``after`` is a
+    decoded cursor; the returned cursor is None on the last page.  Each
+    owner's keys are kept in that order by ``CreatedOrder``, so a page seeks
+    to the cursor instead of sorting the owner's tasks.
+    """
+    page = []
+    with _views_lock:
+        order = sync_view(created_order)
+        active = sync_view(task_order)
+        for uname in sorted(usernames):
+            if after and uname < after[0]:
+                continue
+            if past:
+                done = {t.get('id'): t for t in past_tasks(users, uname)}
+                keys = order.keys(uname, True, lambda _: done.values())
+            else:
+                keys = order.keys(uname)
+            start = 0
+            if after and uname == after[0]:
+                start = bisect_right(keys, tuple(after[1:]))
+            for i in range(start, len(keys)):
+                task_id = keys[i][1]
+                task = done.get(task_id) if past else active.get(task_id)
+                if task is None:
+                    # The views were synced separately and another process
+                    # wrote in between; the next request sees it.
+                    continue
+                if status and task.get('status') != status:
+                    continue
+                if priority and task.get('priority') != priority:
+                    continue
+                if len(page) == limit:
+                    return page, encode_cursor(*page[-1])
+                page.append((uname, task))
+    return page, None
+
+
+def task_summary(owner, task):
+    """Return the fields the task lists need, without history or notes."""
+    return {
+        'id': task.get('id'),
+        'user': owner,
+        'description': task.get('description'),
+        'priority': task.get('priority'),
+        'status': task.get('status'),
+        'due_date': task.get('due_date'),
+        'created_at': task.get('created_at'),
+        'notes': len(task.get('notes', [])),
+        'overdue_class': overdue_class(task),
+        'priority_class': priority_class(task.get('priority')),
+    }
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -169,8 +733,8 @@ def login():
             session['username'] = username
             return redirect(url_for('tasks'))
         else:
-            return render_template('login.html', error='Invalid credentials')
-    return render_template('login.html')
+            return render_page('login.html', error='Invalid credentials')
+    return render_page('login.html')
 
 @app.route('/tasks', methods=['GET', 'POST'])
 def tasks():
@@ -181,9 +745,11 @@ def tasks():
     username = session['username']
     user_data = users[username]
     role = user_data.get('role')
-    can_assign = role in {'Owner', 'Leader', 'IT'}
+    can_assign = role in MANAGER_ROLES
 
     if request.method == 'POST':
+        ops = []
+        has_ref = 'task_id' in request.form or 'task_index' in request.form
         # create a new task
         if 'task' in request.form:
             task = request.form['task']
@@ -192,110 +758,527 @@ def tasks():
             due_date = request.form.get('due_date') or None
             if task:
                 target = assignee if can_assign else username
-                target_data = users.get(target)
-                if target_data:
-                    now = datetime.utcnow().isoformat()
-                    target_data.setdefault('tasks', [])
-                    target_data['tasks'].append({
-                        'description': task,
-                        'priority': priority,
-                        'status': 'Incomplete',
-                        'notes': [],
-                        'due_date': due_date,
-                        'created_at': now,
-                        'history': [{
-                            'status': 'Incomplete',
-                            'timestamp': now,
-                            'action': 'created'
-                        }],
-                    })
-                    save_users(users)
+                if target in users:
+                    ops.append({'op': 'create', 'user': target,
+                                'task': new_task(task, priority, due_date)})
         # add a note to an existing task
-        elif 'note' in request.form and 'task_index' in request.form:
-            target = request.form.get('user', username)
-            idx = int(request.form['task_index'])
+        elif 'note' in request.form and has_ref:
+            target, ref = task_ref(request.form, username)
             note = request.form['note'].strip()
-            tasks_list = users.get(target, {}).get('tasks', [])
-            if note and 0 <= idx < len(tasks_list):
-                entry = {
-                    'text': note,
-                    'timestamp': datetime.utcnow().isoformat(),
-                    'author': username,
-                }
-                tasks_list[idx].setdefault('notes', []).append(entry)
-                save_users(users)
+            if note:
+                ops.append({
+                    'op': 'note',
+                    'user': target,
+                    **ref,
+                    'note': {
+                        'text': note,
+                        'timestamp': datetime.utcnow().isoformat(),
+                        'author': username,
+                    },
+                })
         # reassign a task to another user
-        elif 'task_index' in request.form and 'reassign' in request.form and can_assign:
-            source = request.form.get('user', username)
-            idx = int(request.form['task_index'])
+        elif has_ref and 'reassign' in request.form and can_assign:
+            source, ref = task_ref(request.form, username)
             new_user = request.form['reassign']
             if new_user in users and source in users:
-                tasks_list = users[source]['tasks']
-                if 0 <= idx < len(tasks_list):
-                    task = tasks_list.pop(idx)
-                    task.setdefault('history', []).append({
-                        'status': task.get('status'),
-                        'timestamp': datetime.utcnow().isoformat(),
-                        'action': f'reassigned_to_{new_user}'
-                    })
-                    users[new_user]['tasks'].append(task)
-                    save_users(users)
+                ops.append({
+                    'op': 'reassign',
+                    'user': source,
+                    **ref,
+                    'to': new_user,
+                    'timestamp': datetime.utcnow().isoformat(),
+                })
         # update status of a task
-        elif 'task_index' in request.form and 'status' in request.form:
-            target = request.form.get('user', username)
+        elif has_ref and 'status' in request.form:
+            target, ref = task_ref(request.form, username)
             if target == username or can_assign:
-                idx = int(request.form['task_index'])
-                new_status = request.form['status']
-                tasks_list = users.get(target, {}).get('tasks', [])
-                if 0 <= idx < len(tasks_list):
-                    task = tasks_list[idx]
-                    task['status'] = new_status
-                    task.setdefault('history', []).append({
-                        'status': new_status,
-                        'timestamp': datetime.utcnow().isoformat(),
-                        'action': 'status_change'
-                    })
-                    if new_status == 'Done':
-                        users[target].setdefault('past_tasks', []).append(task)
-                        tasks_list.pop(idx)
-                    save_users(users)
+                ops.append({
+                    'op': 'status',
+                    'user': target,
+                    **ref,
+                    'status': request.form['status'],
+                    'timestamp': datetime.utcnow().isoformat(),
+                })
+        if ops and any(r['ok'] for r in apply_ops(ops)):
+            users = load_users()
+        return render_tasks_page(username, users)
+
+    return cached_page(username, None if can_assign else username,
+                       lambda: render_tasks_page(username, users))
 
 
-    if can_assign:
-        return render_template(
+def render_tasks_page(username, users):
+    """Render /tasks: everyone's task sections for managers, else the user's own."""
+    user_data = users[username]
+    role = user_data.get('role')
+    if role in MANAGER_ROLES:
+        filters = {k: request.args.get(k) or None for k in ('branch', 'status', 'priority')}
+        names = [
+            uname for uname, udata in users.items()
+            if not filters['branch'] or filters['branch'] in udata.get('branches', [])
+        ]
+        sections = []
+        for i, uname in enumerate(names):
+            section = {'user': uname, 'tasks': [], 'next': None, 'loaded': False}
+            if i < MANAGER_EAGER_SECTIONS:
+                page, section['next'] = query_tasks(
+                    users, [uname], filters['status'], filters['priority'],
+                    limit=MANAGER_PAGE_SIZE)
+                section['tasks'] = [t for _, t in page]
+                section['loaded'] = True
+            sections.append(section)
+        all_branches = sorted({b for udata in users.values() for b in udata.get('branches', [])})
+        return render_page(
             'tasks.html',
             user=username,
             role=role,
             branches=user_data.get('branches', []),
             can_assign=True,
-            all_users=users,
+            sections=sections,
+            usernames=list(users),
+            all_branches=all_branches,
+            filters=filters,
+            page_size=MANAGER_PAGE_SIZE,
         )
     performance = get_user_performance(username)
-    all_tasks = user_data.get('tasks', []) + user_data.get('past_tasks', [])
-    trend = build_trend(all_tasks)
-    return render_template(
+    # Only this user's archive is read, not everyone's.
+    done = past_tasks(users, username)
+    trend = build_trend(get_compact_tasks(username))
+    return render_page(
         'tasks.html',
         user=username,
         role=role,
         branches=user_data.get('branches', []),
         can_assign=False,
         tasks=user_data.get('tasks', []),
-        past_tasks=user_data.get('past_tasks', []),
+        past_tasks=done,
         stats=performance,
         trend=trend,
     )
 
 
+@app.route('/api/tasks')
+def api_tasks():
+    """Return a page of tasks as JSON.
+
+    Managers may filter by ``user`` and ``branch``; everyone else only sees
+    their own tasks.  ``status`` and ``priority`` filter further, ``past=1``
+    lists completed tasks, and ``after`` takes the ``next`` cursor of the
+    previous page.
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    users = load_users()
+    username = session['username']
+    if users.get(username, {}).get('role') in MANAGER_ROLES:
+        requested = request.args.get('user')
+        names = [requested] if requested else list(users)
+        branch = request.args.get('branch')
+        if branch:
+            names = [n for n in names if branch in users.get(n, {}).get('branches', [])]
+    else:
+        names = [username]
+    names = [n for n in names if n in users]
+    after = request.args.get('after')
+    try:
+        after = decode_cursor(after) if after else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    limit = max(1, min(request.args.get('limit', MANAGER_PAGE_SIZE, type=int), 100))
+    page, next_cursor = query_tasks(
+        users,
+        names,
+        status=request.args.get('status') or None,
+        priority=request.args.get('priority') or None,
+        past=request.args.get('past') == '1',
+        after=after,
+        limit=limit,
+    )
+    return jsonify({'tasks': [task_summary(o, t) for o, t in page], 'next': next_cursor})
+
+
+_TASK_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def batch_op(item, users, username, can_assign, owners):
+    """Translate one item of a batch request into a task operation.
+
+    ``owners`` maps task IDs created or moved earlier in the same batch to
+    their owner, so later items can refer to them.  Raises ``ValueError``
+    with a message for the client when the item is malformed or not allowed.
+    """
+    if not isinstance(item, dict):
+        raise ValueError('operation must be an object')
+    kind = item.get('op')
+    now = datetime.utcnow().isoformat()
+    if kind == 'create':
+        description = item.get('description')
+        if not isinstance(description, str) or not description.strip():
+            raise ValueError('description is required')
+        priority = item.get('priority') or 'Mid'
+        if priority not in TASK_PRIORITIES:
+            raise ValueError(f'unknown priority {priority!r}')
+        target = item.get('user') or username
+        if target != username and not can_assign:
+            raise ValueError('not allowed to assign tasks to others')
+        if target not in users:
+            raise ValueError(f'unknown user {target!r}')
+        task_id = item.get('id')
+        if task_id is not None:
+            if not isinstance(task_id, str) or not _TASK_ID.match(task_id):
+                raise ValueError('id must be 32 lowercase hex digits')
+            if task_id in owners or locate_task(task_id):
+                raise ValueError('task already exists')
+        due_date = check_due_date(item.get('due_date'))
+        task = new_task(description.strip(), priority, due_date, task_id)
+        owners[task['id']] = target
+        return {'op': 'create', 'user': target, 'task': task}
+    if kind not in ('status', 'note', 'reassign'):
+        raise ValueError(f'unknown operation {kind!r}')
+    task_id = item.get('id')
+    if not isinstance(task_id, str):
+        raise ValueError('id is required')
+    owner = owners.get(task_id)
+    if owner is None:
+        found = locate_task(task_id)
+        if found is None:
+            raise ValueError('task not found')
+        owner = found[0]
+    if kind == 'reassign':
+        new_user = item.get('to')
+        if not can_assign:
+            raise ValueError('not allowed to reassign tasks')
+        if new_user not in users:
+            raise ValueError(f'unknown user {new_user!r}')
+        owners[task_id] = new_user
+        return {'op': 'reassign', 'user': owner, 'id': task_id, 'to': new_user, 'timestamp': now}
+    if owner != username and not can_assign:
+        raise ValueError("not allowed to change other users' tasks")
+    if kind == 'status':
+        status = item.get('status')
+        if status not in TASK_STATUSES:
+            raise ValueError(f'unknown status {status!r}')
+        return {'op': 'status', 'user': owner, 'id': task_id, 'status': status, 'timestamp': now}
+    text = item.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError('text is required')
+    return {'op': 'note', 'user': owner, 'id': task_id,
+            'note': {'text': text.strip(), 'timestamp': now, 'author': username}}
+
+
+def run_batch(items, username, atomic=True):
+    """Validate and apply batch ``items`` for ``username``; return ``(body, status)``.
+
+    Every item gets a result: ``{'ok': True, 'task': ...}``, or ``ok`` false
+    with an ``error``, or with ``rolled_back`` when an atomic batch was not
+    applied because of another item.
+    """
+    users = load_users()
+    can_assign = users.get(username, {}).get('role') in MANAGER_ROLES
+    owners = {}
+    ops, errors = [], []
+    for item in items:
+        try:
+            ops.append(batch_op(item, users, username, can_assign, owners))
+            errors.append(None)
+        except ValueError as e:
+            ops.append(None)
+            errors.append(str(e))
+    if atomic and any(errors):
+        results = [{'ok': False, 'error': e} if e else {'ok': False, 'rolled_back': True}
+                   for e in errors]
+        return {'ok': False, 'results': results}, 400
+    applied = iter(apply_ops([op for op in ops if op is not None], atomic=atomic))
+    results = []
+    for op, error in zip(ops, errors):
+        if op is None:
+            results.append({'ok': False, 'error': error})
+            continue
+        result = next(applied)
+        if result['ok']:
+            owner = op['to'] if op['op'] == 'reassign' else op['user']
+            results.append({'ok': True, 'task': task_summary(owner, result['task'])})
+        elif result.get('rolled_back'):
+            results.append({'ok': False, 'rolled_back': True})
+        else:
+            results.append({'ok': False, 'error': 'task not found'})
+    ok = all(r['ok'] for r in results)
+    return {'ok': ok, 'results': results}, 409 if atomic and not ok else 200
+
+
+@app.route('/tasks/batch', methods=['POST'])
+def tasks_batch():
+    """Apply a list of task operations in one storage transaction.
+
+    The JSON body is ``{"ops": [...], "atomic": true}``; each operation is
+    one of::
+
+        {"op": "create", "description": ..., "priority": ..., "due_date": ..., "user": ..., "id": ...}
+        {"op": "status", "id": ..., "status": ...}
+        {"op": "note", "id": ..., "text": ...}
+        {"op": "reassign", "id": ..., "to": ...}
+
+    ``user`` and ``id`` are optional for creates; a client-chosen ``id``
+    lets later operations in the same batch refer to the new task.  Unless
+    ``atomic`` is false nothing is applied when any operation fails.
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    data = request.get_json(silent=True)
+    items = data.get('ops') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'ops must be a non-empty list'}), 400
+    if len(items) > BATCH_MAX_OPS:
+        return jsonify({'error': f'at most {BATCH_MAX_OPS} operations per batch'}), 400
+    body, status = run_batch(items, session['username'], atomic=data.get('atomic', True) is not False)
+    return jsonify(body), status
+
+
+def import_items(rows, branch, users):
+    """Turn CSV rows into batch ``create`` items for ``branch``.
+
+    Rows name a ``description`` and optionally ``priority``, ``due_date``
+    and ``assignee``; rows without an assignee give every member of the
+    branch their own copy of the task.  Raises ``ValueError`` for a row
+    assigned to someone outside the branch.
+    """
+    members = sorted(branch_members(users).get(branch, ()))
+    items = []
+    for number, row in enumerate(rows, 2):
+        row = {(k or '').strip().lower(): (v or '').strip() for k, v in row.items()}
+        item = {'op': 'create', 'description': row.get('description', ''),
+                'priority': row.get('priority') or None, 'due_date': row.get('due_date') or None}
+        assignee = row.get('assignee')
+        if assignee and assignee not in members:
+            raise ValueError(f'line {number}: {assignee!r} is not a member of {branch}')
+        for user in [assignee] if assignee else members:
+            items.append(dict(item, user=user))
+    return items
+
+
+@app.route('/tasks/import', methods=['POST'])
+def import_tasks():
+    """Create tasks for a branch from an uploaded CSV file, all or nothing."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    users = load_users()
+    username = session['username']
+    if users.get(username, {}).get('role') not in MANAGER_ROLES:
+        return jsonify({'error': 'Forbidden'}), 403
+    branch = request.form.get('branch', '')
+    upload = request.files.get('file')
+    if not branch or upload is None:
+        return jsonify({'error': 'branch and file are required'}), 400
+    try:
+        rows = list(csv.DictReader(io.TextIOWrapper(upload.stream, encoding='utf-8-sig')))
+    except (UnicodeDecodeError, csv.Error):
+        return jsonify({'error': 'file is not a UTF-8 CSV'}), 400
+    try:
+        items = import_items(rows, branch, users)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not items:
+        return jsonify({'error': 'nothing to import'}), 400
+    body, status = run_batch(items, username)
+    return jsonify(body), status
+
+
+def run_search(username, query, kind=None, offset=0, limit=SEARCH_PAGE_SIZE):
+    """Return ``(hits, more)`` for ``query`` over what ``username`` may see.
+
+    Tasks are those the user owns (every task for managers) and messages
+    those broadcast or addressed to them.  ``kind`` limits the search to
+    ``'tasks'`` or ``'messages'``; otherwise both are merged by score.
+    """
+    users = load_users()
+    wanted = offset + limit + 1
+    ranked = []
+    if kind in (None, 'tasks'):
+        owners = None if users.get(username, {}).get('role') in MANAGER_ROLES else {username}
+        ranked += [(score, 'task', doc)
+                   for score, doc in sync_view(task_search).search(query, owners, wanted)]
+    if kind in (None, 'messages'):
+        ranked += [(score, 'message', doc)
+                   for score, doc in get_message_search().search(query, username, wanted)]
+    ranked.sort(key=lambda hit: hit[0], reverse=True)
+    page = ranked[offset:offset + limit]
+    message_ids = sorted(doc for _, hit_kind, doc in page if hit_kind == 'message')
+    messages = {m['id']: m for m in get_chat_log().get(message_ids)}
+    hits = []
+    for score, hit_kind, doc in page:
+        if hit_kind == 'task':
+            found = locate_task(doc)
+            if found is not None:
+                hits.append({'type': 'task', 'score': round(score, 3),
+                             'task': task_summary(found[0], found[2])})
+        elif doc in messages:
+            hits.append({'type': 'message', 'score': round(score, 3), 'message': messages[doc]})
+    return hits, len(ranked) > offset + limit
+
+
+def search_args():
+    kind = request.args.get('type')
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 100))
+    return request.args.get('q', '').strip(), kind if kind in ('tasks', 'messages') else None, offset, limit
+
+
+@app.route('/api/search')
+def api_search():
+    """Ranked search over tasks, notes and chat messages.
+
+    ``q`` is the query (every word must match, as a whole word or a
+    prefix), ``type`` is ``tasks`` or ``messages`` to search only those, and
+    ``offset``/``limit`` page through the results; ``next`` is the offset of
+    the following page, or null.
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    query, kind, offset, limit = search_args()
+    hits, more = run_search(session['username'], query, kind, offset, limit) if query else ([], False)
+    return jsonify({'results': hits, 'next': offset + limit if more else None})
+
+
+@app.route('/search')
+def search():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    query, kind, offset, limit = search_args()
+    hits, more = run_search(session['username'], query, kind, offset, limit) if query else ([], False)
+    return render_page('search.html', query=query, kind=kind, hits=hits, offset=offset,
+                       limit=limit, more=more)
+
+
 @app.route('/dashboard')
 def dashboard():
     """Display top tasks, today's progress, and due dates."""
     if 'username' not in session:
         return redirect(url_for('login'))
     username = session['username']
-    top_tasks = top_three_tasks(username)
-    progress = progress_today(username)
-    due_tasks = [t for t in get_user_tasks(username) if t.get('due_date')]
-    return render_template('dashboard.html', top_tasks=top_tasks, progress=progress, due_tasks=due_tasks)
+
+    def render():
+        top_tasks = top_three_tasks(username)
+        progress = progress_today(username)
+        due_tasks = due_between(username)
+        feed_url = url_for('calendar_feed', token=calendar_token(username), _external=True)
+        return render_page(
+            'dashboard.html', top_tasks=top_tasks, progress=progress, due_tasks=due_tasks, feed_url=feed_url
+        )
+    return cached_page(username, username, render)
+
+
+def cached_page(username, scope, render):
+    """Serve the page ``render()`` produces from the render cache, with an ETag.
+
+    ``scope`` is the user whose tasks the page shows, or None when it shows
+    everyone's.  Pages are keyed on the URL, the viewer and their role, the
+    scope's data version (see ``FeedVersions``), the asset version the page
+    links to and today's date, which due dates are highlighted against.  A
+    matching ``If-None-Match`` gets a 304 without rendering anything.
+    """
+    feed = sync_view(feed_versions)
+    role = load_users().get(username, {}).get('role')
+    key = (request.url, username, role, feed.etag(scope), asset_version(),
+           datetime.utcnow().date().isoformat())
+    etag = hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(render_cache.get_or_render(key, render, tags=(scope or '*',)))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def calendar_token(username):
+    """Return the signed token that identifies ``username``'s calendar feed."""
+    return URLSafeSerializer(app.secret_key, salt='calendar').dumps(username)
+
+
+def ics_escape(text):
+    """Escape a TEXT property value (RFC 5545 section 3.3.11)."""
+    return (
+        str(text)
+        .replace('\\', '\\\\')
+        .replace(';', '\\;')
+        .replace(',', '\\,')
+        .replace('\r\n', '\\n')
+        .replace('\n', '\\n')
+        .replace('\r', '\\n')
+    )
+
+
+def ics_fold(line):
+    """Fold a content line into chunks of at most 75 octets, CRLF-terminated.
+
+    Continuation lines start with a space, which counts towards their 75
+    octets.  Multi-byte UTF-8 characters are never split.
+    """
+    out = []
+    chunk = ''
+    size = 0
+    for ch in line:
+        width = len(ch.encode('utf-8'))
+        if size + width > 75:
+            out.append(chunk)
+            chunk, size = ' ', 1
+        chunk += ch
+        size += width
+    out.append(chunk)
+    return '\r\n'.join(out) + '\r\n'
+
+
+def ics_stamp(timestamp):
+    """Format a stored timestamp as an iCalendar UTC DATE-TIME."""
+    return datetime.fromisoformat(timestamp).strftime('%Y%m%dT%H%M%SZ')
+
+
+def ics_stream(tasks, host):
+    """Yield the folded lines of a calendar holding one all-day event per task."""
+    now = datetime.utcnow().isoformat()
+    yield ics_fold('BEGIN:VCALENDAR')
+    yield ics_fold('VERSION:2.0')
+    yield ics_fold('PRODID:-//TaskManager//EN')
+    for t in tasks:
+        day = _due_day(t.get('due_date'))
+        if day is None:
+            continue
+        due = date.fromordinal(day + taskmodel.EPOCH_DAY)
+        history = t.get('history') or [{}]
+        yield ics_fold('BEGIN:VEVENT')
+        yield ics_fold(f'UID:{t["id"]}@{host}')
+        yield ics_fold(f'DTSTAMP:{ics_stamp(history[-1].get("timestamp") or t.get("created_at") or now)}')
+        yield ics_fold(f'SUMMARY:{ics_escape(t["description"])}')
+        yield ics_fold(f'DTSTART;VALUE=DATE:{due.strftime("%Y%m%d")}')
+        yield ics_fold(f'DTEND;VALUE=DATE:{(due + timedelta(days=1)).strftime("%Y%m%d")}')
+        yield ics_fold('END:VEVENT')
+    yield ics_fold('END:VCALENDAR')
+
+
+def calendar_response(username):
+    """Serve ``username``'s feed, or a 304 when the client's copy is current.
+
+    The validators come from ``feed_versions``, so a conditional poll that
+    matches is answered without reading any tasks.
+    """
+    feed = sync_view(feed_versions)
+    etag = feed.etag(username)
+    modified = feed.last_modified(username)
+    if request.if_none_match:
+        unchanged = request.if_none_match.contains(etag)
+    else:
+        since = request.if_modified_since
+        unchanged = since is not None and modified is not None and modified <= since
+    if unchanged:
+        response = Response(status=304)
+    else:
+        tasks = due_between(username)
+        response = Response(ics_stream(tasks, request.host.split(':')[0]), mimetype='text/calendar')
+    response.set_etag(etag)
+    if modified is not None:
+        response.last_modified = modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @app.route('/calendar.ics')
@@ -303,22 +1286,19 @@ def calendar_ics():
     """Return an iCalendar feed for the user's tasks."""
     if 'username' not in session:
         return redirect(url_for('login'))
-    username = session['username']
-    tasks = [t for t in get_user_tasks(username) if t.get('due_date')]
-    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//TaskManager//EN']
-    for idx, t in enumerate(tasks):
-        due = t['due_date'].replace('-', '')
-        lines.extend([
-            'BEGIN:VEVENT',
-            f'UID:{username}-{idx}',
-            f'SUMMARY:{t["description"]}',
-            f'DTSTART;VALUE=DATE:{due}',
-            f'DTEND;VALUE=DATE:{due}',
-            'END:VEVENT',
-        ])
-    lines.append('END:VCALENDAR')
-    ics_content = '\r\n'.join(lines)
-    return Response(ics_content, mimetype='text/calendar')
+    return calendar_response(session['username'])
+
+
+@app.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    """Return a user's feed for calendar apps that cannot log in."""
+    try:
+        username = URLSafeSerializer(app.secret_key, salt='calendar').loads(token)
+    except BadSignature:
+        return 'Not found', 404
+    if username not in load_users():
+        return 'Not found', 404
+    return calendar_response(username)
 
 
 @app.route('/graph')
@@ -326,28 +1306,51 @@ def graph():
     """Display progress bars and weekly charts for all users."""
     if 'username' not in session:
         return redirect(url_for('login'))
-    users = load_users()
-    stats = {}
-    for uname, udata in users.items():
-        perf = get_user_performance(uname)
+    return cached_page(session['username'], None, render_graph)
 
-        week = weekly_completion(udata.get('tasks', []) + udata.get('past_tasks', []))
 
-        stats[uname] = {'performance': perf, 'week': week}
-    return render_template('graph.html', stats=stats)
+def render_graph():
+    """Render /graph from per-user card fragments.
 
+    Each card is cached on its user's data version, so after a write only
+    the cards of the users involved are rendered again.
+    """
+    counters = sync_view(user_stats)
+    feed = sync_view(feed_versions)
+    today = datetime.utcnow().date().isoformat()
 
-@app.route('/tasks/<user>/<int:index>')
-def task_detail(user, index):
+    def card(uname):
+        return render_page('_graph_card.html', uname=uname,
+                           performance=counters.performance(uname), week=counters.weekly(uname))
+    cards = [
+        Markup(render_cache.get_or_render(('graph-card', uname, feed.etag(uname), today),
+                                          lambda: card(uname), tags=(uname,)))
+        for uname in load_users()
+    ]
+    return render_page('graph.html', cards=cards)
+
+
+@app.route('/tasks/<task_id>')
+def task_detail(task_id):
     """Display details and history for a single task."""
     if 'username' not in session:
         return redirect(url_for('login'))
-    users = load_users()
-    tasks = users.get(user, {}).get('tasks', [])
+    found = locate_task(task_id)
+    if found is None:
+        return redirect(url_for('tasks'))
+    user, _, task = found
+    return render_page('task_detail.html', task=task, user=user)
+
+
+@app.route('/tasks/<user>/<int:index>')
+def task_detail_by_index(user, index):
+    """Redirect old position-based task links to the task's stable URL."""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    tasks = load_users().get(user, {}).get('tasks', [])
     if index < 0 or index >= len(tasks):
         return redirect(url_for('tasks'))
-    task = tasks[index]
-    return render_template('task_detail.html', task=task, user=user, index=index)
+    return redirect(url_for('task_detail', task_id=tasks[index]['id']))
 
 @app.route('/logout')
 def logout():
@@ -359,7 +1362,7 @@ def logout():
 def chat():
     if 'username' not in session:
         return redirect(url_for('login'))
-    return render_template('chat.html')
+    return render_page('chat.html')
 
 
 @app.route('/chat/messages', methods=['GET', 'POST'])
@@ -369,46 +1372,182 @@ def chat_messages():
 
     if request.method == 'POST':
         text = request.form.get('message', '').strip()
-        if not text and 'file' not in request.files:
+        uploaded = request.form.getlist('attachment')
+        if not text and 'file' not in request.files and not uploaded:
             return jsonify({'error': 'No content'}), 400
         users = load_users()
         sender = session['username']
         tags = {t for t in re.findall(r'@([\w]+)', text)}
         recipients = set()
+        members = branch_members(users)
         for t in tags:
             if t in users:
                 recipients.add(t)
             else:
-                for uname, udata in users.items():
-                    if t in udata.get('branches', []):
-                        recipients.add(uname)
+                recipients.update(members.get(t, ()))
         if recipients:
             recipients.add(sender)
         attachments = []
         file = request.files.get('file')
         if file and file.filename:
-            UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
-            filename = secure_filename(file.filename)
-            save_path = UPLOAD_FOLDER / filename
-            file.save(save_path)
-            attachments.append(f'uploads/{filename}')
-        messages = load_messages()
-        messages.append({
-            'sender': sender,
-            'text': text,
-            'recipients': list(recipients),
-            'attachments': attachments,
-        })
-        save_messages(messages)
-        return jsonify({'status': 'ok'})
+            try:
+                digest, _ = get_blob_store().put_stream(
+                    file.stream, max_size=app.config['MAX_CONTENT_LENGTH'])
+            except UploadTooLarge:
+                return jsonify({'error': 'File too large'}), 413
+            attachments.append(attachment_for(digest, file.filename))
+        # Files sent beforehand through /files or /uploads, as {"hash", "name"}.
+        for raw in uploaded:
+            try:
+                ref = json.loads(raw)
+                digest = ref['hash']
+            except (ValueError, TypeError, KeyError):
+                return jsonify({'error': 'Invalid attachment'}), 400
+            if not isinstance(digest, str) or not get_blob_store().exists(digest):
+                return jsonify({'error': 'Unknown attachment'}), 400
+            attachments.append(attachment_for(digest, ref.get('name')))
+        with profiling.phase('save'):
+            message = get_chat_log().append({
+                'sender': sender,
+                'text': text,
+                'recipients': list(recipients),
+                'attachments': attachments,
+                'timestamp': datetime.utcnow().isoformat(),
+            })
+        search_index = _message_searches.get(CHAT_PATH)
+        if search_index is not None:
+            search_index.add(message)
+        event_bus.publish('message', message, users=message['recipients'] or None)
+        store = get_blob_store()
+        for attachment in attachments:
+            if store.read_meta(attachment['hash']) is None:
+                attachment_jobs.submit('attachment', process_attachment, store,
+                                       attachment['hash'], attachment['name'], message['recipients'])
+        return jsonify({'status': 'ok', 'id': message['id']})
 
     username = session['username']
-    messages = load_messages()
-    visible = [
-        m for m in messages
-        if not m['recipients'] or username in m['recipients']
-    ]
-    return jsonify({'messages': visible})
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', CHAT_PAGE_LIMIT, type=int), CHAT_PAGE_LIMIT)
+    visible, cursor, more = get_chat_log().read_visible(username, since, max(limit, 1))
+    return jsonify({'messages': with_attachment_meta(visible), 'cursor': cursor, 'more': more})
+
+
+@app.route('/files', methods=['POST'])
+def upload_file():
+    """Store the raw request body as a blob, streaming it to disk."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    # Also bounds bodies sent without a Content-Length (chunked).
+    try:
+        digest, _ = get_blob_store().put_stream(
+            request.stream, max_size=app.config['MAX_CONTENT_LENGTH'])
+    except UploadTooLarge:
+        return jsonify({'error': 'File too large',
+                        'max': app.config['MAX_CONTENT_LENGTH']}), 413
+    return jsonify(attachment_for(digest, request.args.get('name'))), 201
+
+
+@app.route('/files/<digest>')
+def download_file(digest):
+    """Serve a blob; supports Range requests and is cacheable forever."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    store = get_blob_store()
+    if not store.exists(digest):
+        return 'Not found', 404
+    name = secure_filename(request.args.get('name', '')) or digest
+    # The type comes from the content, never from the name in the URL.
+    meta = store.read_meta(digest)
+    if meta is None:
+        with store.open(digest) as f:
+            mimetype = media.sniff_type(f.read(32))
+    else:
+        mimetype = meta['type']
+    response = send_file(
+        store.path(digest),
+        mimetype=mimetype,
+        as_attachment=mimetype not in INLINE_TYPES,
+        download_name=name,
+        conditional=True,
+        etag=digest,
+        max_age=365 * 24 * 3600,
+    )
+    # The URL names the content, so it never changes; cached copies stay
+    # private because downloads need a login.
+    response.cache_control.private = True
+    response.cache_control.public = False
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = 'sandbox'
+    return response
+
+
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    """Begin a resumable upload of ``{"name", "size"}``."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    body = request.get_json(silent=True) or {}
+    size = body.get('size')
+    if not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'Invalid size'}), 400
+    if size > UPLOAD_MAX_BYTES:
+        return jsonify({'error': 'File too large', 'max': UPLOAD_MAX_BYTES}), 413
+    upload_id = get_blob_store().start_upload(size, session['username'], body.get('name'))
+    return jsonify({'id': upload_id, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_BYTES}), 201
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PATCH'])
+def resume_upload(upload_id):
+    """Report (GET) or extend (PATCH at ``Upload-Offset``) a resumable upload.
+
+    The PATCH that completes the upload returns the attachment record.
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    store = get_blob_store()
+    try:
+        info = store.upload_info(upload_id)
+    except KeyError:
+        return jsonify({'error': 'Unknown upload'}), 404
+    if info['owner'] != session['username']:
+        return jsonify({'error': 'Unknown upload'}), 404
+    if request.method == 'GET':
+        return jsonify({'offset': info['offset'], 'size': info['size']})
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset required'}), 400
+    try:
+        offset, digest = store.append(upload_id, offset, request.stream)
+    except OffsetMismatch as e:
+        return jsonify({'error': 'Offset mismatch', 'offset': e.offset}), 409
+    except UploadTooLarge:
+        return jsonify({'error': 'More data than declared'}), 413
+    if digest is None:
+        return jsonify({'offset': offset})
+    return jsonify({'offset': offset, 'attachment': attachment_for(digest, info['name'])})
+
+
+@app.route('/events')
+def events():
+    """Stream chat and task updates visible to the user as Server-Sent Events."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    username = session['username']
+    role = load_users().get(username, {}).get('role')
+    sub = event_bus.subscribe(username, can_see_all=role in MANAGER_ROLES)
+
+    def generate():
+        try:
+            yield from sub.stream(EVENTS_HEARTBEAT)
+        finally:
+            event_bus.unsubscribe(sub)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 
 @app.route('/manifest.json')
@@ -418,11 +1557,129 @@ def manifest():
     return response
 
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of the request profiles (when enabled)."""
+    if not PROFILING:
+        return 'Not found', 404
+    cache = users_cache_stats()
+    jobs = attachment_jobs.stats()
+    pages = render_cache.stats()
+    text = profiler.metrics.render(extra=[
+        ('taskmanager_users_cache_hits_total', 'counter',
+         'load_users() calls served from the cache.', cache['hits']),
+        ('taskmanager_users_cache_misses_total', 'counter',
+         'load_users() calls that parsed the store.', cache['misses']),
+        ('taskmanager_render_cache_hits_total', 'counter',
+         'Pages and fragments served from the render cache.', pages['hits']),
+        ('taskmanager_render_cache_misses_total', 'counter',
+         'Pages and fragments rendered because they were not cached.', pages['misses']),
+        ('taskmanager_render_cache_evictions_total', 'counter',
+         'Render cache entries dropped to stay within the memory budget.', pages['evictions']),
+        ('taskmanager_render_cache_invalidations_total', 'counter',
+         'Render cache entries dropped after task writes.', pages['invalidations']),
+        ('taskmanager_render_cache_entries', 'gauge',
+         'Pages and fragments in the render cache.', pages['entries']),
+        ('taskmanager_render_cache_bytes', 'gauge',
+         'Characters of rendered output held by the render cache.', pages['bytes']),
+        ('taskmanager_event_subscribers', 'gauge',
+         'Connected /events clients.', event_bus.subscriber_count()),
+        ('taskmanager_attachment_jobs_queued', 'gauge',
+         'Attachment jobs waiting for a worker.', jobs['queued']),
+        ('taskmanager_attachment_jobs_running', 'gauge',
+         'Attachment jobs in progress.', jobs['running']),
+        ('taskmanager_attachment_jobs_completed_total', 'counter',
+         'Attachment jobs finished.', jobs['completed']),
+        ('taskmanager_attachment_jobs_failed_total', 'counter',
+         'Attachment jobs that raised.', jobs['failed']),
+    ])
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    """Serve a hashed asset, precompressed when the client accepts it."""
+    path, encoding = get_assets().resolve(
+        filename, lambda e: request.accept_encodings[e] > 0)
+    if path is None:
+        return 'Not found', 404
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # The name changes with the contents, so this URL never needs revalidating.
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
 @app.route('/service-worker.js')
 def service_worker():
-    response = send_from_directory('static', 'service-worker.js')
-    response.headers['Content-Type'] = 'application/javascript'
+    """The service worker, versioned by the current asset hashes."""
+    version = asset_version()
+    precache = [asset_url(name) for name in get_assets().names]
+    script = render_page('service-worker.js', version=version, precache=precache,
+                         batch_max_ops=BATCH_MAX_OPS)
+    response = Response(script, mimetype='application/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
     return response
 
+
+@app.cli.command('migrate-sqlite')
+def migrate_sqlite_command():
+    """Copy DATA_PATH into the SQLite store at SQLITE_PATH."""
+    count = migrate_json_to_sqlite(DATA_PATH, SQLITE_PATH)
+    print(f'Migrated {count} users from {DATA_PATH} to {SQLITE_PATH}')
+
+
+@app.cli.command('migrate-task-ids')
+def migrate_task_ids_command():
+    """Give every stored task a stable ID."""
+    count = get_storage().update(assign_task_ids)
+    print(f'Assigned IDs to {count} tasks')
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Write hashed and precompressed static assets to ASSET_PATH."""
+    for name, hashed in get_assets().build().items():
+        print(f'{name} -> {ASSET_PATH / hashed}')
+
+
+@app.cli.command('archive-tasks')
+def archive_tasks_command():
+    """Move completed tasks still in DATA_PATH into the tiered store's archives."""
+    storage = get_storage()
+    if not storage.tiered:
+        print('Set TASKS_STORAGE=tiered to archive completed tasks')
+        raise SystemExit(1)
+    moved = {}
+
+    def archive(users):
+        moved.update((u, len(d['past_tasks'])) for u, d in users.items() if d.get('past_tasks'))
+        return bool(moved)
+    storage.update(archive)
+    print(f'Archived {sum(moved.values())} completed tasks for {len(moved)} users')
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute per-user counters from scratch and check the stored ones."""
+    storage = get_storage()
+    version = storage.version()
+    live = UserStats()
+    restored = live.restore(view_path(live), version)
+    fresh = UserStats()
+    fresh.rebuild(load_full_users())
+    fresh.persist(view_path(fresh), version)
+    if not restored:
+        print('No current counters on disk; rebuilt from scratch')
+        return
+    mismatched = fresh.diff(live)
+    if mismatched:
+        print('Counters differed for: ' + ', '.join(mismatched))
+        raise SystemExit(1)
+    print(f'Counters verified for {len(fresh.users)} users')
+
+
 if __name__ == '__main__':
     app.run(debug=True)
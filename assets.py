@@ -0,0 +1,109 @@
+"""Content-hashed, precompressed copies of the static assets.
+
+``AssetPipeline.build`` copies each source file (``styles.css``,
+``dragdrop.js``) to ``<stem>.<hash><suffix>`` in the output directory, next
+to ``.gz`` and, when the optional ``brotli`` package is installed, ``.br``
+variants.  A file name changes whenever its contents do, so the app can
+serve these copies with far-future ``immutable`` caching.  Names are
+rebuilt on demand when a source file changes; builds never delete older
+copies, so pages rendered before a change keep working.
+"""
+import gzip
+import hashlib
+import json
+import re
+import threading
+from pathlib import Path
+
+from storage import atomic_write
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+ASSETS = ('styles.css', 'dragdrop.js')
+# Hex digits of the content hash kept in file names.
+HASH_LENGTH = 12
+# Encodings served from the precompressed variants, best first.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def hashed_name(name, data):
+    path = Path(name)
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()[:HASH_LENGTH]
+    return f'{path.stem}.{digest}{path.suffix}'
+
+
+class AssetPipeline:
+    def __init__(self, source_dir, out_dir, names=ASSETS):
+        self.source_dir = Path(source_dir)
+        self.out_dir = Path(out_dir)
+        self.names = tuple(names)
+        self._lock = threading.Lock()
+        self._built = {}   # source name -> (stat key, hashed name)
+        self._pattern = re.compile('|'.join(
+            rf'{re.escape(Path(n).stem)}\.[0-9a-f]{{{HASH_LENGTH}}}{re.escape(Path(n).suffix)}'
+            for n in self.names))
+
+    def _stat_key(self, name):
+        st = (self.source_dir / name).stat()
+        return st.st_mtime_ns, st.st_size
+
+    def _write(self, path, data):
+        if not path.exists():
+            atomic_write(path, data)
+
+    def _build_one(self, name):
+        data = (self.source_dir / name).read_bytes()
+        hashed = hashed_name(name, data)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        target = self.out_dir / hashed
+        self._write(target, data)
+        self._write(target.with_name(hashed + '.gz'), gzip.compress(data, 9, mtime=0))
+        if brotli is not None:
+            self._write(target.with_name(hashed + '.br'), brotli.compress(data))
+        return hashed
+
+    def build(self):
+        """Build every asset and write ``assets.json``; return ``{name: hashed name}``."""
+        built = {name: self.hashed(name) for name in self.names}
+        atomic_write(self.out_dir / 'assets.json', json.dumps(built, indent=2).encode())
+        return built
+
+    def hashed(self, name):
+        """Return the current hashed file name for source ``name``.
+
+        Rebuilds it when the source changed since it was last built.
+        Raises ``OSError`` when the source cannot be read or the output not
+        written.
+        """
+        key = self._stat_key(name)
+        cached = self._built.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with self._lock:
+            hashed = self._build_one(name)
+            self._built[name] = (key, hashed)
+        return hashed
+
+    def version(self):
+        """Return a token that changes whenever any asset does."""
+        names = [self.hashed(name) for name in self.names]
+        return hashlib.blake2b(' '.join(names).encode(), digest_size=6).hexdigest()
+
+    def resolve(self, filename, accepts=lambda encoding: False):
+        """Return ``(path, content encoding or None)`` for a hashed ``filename``.
+
+        ``accepts(encoding)`` says whether the client takes that encoding.
+        Earlier builds stay available; names that are not hashed copies of
+        one of the assets give ``(None, None)``.
+        """
+        path = self.out_dir / filename
+        if not self._pattern.fullmatch(filename) or not path.is_file():
+            return None, None
+        for encoding, suffix in ENCODINGS:
+            variant = path.with_name(filename + suffix)
+            if accepts(encoding) and variant.is_file():
+                return variant, encoding
+        return path, None
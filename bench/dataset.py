@@ -0,0 +1,85 @@
+"""Synthetic ``users.json``/``messages.json`` datasets for the benchmarks."""
+import json
+import random
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+PASSWORD = 'secret'
+BRANCHES = ['Mzone', 'UNIPRO', 'Babol', 'Other']
+STATUSES = ['Incomplete', 'Doing', 'Done']
+PRIORITIES = ['High', 'Mid', 'Low']
+
+
+def _task(rng, now, history):
+    created = now - timedelta(days=rng.randrange(60), seconds=rng.randrange(86400))
+    entries = [{'status': 'Incomplete', 'timestamp': created.isoformat(), 'action': 'created'}]
+    stamp = created
+    status = 'Incomplete'
+    for _ in range(history):
+        stamp = min(now, stamp + timedelta(hours=rng.randrange(1, 48)))
+        status = rng.choice(STATUSES)
+        entries.append({'status': status, 'timestamp': stamp.isoformat(), 'action': 'status_change'})
+    due = created.date() + timedelta(days=rng.randrange(90))
+    return {
+        'id': uuid.UUID(int=rng.getrandbits(128)).hex,
+        'description': f'Task {rng.randrange(10**6)}',
+        'priority': rng.choice(PRIORITIES),
+        'status': status,
+        'notes': [],
+        'due_date': due.isoformat() if rng.random() < 0.7 else None,
+        'created_at': created.isoformat(),
+        'history': entries,
+    }
+
+
+def generate(data_dir, users=20, tasks=50, history=3, messages=1000, seed=0):
+    """Write a dataset into ``data_dir`` and return the usernames.
+
+    ``user0`` is an Owner (sees everyone's tasks); the rest are Workers.
+    ``tasks`` is per user; about a third of them end up in ``past_tasks``.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    store = {}
+    for u in range(users):
+        active, past = [], []
+        for _ in range(tasks):
+            task = _task(rng, now, history)
+            (past if task['status'] == 'Done' else active).append(task)
+        store[f'user{u}'] = {
+            'password': PASSWORD,
+            'role': 'Owner' if u == 0 else 'Worker',
+            'branches': rng.sample(BRANCHES, 2),
+            'tasks': active,
+            'past_tasks': past,
+        }
+    names = list(store)
+    chat = []
+    for i in range(messages):
+        sender = rng.choice(names)
+        recipients = [] if rng.random() < 0.5 else sorted({sender, rng.choice(names)})
+        chat.append({
+            'sender': sender,
+            'text': f'message {i}',
+            'recipients': recipients,
+            'attachments': [],
+            'timestamp': (now - timedelta(seconds=messages - i)).isoformat(),
+        })
+    (data_dir / 'users.json').write_text(json.dumps(store, indent=2))
+    (data_dir / 'messages.json').write_text(json.dumps(chat))
+    return names
+
+
+def configure(app_module, data_dir, backend='json'):
+    """Point the app's data paths at ``data_dir``."""
+    data_dir = Path(data_dir)
+    app_module.DATA_PATH = data_dir / 'users.json'
+    app_module.CHAT_PATH = data_dir / 'messages.json'
+    app_module.UPLOAD_FOLDER = data_dir / 'uploads'
+    app_module.BLOB_PATH = data_dir / 'blobs'
+    app_module.STORAGE_BACKEND = backend
+    app_module.SQLITE_PATH = data_dir / 'tasks.db'
+    app_module.ARCHIVE_PATH = data_dir / 'archive'
@@ -0,0 +1,226 @@
+"""Latency and throughput benchmarks for the hot routes.
+
+Generates a synthetic dataset (see ``bench/dataset.py``), then:
+
+* requests ``/tasks``, ``/dashboard``, ``/graph``, ``/chat/messages`` and
+  ``/calendar.ics`` repeatedly through the Flask test client;
+* runs the same routes against a local threaded HTTP server from several
+  concurrent clients;
+* times ``build_trend``, ``weekly_completion``, ``get_user_performance`` and
+  ``top_three_tasks`` on their own.
+
+Latencies are reported as p50/p95/p99 in milliseconds, along with throughput
+and the process's peak RSS.  ``--out`` writes the results as JSON and
+``--baseline`` compares them with an earlier run, exiting with status 1 when a
+latency got more than ``--tolerance`` slower.
+
+    python bench/run.py --users 50 --tasks 200 --out bench/results.json
+    python bench/run.py --users 50 --tasks 200 --baseline bench/results.json
+"""
+import argparse
+import http.cookiejar
+import json
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bench.dataset import PASSWORD, configure, generate  # noqa: E402
+
+ROUTES = ['/tasks', '/dashboard', '/graph', '/chat/messages', '/calendar.ics']
+
+
+def percentiles(samples):
+    """Summarise latencies given in seconds."""
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {'count': len(ordered), 'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def bench_test_client(app_module, viewer, iterations):
+    results = {}
+    with app_module.app.test_client() as client:
+        client.post('/login', data={'username': viewer, 'password': PASSWORD})
+        for route in ROUTES:
+            client.get(route)  # the first request builds caches and views
+            samples = []
+            start = time.perf_counter()
+            for _ in range(iterations):
+                t0 = time.perf_counter()
+                resp = client.get(route)
+                resp.get_data()
+                samples.append(time.perf_counter() - t0)
+                if resp.status_code != 200:
+                    raise RuntimeError(f'{route} returned {resp.status_code}')
+            elapsed = time.perf_counter() - start
+            results[route] = dict(percentiles(samples), rps=round(iterations / elapsed, 1))
+    return results
+
+
+def _session(base_url, viewer):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    body = urllib.parse.urlencode({'username': viewer, 'password': PASSWORD}).encode()
+    opener.open(base_url + '/login', body).read()
+    return opener
+
+
+def bench_http(app_module, viewer, iterations, concurrency):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    local = threading.local()
+
+    def fetch(route):
+        if not hasattr(local, 'opener'):
+            local.opener = _session(base_url, viewer)
+        t0 = time.perf_counter()
+        with local.opener.open(base_url + route) as resp:
+            resp.read()
+        return time.perf_counter() - t0
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for route in ROUTES:
+                start = time.perf_counter()
+                samples = list(pool.map(fetch, [route] * iterations))
+                elapsed = time.perf_counter() - start
+                results[route] = dict(percentiles(samples), rps=round(iterations / elapsed, 1))
+    finally:
+        server.shutdown()
+        thread.join()
+    return results
+
+
+def bench_functions(app_module, viewer, iterations):
+    # As the app calls them: with the viewer's tasks from the compact view.
+    cases = {
+        'build_trend': lambda: app_module.build_trend(app_module.get_compact_tasks(viewer)),
+        'weekly_completion': lambda: app_module.weekly_completion(
+            app_module.get_compact_tasks(viewer)),
+        'get_user_performance': lambda: app_module.get_user_performance(viewer),
+        'top_three_tasks': lambda: app_module.top_three_tasks(viewer),
+    }
+    results = {}
+    for name, fn in cases.items():
+        fn()  # warm caches and views so only steady-state calls are timed
+        samples = []
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - t0)
+        results[name] = percentiles(samples)
+    return results
+
+
+def run(data_dir, users=20, tasks=50, history=3, messages=1000, iterations=50,
+        concurrency=8, viewer='user0', backend='json', http=True):
+    """Generate a dataset in ``data_dir``, run every benchmark, return results."""
+    generate(data_dir, users=users, tasks=tasks, history=history, messages=messages)
+    import app as app_module
+    configure(app_module, data_dir, backend)
+    if backend == 'sqlite':
+        from storage import migrate_json_to_sqlite
+        migrate_json_to_sqlite(app_module.DATA_PATH, app_module.SQLITE_PATH)
+    results = {
+        'params': {
+            'users': users, 'tasks': tasks, 'history': history, 'messages': messages,
+            'iterations': iterations, 'concurrency': concurrency, 'viewer': viewer,
+            'backend': backend,
+        },
+        'test_client': bench_test_client(app_module, viewer, iterations),
+        'functions': bench_functions(app_module, viewer, iterations),
+    }
+    if http:
+        results['http'] = bench_http(app_module, viewer, iterations, concurrency)
+    results['peak_rss_kb'] = peak_rss_kb()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return ``(lines, regressed)`` comparing p50/p95 latencies with ``baseline``."""
+    lines = []
+    regressed = False
+    for section in ('test_client', 'http', 'functions'):
+        for name, current in results.get(section, {}).items():
+            before = baseline.get(section, {}).get(name)
+            if not before:
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                old, new = before[metric], current[metric]
+                ratio = new / old if old else 1.0
+                flag = ''
+                if ratio > 1 + tolerance:
+                    flag = '  REGRESSION'
+                    regressed = True
+                lines.append(f'{section:12} {name:22} {metric} {old:9.3f} -> {new:9.3f} ({ratio:5.2f}x){flag}')
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--tasks', type=int, default=50, help='tasks per user')
+    parser.add_argument('--history', type=int, default=3, help='status changes per task')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=50, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8, help='HTTP client threads')
+    parser.add_argument('--viewer', default='user0', help='user0 is an Owner, the rest Workers')
+    parser.add_argument('--backend', choices=['json', 'journal', 'tiered', 'sqlite'], default='json')
+    parser.add_argument('--no-http', action='store_true', help='skip the HTTP server run')
+    parser.add_argument('--dir', help='data directory (default: a temporary one)')
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before a latency counts as a regression')
+    args = parser.parse_args(argv)
+
+    kwargs = dict(users=args.users, tasks=args.tasks, history=args.history,
+                  messages=args.messages, iterations=args.iterations,
+                  concurrency=args.concurrency, viewer=args.viewer,
+                  backend=args.backend, http=not args.no_http)
+    if args.dir:
+        results = run(args.dir, **kwargs)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run(tmp, **kwargs)
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        lines, regressed = compare(results, baseline, args.tolerance)
+        print('\n'.join(lines))
+        if regressed:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Search latency as the corpus grows.
+
+Builds a ``search.InvertedIndex`` over synthetic task-like documents at
+several corpus sizes and times the same queries against each.  Every size
+holds the same number of documents matching the queries, so the latencies
+should stay flat while the corpus grows:
+
+    python bench/search.py --sizes 1000 10000 100000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bench.run import percentiles  # noqa: E402
+from search import InvertedIndex  # noqa: E402
+
+# Documents per corpus that mention the query words.
+MATCHES = 50
+QUERIES = {
+    'word': 'forklift',
+    'prefix': 'forkl',
+    'two_words': 'forklift inspection',
+}
+_LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def _filler(rng):
+    return ''.join(rng.choice(_LETTERS) for _ in range(rng.randrange(3, 9)))
+
+
+def corpus(size, words=12, seed=0):
+    """Yield ``(doc, text)`` pairs; ``MATCHES`` of them contain the query words."""
+    rng = random.Random(seed)
+    vocabulary = [_filler(rng) for _ in range(5000)]
+    for doc in range(size):
+        text = ' '.join(rng.choice(vocabulary) for _ in range(words))
+        if doc % (size // MATCHES or 1) == 0:
+            text += ' forklift inspection'
+        yield doc, text
+
+
+def bench_size(size, iterations):
+    index = InvertedIndex()
+    start = time.perf_counter()
+    for doc, text in corpus(size):
+        index.add(doc, text)
+    build = time.perf_counter() - start
+    results = {'build_s': round(build, 3)}
+    for name, query in QUERIES.items():
+        index.scores(query)
+        samples = []
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            index.scores(query)
+            samples.append(time.perf_counter() - t0)
+        results[name] = percentiles(samples)
+    return results
+
+
+def run(sizes=(1000, 10000, 100000), iterations=200):
+    return {str(size): bench_size(size, iterations) for size in sizes}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.sizes, args.iterations), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Concurrent write stress test for the file-based stores.
+
+Starts several processes that each log in through the Flask test client and,
+against one shared data directory, create tasks, add a note to each and post
+chat messages.  Afterwards every task, note and message must be present
+exactly once.
+
+    python bench/stress.py --workers 8 --ops 50 --backend json
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bench.dataset import configure  # noqa: E402
+
+
+def seed(data_dir):
+    data_dir = Path(data_dir)
+    users = {
+        'worker': {'password': 'secret', 'role': 'Worker', 'branches': ['Mzone'],
+                   'tasks': [], 'past_tasks': []},
+    }
+    (data_dir / 'users.json').write_text(json.dumps(users))
+    (data_dir / 'messages.json').write_text('[]')
+
+
+def worker(data_dir, backend, worker_id, ops):
+    import app as app_module
+    configure(app_module, data_dir, backend)
+    with app_module.app.test_client() as client:
+        client.post('/login', data={'username': 'worker', 'password': 'secret'})
+        for i in range(ops):
+            name = f'w{worker_id}-{i}'
+            client.post('/tasks', data={'task': name})
+            task = next(t for t in app_module.load_users()['worker']['tasks']
+                        if t['description'] == name)
+            client.post('/tasks', data={'task_id': task['id'], 'note': f'note {name}'})
+            client.post('/chat/messages', data={'message': f'msg {name}'})
+    storage = app_module.get_storage()
+    if hasattr(storage, 'close'):
+        storage.close()
+    return getattr(storage, 'conflicts', 0)
+
+
+def run(data_dir, backend='json', workers=4, ops=20):
+    """Run the stress test and return a summary; raise AssertionError on loss."""
+    seed(data_dir)
+    if backend == 'sqlite':
+        from storage import migrate_json_to_sqlite
+        migrate_json_to_sqlite(Path(data_dir) / 'users.json', Path(data_dir) / 'tasks.db')
+    ctx = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    with ctx.Pool(workers) as pool:
+        conflicts = pool.starmap(worker, [(str(data_dir), backend, w, ops) for w in range(workers)])
+    elapsed = time.perf_counter() - start
+
+    import app as app_module
+    configure(app_module, data_dir, backend)
+    tasks = app_module.get_storage().load()['worker']['tasks']
+    messages = app_module.get_chat_log().read_since(0)[0]
+    expected = Counter(f'w{w}-{i}' for w in range(workers) for i in range(ops))
+    descriptions = Counter(t['description'] for t in tasks)
+    notes = Counter(n['text'] for t in tasks for n in t.get('notes', []))
+    texts = Counter(m['text'] for m in messages)
+    assert descriptions == expected, 'tasks lost or duplicated'
+    assert notes == Counter({f'note {k}': 1 for k in expected}), 'notes lost or duplicated'
+    assert texts == Counter({f'msg {k}': 1 for k in expected}), 'messages lost or duplicated'
+    assert [m['id'] for m in messages] == list(range(1, len(messages) + 1))
+    return {
+        'backend': backend,
+        'workers': workers,
+        'ops_per_worker': ops,
+        'requests': workers * ops * 3,
+        'seconds': round(elapsed, 3),
+        'conflicts': sum(conflicts),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=50, help='tasks created per worker')
+    parser.add_argument('--backend', choices=['json', 'journal', 'tiered', 'sqlite'], default='json')
+    parser.add_argument('--dir', help='data directory (default: a temporary one)')
+    args = parser.parse_args(argv)
+    if args.dir:
+        summary = run(args.dir, args.backend, args.workers, args.ops)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            summary = run(tmp, args.backend, args.workers, args.ops)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
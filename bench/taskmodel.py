@@ -0,0 +1,142 @@
+"""Memory and CPU of ``taskmodel.Task`` against plain task dicts.
+
+Generates synthetic tasks like ``bench.dataset`` does, round-trips them
+through JSON (so the dicts hold freshly parsed strings, as loaded from the
+store) and compares:
+
+* the memory the tasks take as dicts and as compact ``Task`` objects
+  (``tracemalloc``), and the one-off conversion time;
+* ``build_trend`` and ``weekly_completion`` computed from the dicts in one
+  pass that parses every timestamp on each call (how they worked before the
+  app kept compact tasks) and from the converted tasks.
+
+    python bench/taskmodel.py --tasks 100000
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import taskmodel  # noqa: E402
+from bench.dataset import _task  # noqa: E402
+from bench.run import percentiles  # noqa: E402
+
+
+def dict_trend(tasks):
+    created_counts = {}
+    done_counts = {}
+    for t in tasks:
+        created = datetime.fromisoformat(t.get('created_at')).date().isoformat()
+        created_counts[created] = created_counts.get(created, 0) + 1
+        for h in t.get('history', []):
+            if h.get('status') == 'Done':
+                finished = datetime.fromisoformat(h['timestamp']).date().isoformat()
+                done_counts[finished] = done_counts.get(finished, 0) + 1
+    trend = []
+    cumulative_created = 0
+    cumulative_done = 0
+    for d in sorted(set(created_counts) | set(done_counts)):
+        cumulative_created += created_counts.get(d, 0)
+        cumulative_done += done_counts.get(d, 0)
+        trend.append({'date': d, 'created': cumulative_created, 'done': cumulative_done})
+    return trend
+
+
+def dict_weekly(tasks, days, today):
+    first = today - timedelta(days=days - 1)
+    counts = [0] * days
+    for t in tasks:
+        for h in t.get('history', []):
+            if h.get('status') == 'Done':
+                offset = (datetime.fromisoformat(h['timestamp']).date() - first).days
+                if 0 <= offset < days:
+                    counts[offset] += 1
+    labels = [(first + timedelta(days=i)).isoformat() for i in range(days)]
+    return {'labels': labels, 'data': counts}
+
+
+def synthetic(count, history=3, seed=0):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    return json.dumps([_task(rng, now, history) for _ in range(count)])
+
+
+def convert(dicts):
+    return [taskmodel.Task.from_dict(t) for t in dicts]
+
+
+def _measure(build):
+    gc.collect()
+    tracemalloc.start()
+    value = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, size
+
+
+def _timed(build):
+    start = time.perf_counter()
+    value = build()
+    return value, time.perf_counter() - start
+
+
+def _time(fn, iterations):
+    fn()
+    samples = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return percentiles(samples)
+
+
+def run(tasks=100000, history=3, iterations=5):
+    raw = synthetic(tasks, history)
+    # Memory is what each form retains once loaded; the compact tasks are
+    # built from their own copy of the dicts, which is then dropped.
+    _, dict_bytes = _measure(lambda: json.loads(raw))
+    _, compact_bytes = _measure(lambda: convert(json.loads(raw)))
+    dicts, load_s = _timed(lambda: json.loads(raw))
+    compact, convert_s = _timed(lambda: convert(dicts))
+    assert all(c.to_dict() == t for c, t in zip(compact, dicts))
+    today = datetime.utcnow().date()
+    assert taskmodel.trend(compact) == dict_trend(dicts)
+    assert taskmodel.weekly(compact, 7, today) == dict_weekly(dicts, 7, today)
+    return {
+        'tasks': tasks,
+        'memory': {
+            'dict_mb': round(dict_bytes / 2**20, 1),
+            'compact_mb': round(compact_bytes / 2**20, 1),
+            'ratio': round(compact_bytes / dict_bytes, 3),
+        },
+        'json_load_s': round(load_s, 3),
+        'convert_s': round(convert_s, 3),
+        'build_trend': {
+            'dict': _time(lambda: dict_trend(dicts), iterations),
+            'compact': _time(lambda: taskmodel.trend(compact), iterations),
+        },
+        'weekly_completion': {
+            'dict': _time(lambda: dict_weekly(dicts, 7, today), iterations),
+            'compact': _time(lambda: taskmodel.weekly(compact, 7, today), iterations),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=100000)
+    parser.add_argument('--history', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.tasks, args.history, args.iterations), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""Content-addressed storage for uploaded files.
+
+Each blob is stored once under ``<root>/<first two hex digits>/<sha256>``, so
+identical attachments share a file and a blob's name never changes.  Writes
+stream through a temporary file in fixed-size chunks, hashing as they go, and
+are renamed into place only when complete.
+
+Large files can be sent as a resumable upload: ``start_upload`` reserves an
+ID, ``append`` adds chunks at a given offset (a client that lost its
+connection asks ``upload_info`` where to continue) and the blob is
+committed when the declared size has been reached.  Uploads that received
+nothing for ``upload_ttl`` seconds are deleted, as are temporary files left
+by interrupted writes; starting an upload sweeps for them now and then.
+
+Derived metadata (type, dimensions, thumbnail variants) is kept in a JSON
+sidecar per blob under ``<root>/meta``; as blobs never change, it is cached
+in memory once written.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from storage import atomic_write
+
+CHUNK_SIZE = 64 * 1024
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class OffsetMismatch(Exception):
+    def __init__(self, offset):
+        super().__init__(f'upload is at offset {offset}')
+        self.offset = offset
+
+
+class BlobStore:
+    def __init__(self, root, chunk_size=CHUNK_SIZE, upload_ttl=None):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.upload_ttl = upload_ttl
+        self.tmp_dir = self.root / 'tmp'
+        self.uploads_dir = self.root / 'uploads'
+        self.meta_dir = self.root / 'meta'
+        for path in (self.tmp_dir, self.uploads_dir, self.meta_dir):
+            path.mkdir(parents=True, exist_ok=True)
+        # Guards ``_uploads``; each upload has its own lock, held while its
+        # chunks are read from the client.
+        self._lock = threading.Lock()
+        self._uploads = {}
+        self._meta = {}
+        self._next_sweep = 0
+
+    # -- blobs -------------------------------------------------------------
+
+    def path(self, digest):
+        """Return the file holding ``digest``, or None for a malformed hash."""
+        if not _DIGEST.match(digest):
+            return None
+        return self.root / digest[:2] / digest
+
+    def exists(self, digest):
+        path = self.path(digest)
+        return path is not None and path.exists()
+
+    def size(self, digest):
+        return self.path(digest).stat().st_size
+
+    def _commit(self, tmp, digest):
+        final = self.path(digest)
+        if final.exists():
+            tmp.unlink()
+        else:
+            final.parent.mkdir(exist_ok=True)
+            os.replace(tmp, final)
+        return digest
+
+    def put_stream(self, stream, max_size=None):
+        """Store everything read from ``stream``; return ``(digest, size)``.
+
+        Raises ``UploadTooLarge`` as soon as more than ``max_size`` bytes have
+        arrived, without reading the rest.
+        """
+        tmp = self.tmp_dir / uuid.uuid4().hex
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp, 'wb') as f:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise UploadTooLarge(f'more than {max_size} bytes')
+                    digest.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return self._commit(tmp, digest.hexdigest()), size
+
+    def open(self, digest):
+        return self.path(digest).open('rb')
+
+    # -- metadata sidecars -------------------------------------------------
+
+    def read_meta(self, digest):
+        """Return the metadata recorded for ``digest``, or None if not yet computed."""
+        meta = self._meta.get(digest)
+        if meta is None and _DIGEST.match(digest):
+            try:
+                meta = json.loads((self.meta_dir / f'{digest}.json').read_text())
+            except FileNotFoundError:
+                return None
+            self._meta[digest] = meta
+        return meta
+
+    def write_meta(self, digest, meta):
+        atomic_write(self.meta_dir / f'{digest}.json', json.dumps(meta).encode())
+        self._meta[digest] = meta
+
+    # -- resumable uploads -------------------------------------------------
+
+    def _upload_paths(self, upload_id):
+        if not _UPLOAD_ID.match(upload_id):
+            raise KeyError(upload_id)
+        return self.uploads_dir / f'{upload_id}.part', self.uploads_dir / f'{upload_id}.json'
+
+    def start_upload(self, size, owner, name):
+        """Reserve an upload of ``size`` bytes and return its ID."""
+        if self.upload_ttl is not None and time.time() >= self._next_sweep:
+            self._next_sweep = time.time() + self.upload_ttl / 10
+            self.expire_uploads()
+        upload_id = uuid.uuid4().hex
+        part, meta = self._upload_paths(upload_id)
+        part.touch()
+        meta.write_text(json.dumps({'size': size, 'owner': owner, 'name': name}))
+        return upload_id
+
+    def upload_info(self, upload_id):
+        """Return the upload's metadata plus its current ``offset``."""
+        part, meta = self._upload_paths(upload_id)
+        try:
+            info = json.loads(meta.read_text())
+            info['offset'] = part.stat().st_size
+        except FileNotFoundError:
+            raise KeyError(upload_id) from None
+        return info
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._uploads.setdefault(upload_id, threading.Lock())
+
+    def append(self, upload_id, offset, stream):
+        """Write ``stream`` at ``offset``; return ``(offset, digest or None)``.
+
+        The digest is returned once the upload is complete and committed as
+        a blob.  Only appends to the same upload wait for each other.
+        """
+        part, meta = self._upload_paths(upload_id)
+        with self._upload_lock(upload_id):
+            info = self.upload_info(upload_id)
+            if offset != info['offset']:
+                raise OffsetMismatch(info['offset'])
+            with open(part, 'ab') as f:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    if offset + len(chunk) > info['size']:
+                        f.truncate(info['offset'])
+                        raise UploadTooLarge(f'more than the declared {info["size"]} bytes')
+                    f.write(chunk)
+                    offset += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if offset < info['size']:
+                return offset, None
+            digest = hashlib.sha256()
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(chunk)
+            meta.unlink()
+            with self._lock:
+                self._uploads.pop(upload_id, None)
+            return offset, self._commit(part, digest.hexdigest())
+
+    def expire_uploads(self, now=None):
+        """Delete uploads and temporary files untouched for ``upload_ttl``
+        seconds; return how many files were removed."""
+        if self.upload_ttl is None:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.upload_ttl
+        removed = 0
+        for path in self.tmp_dir.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        for path in self.uploads_dir.glob('*.part'):
+            lock = self._upload_lock(path.stem)
+            # An upload that is receiving a chunk right now is not stale.
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if path.stat().st_mtime >= cutoff:
+                    continue
+                path.unlink()
+                path.with_suffix('.json').unlink(missing_ok=True)
+                removed += 1
+                with self._lock:
+                    self._uploads.pop(path.stem, None)
+            except FileNotFoundError:
+                continue
+            finally:
+                lock.release()
+        return removed
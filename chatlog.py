@@ -0,0 +1,510 @@
+"""Append-only, segmented storage for chat messages."""
+import gzip
+import heapq
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from itertools import islice
+from pathlib import Path
+
+import profiling
+from storage import atomic_write, file_lock
+
+logger = logging.getLogger(__name__)
+
+_OFFSET = struct.Struct('<Q')
+
+# Messages per segment file.  Fixed when a log is created: IDs map to
+# segments by division, so it is kept in the manifest.
+SEGMENT_SIZE = 10000
+# Newest segments kept as plain files and covered by the recipient index;
+# older ones are gzipped.
+HOT_SEGMENTS = 4
+
+
+class LogSegment:
+    """Up to ``segment_size`` messages stored one JSON object per line.
+
+    Message ``base + n`` is line ``n`` of the segment.  ``<segment>.idx``
+    holds the byte offset of every line as a fixed-width integer, so reads
+    seek straight to the first unseen message instead of scanning.
+    """
+
+    def __init__(self, path, base, create=False):
+        self.path = Path(path)
+        self.index_path = self.path.with_name(self.path.name + '.idx')
+        self.base = base
+        if create:
+            self.path.touch()
+        self._recover()
+
+    def _recover(self):
+        """Bring the offset index in line with the segment after a crash.
+
+        The last indexed line and anything after it are re-scanned; a torn
+        trailing line is truncated away.
+        """
+        size = self.path.stat().st_size
+        count = self.index_path.stat().st_size // _OFFSET.size if self.index_path.exists() else 0
+        start = 0
+        with open(self.index_path, 'a+b') as idx:
+            while count:
+                idx.seek((count - 1) * _OFFSET.size)
+                (start,) = _OFFSET.unpack(idx.read(_OFFSET.size))
+                count -= 1
+                if start < size:
+                    break
+                start = 0
+            offsets = []
+            with self.path.open('r+b') as log:
+                log.seek(start)
+                pos = start
+                for line in log:
+                    if not line.endswith(b'\n'):
+                        break
+                    offsets.append(pos)
+                    pos += len(line)
+                log.truncate(pos)
+            idx.truncate(count * _OFFSET.size)
+            idx.seek(0, 2)
+            idx.write(b''.join(_OFFSET.pack(o) for o in offsets))
+        self.count = count + len(offsets)
+        self._size = pos
+
+    @property
+    def last_id(self):
+        return self.base + self.count
+
+    def refresh(self):
+        """Pick up lines appended by other processes."""
+        count = self.index_path.stat().st_size // _OFFSET.size
+        if count != self.count:
+            self.count = count
+            self._size = self.path.stat().st_size
+
+    def append(self, message):
+        message = dict(message, id=self.last_id + 1)
+        line = json.dumps(message, separators=(',', ':')).encode() + b'\n'
+        with self.path.open('ab') as log:
+            log.write(line)
+        profiling.count('bytes_written', len(line))
+        with self.index_path.open('ab') as idx:
+            idx.write(_OFFSET.pack(self._size))
+        self._size += len(line)
+        self.count += 1
+        return message
+
+    def read(self, since):
+        """Yield the messages after ID ``since``, in order."""
+        stop = self.last_id
+        since = max(since, self.base)
+        if since >= stop:
+            return
+        with self.index_path.open('rb') as idx:
+            idx.seek((since - self.base) * _OFFSET.size)
+            (start,) = _OFFSET.unpack(idx.read(_OFFSET.size))
+        with self.path.open('rb') as log:
+            log.seek(start)
+            for _ in range(since, stop):
+                line = log.readline()
+                profiling.count('bytes_read', len(line))
+                yield json.loads(line)
+
+    def get(self, msg_ids):
+        """Return the messages with the given (ascending) IDs."""
+        messages = []
+        with self.index_path.open('rb') as idx, self.path.open('rb') as log:
+            for msg_id in msg_ids:
+                idx.seek((msg_id - self.base - 1) * _OFFSET.size)
+                (offset,) = _OFFSET.unpack(idx.read(_OFFSET.size))
+                log.seek(offset)
+                line = log.readline()
+                profiling.count('bytes_read', len(line))
+                messages.append(json.loads(line))
+        return messages
+
+
+def _read_archive(path, since):
+    """Yield the messages after ID ``since`` from a gzipped segment."""
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            profiling.count('bytes_read', len(line))
+            message = json.loads(line)
+            if message['id'] > since:
+                yield message
+
+
+class ChatLog:
+    """Chat messages split across numbered segment files in one directory.
+
+    Messages get consecutive integer IDs starting at 1; segment ``n`` holds
+    IDs ``n * segment_size + 1`` to ``(n + 1) * segment_size``, so reading
+    recent messages only opens the newest segment.  ``manifest.json``
+    records the segment size, the oldest retained segment and the first
+    segment not yet archived.
+
+    When a segment fills up the next one is started, and a background
+    thread gzips all but the newest ``hot_segments``; with ``retain_days``
+    set, archived segments whose last message is older than that are
+    deleted.
+
+    An in-memory recipient index covers the hot segments only, keeping, per
+    user, the sorted IDs of messages addressed to them plus one list of
+    broadcast IDs.  ``read_visible`` costs time proportional to the reader's
+    own feed, and memory stays bounded however long the history grows.
+    """
+
+    def __init__(self, root, legacy_path=None, segment_size=SEGMENT_SIZE,
+                 hot_segments=HOT_SEGMENTS, retain_days=None):
+        self.root = Path(root)
+        self.manifest_path = self.root / 'manifest.json'
+        self.hot_segments = max(1, hot_segments)
+        self.retain_days = retain_days
+        self._lock = threading.RLock()
+        self._file_lock = file_lock(self.manifest_path)
+        self._manifest_key = None
+        self._segments = {}
+        self._inbox = {}
+        self._broadcast = array('q')
+        self._indexed = 0
+        self._maintainer = None
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock, self._file_lock:
+            if not self.manifest_path.exists():
+                self._manifest = {'segment_size': segment_size, 'first': 0, 'hot': 0,
+                                  'archived': {}}
+                self._save_manifest()
+                self._segment(0, create=True)
+                if legacy_path is not None and Path(legacy_path).exists():
+                    self._import_legacy(Path(legacy_path))
+            self._load_manifest()
+            self._segment(self._manifest['hot'], create=True)
+            self._refresh()
+
+    # -- manifest and segments ----------------------------------------------
+
+    @property
+    def segment_size(self):
+        return self._manifest['segment_size']
+
+    def segment_path(self, number, archived=False):
+        return self.root / (f'{number:08d}.jsonl' + ('.gz' if archived else ''))
+
+    def _save_manifest(self):
+        atomic_write(self.manifest_path, json.dumps(self._manifest).encode())
+        st = self.manifest_path.stat()
+        self._manifest_key = (st.st_ino, st.st_mtime_ns)
+
+    def _load_manifest(self):
+        st = self.manifest_path.stat()
+        key = (st.st_ino, st.st_mtime_ns)
+        if key == self._manifest_key:
+            return
+        self._manifest = json.loads(self.manifest_path.read_bytes())
+        self._manifest_key = key
+        for number in [n for n in self._segments if n < self._manifest['hot']]:
+            del self._segments[number]
+        self._prune_index()
+
+    def _segment(self, number, create=False):
+        segment = self._segments.get(number)
+        if segment is None:
+            segment = LogSegment(self.segment_path(number), number * self.segment_size, create)
+            self._segments[number] = segment
+        return segment
+
+    def _newest(self):
+        """Return the newest segment, following any started by other processes."""
+        number = max(self._segments, default=self._manifest['hot'])
+        segment = self._segment(number)
+        segment.refresh()
+        while segment.count >= self.segment_size and self.segment_path(number + 1).exists():
+            number += 1
+            segment = self._segment(number)
+        return segment
+
+    def _import_legacy(self, legacy_path):
+        """Seed the log from ``messages.jsonl`` or the old ``messages.json`` array."""
+        with legacy_path.open('rb') as f:
+            if legacy_path.suffix == '.jsonl':
+                messages = (json.loads(line) for line in f if line.endswith(b'\n'))
+            else:
+                messages = json.load(f)
+            for message in messages:
+                self._append(message)
+
+    def _append(self, message):
+        segment = self._newest()
+        if segment.count >= self.segment_size:
+            segment = self._segment(segment.base // self.segment_size + 1, create=True)
+            self._start_maintenance()
+        message = segment.append(message)
+        if self._indexed == message['id'] - 1:
+            self._index_message(message)
+        return message
+
+    # -- archiving ------------------------------------------------------------
+
+    def _start_maintenance(self):
+        if self._maintainer is None:
+            self._maintainer = threading.Thread(target=self._maintain, name='chatlog-archiver',
+                                                daemon=True)
+            self._maintainer.start()
+
+    def _next_to_archive(self):
+        """Return the oldest segment due for archiving, or None."""
+        self._load_manifest()
+        newest = self._newest().base // self.segment_size
+        if newest - self._manifest['hot'] >= self.hot_segments:
+            return self._manifest['hot']
+        return None
+
+    def _maintain(self):
+        """Archive segments beyond the hot ones and drop expired archives.
+
+        Runs on a background thread so appends do not wait for gzip.  A
+        full segment is never written again, so it is compressed without
+        holding the locks, which are only taken to switch the manifest over.
+        """
+        try:
+            while True:
+                with self._lock, self._file_lock:
+                    number = self._next_to_archive()
+                    if number is None:
+                        self._expire()
+                        self._maintainer = None
+                        return
+                path = self.segment_path(number)
+                target = self.segment_path(number, True)
+                tmp = target.with_name(f'.{target.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+                try:
+                    with path.open('rb') as src, gzip.open(tmp, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                except FileNotFoundError:
+                    continue  # archived by another process meanwhile
+                with self._lock, self._file_lock:
+                    if self._next_to_archive() != number:
+                        tmp.unlink(missing_ok=True)
+                        continue
+                    os.replace(tmp, target)
+                    segment = self._segment(number)
+                    last = segment.get([segment.last_id])[0] if segment.count else {}
+                    self._manifest['archived'][str(number)] = last.get('timestamp')
+                    self._manifest['hot'] = number + 1
+                    self._segments.pop(number, None)
+                    self._save_manifest()
+                    path.unlink()
+                    segment.index_path.unlink(missing_ok=True)
+                    self._prune_index()
+        except Exception:
+            logger.exception('archiving chat segments in %s failed', self.root)
+            with self._lock:
+                self._maintainer = None
+
+    def _expire(self):
+        manifest = self._manifest
+        if self.retain_days is None:
+            return
+        cutoff = (datetime.utcnow() - timedelta(days=self.retain_days)).isoformat()
+        while manifest['first'] < manifest['hot']:
+            number = manifest['first']
+            last = manifest['archived'].get(str(number))
+            if last is not None and last >= cutoff:
+                break
+            manifest['first'] = number + 1
+            manifest['archived'].pop(str(number), None)
+            self._save_manifest()
+            self.segment_path(number, True).unlink(missing_ok=True)
+
+    def wait_archived(self):
+        """Block until segments due for archiving have been archived."""
+        while True:
+            with self._lock:
+                maintainer = self._maintainer
+            if maintainer is None:
+                return
+            maintainer.join()
+
+    # -- recipient index ----------------------------------------------------
+
+    def _index_message(self, message):
+        recipients = message.get('recipients')
+        if recipients:
+            for user in set(recipients):
+                self._inbox.setdefault(user, array('q')).append(message['id'])
+        else:
+            self._broadcast.append(message['id'])
+        self._indexed = message['id']
+
+    def _prune_index(self):
+        """Drop archived messages from the recipient index."""
+        first = self._manifest['hot'] * self.segment_size
+        if self._indexed < first:
+            self._inbox.clear()
+            self._broadcast = array('q')
+            self._indexed = first
+            return
+        for user, ids in list(self._inbox.items()):
+            ids = ids[bisect_right(ids, first):]
+            if ids:
+                self._inbox[user] = ids
+            else:
+                del self._inbox[user]
+        self._broadcast = self._broadcast[bisect_right(self._broadcast, first):]
+
+    def _refresh(self):
+        """Pick up messages and segments written by other processes."""
+        self._load_manifest()
+        newest = self._newest()
+        for number in range(max(self._indexed // self.segment_size, self._manifest['hot']),
+                            newest.base // self.segment_size + 1):
+            for message in self._segment(number).read(self._indexed):
+                self._index_message(message)
+        return newest.last_id
+
+    # -- public API ---------------------------------------------------------
+
+    def append(self, message):
+        """Store ``message`` and return it with its assigned ``id``.
+
+        Appends from several processes are serialised on a lock file, so
+        each one sees the others' lines before numbering its own.
+        """
+        with self._lock, self._file_lock:
+            self._refresh()
+            return self._append(message)
+
+    def last_id(self):
+        with self._lock:
+            return self._refresh()
+
+    def first_id(self):
+        """Return the ID of the oldest retained message, minus one."""
+        with self._lock:
+            self._refresh()
+            return self._manifest['first'] * self.segment_size
+
+    def first_hot_id(self):
+        """Return the ID of the oldest message not yet archived, minus one."""
+        with self._lock:
+            self._refresh()
+            return self._manifest['hot'] * self.segment_size
+
+    def _iter(self, since, stop):
+        """Yield the messages with IDs in ``(since, stop]``, oldest first."""
+        with self._lock:
+            manifest = dict(self._manifest)
+        size = manifest['segment_size']
+        number = max(since // size, manifest['first'])
+        while number * size < stop:
+            if number < manifest['hot']:
+                try:
+                    messages = _read_archive(self.segment_path(number, True), since)
+                    for message in messages:
+                        if message['id'] > stop:
+                            return
+                        yield message
+                except FileNotFoundError:
+                    pass  # expired and deleted meanwhile
+            else:
+                for message in self._read_segment(number, since):
+                    if message['id'] > stop:
+                        return
+                    yield message
+            number += 1
+
+    def _read_segment(self, number, since):
+        with self._lock:
+            segment = self._segment(number)
+        try:
+            yield from segment.read(since)
+        except FileNotFoundError:
+            # Archived since the manifest was read; both files are opened
+            # before the first message is yielded.
+            yield from _read_archive(self.segment_path(number, True), since)
+
+    def read_since(self, since=0, limit=None, predicate=None):
+        """Return ``(messages, cursor)`` for messages with an ID above ``since``.
+
+        Only messages accepted by ``predicate`` are returned, at most ``limit``
+        of them.  ``cursor`` is the ID of the last message examined, which is
+        what the caller should pass as ``since`` next time.
+        """
+        count = self.last_id()
+        since = max(0, since)
+        if since >= count:
+            return [], since
+        messages = []
+        cursor = since
+        for message in self._iter(since, count):
+            cursor = message['id']
+            if predicate is None or predicate(message):
+                messages.append(message)
+                if limit is not None and len(messages) >= limit:
+                    break
+        return messages, cursor
+
+    def get(self, msg_ids):
+        """Return the messages with the given (ascending) IDs."""
+        with self._lock:
+            self._refresh()
+            size, hot = self.segment_size, self._manifest['hot']
+        messages = []
+        groups = {}
+        for msg_id in msg_ids:
+            groups.setdefault((msg_id - 1) // size, []).append(msg_id)
+        for number, ids in groups.items():
+            if number >= hot:
+                with self._lock:
+                    segment = self._segment(number)
+                try:
+                    messages.extend(segment.get(ids))
+                    continue
+                except FileNotFoundError:
+                    pass  # archived meanwhile
+            wanted = set(ids)
+            messages.extend(m for m in self._iter(ids[0] - 1, ids[-1]) if m['id'] in wanted)
+        return messages
+
+    def read_visible(self, username, since=0, limit=None):
+        """Return ``(messages, cursor, more)`` for ``username``'s feed.
+
+        The feed is every broadcast message plus those listing ``username``
+        among the recipients, starting after ID ``since``.  Archived
+        segments are scanned; the hot ones are served from the index.
+        """
+        def visible(message):
+            return not message.get('recipients') or username in message['recipients']
+
+        wanted = None if limit is None else limit + 1
+        with self._lock:
+            count = self._refresh()
+            hot_start = self._manifest['hot'] * self.segment_size
+
+            def after(ids):
+                start = bisect_right(ids, max(since, hot_start))
+                return (ids[i] for i in range(start, len(ids)))
+
+            merged = heapq.merge(after(self._inbox.get(username, array('q'))),
+                                 after(self._broadcast))
+            ids = list(islice(merged, wanted))
+        messages = []
+        if since < hot_start:
+            archived = filter(visible, self._iter(since, hot_start))
+            messages = list(islice(archived, wanted))
+        if wanted is not None:
+            ids = ids[:wanted - len(messages)]
+        messages += self.get(ids)
+        more = limit is not None and len(messages) > limit
+        if more:
+            messages = messages[:limit]
+            cursor = messages[-1]['id']
+        else:
+            cursor = max([since, count] + [m['id'] for m in messages[-1:]])
+        return messages, cursor, more
@@ -0,0 +1,82 @@
+"""In-process publish/subscribe used by the ``/events`` stream."""
+import json
+import queue
+import threading
+
+
+class Subscription:
+    """One connected client with a bounded queue of pending events."""
+
+    def __init__(self, username, can_see_all, maxsize):
+        self.username = username
+        self.can_see_all = can_see_all
+        self.queue = queue.Queue(maxsize)
+        # Set when the queue filled up and events were dropped; the client is
+        # told to resync instead of silently missing updates.
+        self.overflowed = False
+
+    def wants(self, users, managers):
+        if users is None:
+            return True
+        return self.username in users or (managers and self.can_see_all)
+
+    def offer(self, kind, data):
+        try:
+            self.queue.put_nowait((kind, data))
+        except queue.Full:
+            self.overflowed = True
+
+    def stream(self, heartbeat):
+        """Yield Server-Sent Events, with a comment line every ``heartbeat`` seconds."""
+        yield 'retry: 3000\n\n'
+        while True:
+            if self.overflowed:
+                self.overflowed = False
+                while True:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                yield 'event: resync\ndata: {}\n\n'
+            try:
+                kind, data = self.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield f'event: {kind}\ndata: {json.dumps(data)}\n\n'
+
+
+class EventBus:
+    """Fan events out to the subscriptions allowed to see them."""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, username, can_see_all=False):
+        sub = Subscription(username, can_see_all, self.queue_size)
+        with self._lock:
+            self._subscriptions.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscriptions.discard(sub)
+
+    def publish(self, kind, data, users=None, managers=False):
+        """Deliver an event.
+
+        ``users`` limits delivery to those usernames (``None`` broadcasts);
+        with ``managers`` set, subscribers that can see every user's tasks
+        receive it as well.
+        """
+        with self._lock:
+            subs = list(self._subscriptions)
+        for sub in subs:
+            if sub.wants(users, managers):
+                sub.offer(kind, data)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscriptions)
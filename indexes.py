@@ -0,0 +1,529 @@
+"""Derived data kept in step with the task store.
+
+Each view is built once from a user snapshot (``rebuild``) and then updated
+from the task operations applied through ``app.apply_ops`` (``apply``), so
+reads do not have to rescan every task.  ``app.sync_view`` rebuilds a view
+whenever the store's version no longer matches the one the view was last
+brought up to date with.
+"""
+import copy
+import json
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+
+from storage import atomic_write
+from taskmodel import Task
+
+
+class MaterializedView:
+    # Views with a name are persisted next to the data file so a restart (or
+    # another worker) can pick them up without rebuilding.
+    name = None
+    # Whether ``rebuild`` reads completed tasks, which the tiered store only
+    # loads on request (see ``app.load_full_users``).
+    archived = True
+
+    def __init__(self):
+        self.version = None
+
+    def rebuild(self, users):
+        raise NotImplementedError
+
+    def apply(self, op, result):
+        raise NotImplementedError
+
+    def is_fresh(self):
+        """Return False when the view must be rebuilt regardless of version."""
+        return True
+
+    def restore(self, path, version):
+        return False
+
+    def persist(self, path, version):
+        pass
+
+
+def _today():
+    return datetime.utcnow().date().isoformat()
+
+
+def _bump(counter, key, delta):
+    value = counter.get(key, 0) + delta
+    if value:
+        counter[key] = value
+    else:
+        counter.pop(key, None)
+
+
+def _new_counters():
+    return {
+        'total': 0,
+        'done': 0,
+        'priority': {},
+        'created': {},
+        'completed': {},
+        'today_total': 0,
+        'today_done': 0,
+    }
+
+
+class UserStats(MaterializedView):
+    """Per-user task aggregates maintained at write time.
+
+    For every user: task totals, done count, counts per priority, tasks
+    created and completed per day, and how many tasks were touched today
+    (and of those, how many were completed by their first update today).
+    Each task contributes independently, so an operation is applied by
+    subtracting the task's contribution before the change and adding it back
+    afterwards.
+    """
+
+    name = 'stats'
+
+    def __init__(self):
+        super().__init__()
+        self.users = {}
+        self.today = None
+
+    def _add(self, username, task, sign):
+        c = self.users.setdefault(username, _new_counters())
+        c['total'] += sign
+        if task.get('status') == 'Done':
+            c['done'] += sign
+        _bump(c['priority'], task.get('priority', 'Mid'), sign)
+        if task.get('created_at'):
+            _bump(c['created'], task['created_at'][:10], sign)
+        first_today = None
+        for h in task.get('history', []):
+            day = h['timestamp'][:10]
+            if h.get('status') == 'Done':
+                _bump(c['completed'], day, sign)
+            if first_today is None and day == self.today:
+                first_today = h
+        if first_today is not None:
+            c['today_total'] += sign
+            if first_today.get('status') == 'Done':
+                c['today_done'] += sign
+
+    def rebuild(self, users):
+        self.today = _today()
+        self.users = {}
+        for uname, udata in users.items():
+            self.users[uname] = _new_counters()
+            for key in ('tasks', 'past_tasks'):
+                for task in udata.get(key, []):
+                    self._add(uname, task, 1)
+
+    def apply(self, op, result):
+        task = result['task']
+        kind = op['op']
+        if kind == 'create':
+            self._add(op['user'], task, 1)
+        elif kind == 'status':
+            before = dict(task, status=result['previous'], history=task['history'][:-1])
+            self._add(op['user'], before, -1)
+            self._add(op['user'], task, 1)
+        elif kind == 'reassign':
+            self._add(op['user'], dict(task, history=task['history'][:-1]), -1)
+            self._add(op['to'], task, 1)
+
+    def is_fresh(self):
+        return self.today == _today()
+
+    # -- persistence -------------------------------------------------------
+
+    def restore(self, path, version):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if data.get('version') != json.loads(json.dumps(version)) or data.get('today') != _today():
+            return False
+        self.today = data['today']
+        self.users = data['users']
+        return True
+
+    def persist(self, path, version):
+        data = {'version': version, 'today': self.today, 'users': self.users}
+        atomic_write(path, json.dumps(data, separators=(',', ':')).encode())
+
+    def diff(self, other):
+        """Return the usernames whose counters differ from ``other``'s."""
+        names = set(self.users) | set(other.users)
+        return sorted(n for n in names if self.users.get(n) != other.users.get(n))
+
+    # -- queries -----------------------------------------------------------
+
+    def counters(self, username):
+        return self.users.get(username) or _new_counters()
+
+    def performance(self, username):
+        """Return the same shape as ``app.get_user_performance``."""
+        c = self.counters(username)
+        priorities = {'High': 0, 'Mid': 0, 'Low': 0}
+        priorities.update(c['priority'])
+        total = c['total']
+        return {
+            'total': total,
+            'done': c['done'],
+            'pending': total - c['done'],
+            'completion_rate': (c['done'] / total * 100) if total else 0,
+            'priority': priorities,
+        }
+
+    def progress_today(self, username):
+        c = self.counters(username)
+        return {'total': c['today_total'], 'done': c['today_done']}
+
+    def weekly(self, username, days=7):
+        """Return the same shape as ``app.weekly_completion``."""
+        today = date.fromisoformat(self.today)
+        completed = self.counters(username)['completed']
+        labels = [(today - timedelta(days=days - i - 1)).isoformat() for i in range(days)]
+        return {'labels': labels, 'data': [completed.get(d, 0) for d in labels]}
+
+
+PRIORITY_RANK = {'High': 0, 'Mid': 1, 'Low': 2}
+NO_DUE = '9999-12-31'
+
+
+class _Entry:
+    __slots__ = ('task', 'username', 'order_key', 'due_key')
+
+
+class _UserOrder:
+    def __init__(self):
+        self.by_order = []  # sorted (priority rank, due, seq, entry)
+        self.by_due = []    # sorted (due, seq, entry) for tasks with a due date
+
+
+class TaskOrder(MaterializedView):
+    """Per-user active tasks ordered by (priority, due date) and by due date.
+
+    Both orders are sorted lists kept in sync with each operation, so top-K
+    and due-date range queries are bisections plus a slice instead of a sort
+    over every active task.  Ties keep the order tasks were added in.
+    """
+
+    archived = False
+
+    def __init__(self):
+        super().__init__()
+        self.users = {}
+        self.entries = {}
+        self._seq = 0
+
+    def _insert(self, username, task):
+        order = self.users.setdefault(username, _UserOrder())
+        entry = _Entry()
+        entry.task = task
+        entry.username = username
+        seq = self._seq
+        self._seq += 1
+        due = task.get('due_date')
+        entry.order_key = (PRIORITY_RANK.get(task.get('priority', 'Mid'), 1), due or NO_DUE, seq)
+        entry.due_key = (due, seq) if due else None
+        self.entries[task['id']] = entry
+        insort(order.by_order, entry.order_key + (entry,))
+        if entry.due_key:
+            insort(order.by_due, entry.due_key + (entry,))
+
+    def _remove(self, task_id):
+        entry = self.entries.pop(task_id)
+        order = self.users[entry.username]
+        del order.by_order[bisect_left(order.by_order, entry.order_key)]
+        if entry.due_key:
+            del order.by_due[bisect_left(order.by_due, entry.due_key)]
+
+    def rebuild(self, users):
+        self.users = {}
+        self.entries = {}
+        for uname, udata in users.items():
+            self.users[uname] = _UserOrder()
+            for task in udata.get('tasks', []):
+                self._insert(uname, task)
+
+    def apply(self, op, result):
+        task = copy.deepcopy(result['task'])
+        kind = op['op']
+        if kind == 'create':
+            self._insert(op['user'], task)
+        elif kind == 'reassign':
+            self._remove(task['id'])
+            self._insert(op['to'], task)
+        elif kind == 'status' and task.get('status') == 'Done':
+            self._remove(task['id'])
+        else:
+            self.entries[task['id']].task = task
+
+    # -- queries -----------------------------------------------------------
+
+    def get(self, task_id):
+        """Return the active task with ``task_id``, or None."""
+        entry = self.entries.get(task_id)
+        return None if entry is None else entry.task
+
+    def top_tasks(self, username, k):
+        """Return the ``k`` most urgent active tasks (priority, then due date)."""
+        order = self.users.get(username)
+        if order is None:
+            return []
+        return [item[-1].task for item in order.by_order[:k]]
+
+    def due_between(self, username, start=None, end=None):
+        """Return active tasks due between ``start`` and ``end`` (ISO dates, inclusive)."""
+        order = self.users.get(username)
+        if order is None:
+            return []
+        lo = 0 if start is None else bisect_left(order.by_due, (start,))
+        hi = len(order.by_due) if end is None else bisect_right(order.by_due, (end, float('inf')))
+        return [item[-1].task for item in order.by_due[lo:hi]]
+
+    def overdue(self, username, today=None):
+        """Return active tasks whose due date is before ``today``."""
+        today = today or datetime.utcnow().date()
+        yesterday = (today - timedelta(days=1)).isoformat()
+        return self.due_between(username, end=yesterday)
+
+
+def created_key(task):
+    return (task.get('created_at') or '', task.get('id') or '')
+
+
+class CreatedOrder(MaterializedView):
+    """Per-user task IDs in ``(created_at, id)`` order, active and completed.
+
+    Only the keys are kept (the tasks are found through ``TaskIds``), sorted
+    so a keyset page is a bisection to the cursor and a scan from there.
+    Completed tasks of users with a tiered archive are keyed the first time
+    they are asked for, so building the view reads no archive.
+    """
+
+    archived = False
+
+    def __init__(self):
+        super().__init__()
+        self.active = {}
+        self.past = {}
+
+    def rebuild(self, users):
+        self.active = {}
+        self.past = {}
+        for uname, udata in users.items():
+            self.active[uname] = sorted(created_key(t) for t in udata.get('tasks', []))
+            if not udata.get('archive'):
+                self.past[uname] = sorted(created_key(t) for t in udata.get('past_tasks', []))
+
+    @staticmethod
+    def _discard(keys, key):
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+    def apply(self, op, result):
+        task = result['task']
+        key = created_key(task)
+        kind = op['op']
+        if kind == 'create':
+            insort(self.active.setdefault(op['user'], []), key)
+        elif kind == 'reassign':
+            self._discard(self.active.setdefault(op['user'], []), key)
+            insort(self.active.setdefault(op['to'], []), key)
+        elif kind == 'status' and task.get('status') == 'Done':
+            self._discard(self.active.setdefault(op['user'], []), key)
+            if op['user'] in self.past:
+                insort(self.past[op['user']], key)
+
+    def keys(self, username, past=False, load_past=lambda username: []):
+        """Return the user's sorted ``(created_at, id)`` keys (do not modify).
+
+        ``load_past(username)`` returns the user's completed tasks; it is
+        called once per user whose keys are not held yet.
+        """
+        if not past:
+            return self.active.get(username, [])
+        keys = self.past.get(username)
+        if keys is None:
+            keys = self.past[username] = sorted(created_key(t) for t in load_past(username))
+        return keys
+
+
+class TaskIds(MaterializedView):
+    """Global index from task ID to its owner and list.
+
+    Built from the hot data only: the tiered store lists the IDs in each
+    user's archive in its summary, so an archived task is found without
+    reading any archive.  The task itself is fetched from the owner's data
+    (see ``app.locate_task``).
+    """
+
+    name = 'ids'
+    archived = False
+
+    def __init__(self):
+        super().__init__()
+        self.tasks = {}
+
+    def rebuild(self, users):
+        self.tasks = {}
+        for uname, udata in users.items():
+            for task_id in (udata.get('archive') or {}).get('ids', []):
+                self.tasks[task_id] = (uname, 'past_tasks')
+            for key in ('tasks', 'past_tasks'):
+                for task in udata.get(key, []):
+                    self.tasks[task['id']] = (uname, key)
+
+    def apply(self, op, result):
+        task_id = result['task']['id']
+        kind = op['op']
+        owner = op['to'] if kind == 'reassign' else op['user']
+        if kind == 'status' and result['task'].get('status') == 'Done':
+            key = 'past_tasks'
+        elif kind == 'create':
+            key = 'tasks'
+        else:
+            key = self.tasks[task_id][1]
+        self.tasks[task_id] = (owner, key)
+
+    def restore(self, path, version):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if data.get('version') != json.loads(json.dumps(version)):
+            return False
+        self.tasks = {task_id: tuple(where) for task_id, where in data['tasks'].items()}
+        return True
+
+    def persist(self, path, version):
+        data = {'version': version, 'tasks': self.tasks}
+        atomic_write(path, json.dumps(data, separators=(',', ':')).encode())
+
+    def locate(self, task_id):
+        """Return ``(owner, 'tasks' or 'past_tasks')`` or None."""
+        return self.tasks.get(task_id)
+
+
+class CompactTasks(MaterializedView):
+    """Per-user tasks, active and completed, as ``taskmodel.Task`` objects.
+
+    A user's tasks are converted the first time they are asked for and from
+    then on only the task an operation changed is converted again, so their
+    timestamps are parsed once.  Users whose tasks were not asked for stay
+    unconverted; beyond ``max_users`` the least recently used are dropped.
+    """
+
+    archived = False
+
+    def __init__(self, max_users=64):
+        super().__init__()
+        self.max_users = max_users
+        self.users = OrderedDict()  # username -> {task id: Task}
+
+    def rebuild(self, users):
+        self.users = OrderedDict()
+
+    def apply(self, op, result):
+        task = result['task']
+        if op['op'] == 'reassign':
+            self.users.get(op['user'], {}).pop(task['id'], None)
+        owner = op['to'] if op['op'] == 'reassign' else op['user']
+        tasks = self.users.get(owner)
+        if tasks is not None:
+            # A copy, as the store may keep changing the dict it returned.
+            tasks[task['id']] = Task.from_dict(copy.deepcopy(task))
+
+    def tasks(self, username, load):
+        """Return the user's tasks; ``load(username)`` gives them as dicts."""
+        tasks = self.users.get(username)
+        if tasks is None:
+            tasks = self.users[username] = {t['id']: Task.from_dict(t) for t in load(username)}
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        self.users.move_to_end(username)
+        return list(tasks.values())
+
+
+class FeedVersions(MaterializedView):
+    """Per-user change counters and last-change times.
+
+    Lets the calendar feed and the render cache answer conditional requests
+    from the counters alone.  The generation is new for every rebuild, so
+    ETags issued before a rebuild are never mistaken for current ones; the
+    view is persisted, so every worker (and a restart with unchanged data)
+    issues the same ETags.
+    """
+
+    name = 'feeds'
+    archived = False
+
+    def __init__(self):
+        super().__init__()
+        self.generation = None
+        self.counters = {}
+        self.modified = {}
+        self.total = 0
+
+    def rebuild(self, users):
+        self.generation = uuid.uuid4().hex[:12]
+        self.counters = {}
+        self.modified = {}
+        self.total = 0
+        for uname, udata in users.items():
+            stamps = []
+            for task in udata.get('tasks', []):
+                stamps.append(task.get('created_at') or '')
+                stamps.extend(h.get('timestamp') or '' for h in task.get('history', []))
+            latest = max(stamps, default='')
+            self.modified[uname] = _parse_utc(latest) if latest else None
+
+    def restore(self, path, version):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if data.get('version') != json.loads(json.dumps(version)):
+            return False
+        self.generation = data['generation']
+        self.counters = data['counters']
+        self.modified = {u: _parse_utc(m) if m else None for u, m in data['modified'].items()}
+        self.total = data['total']
+        return True
+
+    def persist(self, path, version):
+        data = {
+            'version': version,
+            'generation': self.generation,
+            'counters': self.counters,
+            'modified': {u: m.isoformat() if m else None for u, m in self.modified.items()},
+            'total': self.total,
+        }
+        atomic_write(path, json.dumps(data, separators=(',', ':')).encode())
+
+    def apply(self, op, result):
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        for username in {op['user'], op.get('to')} - {None}:
+            self.counters[username] = self.counters.get(username, 0) + 1
+            self.modified[username] = now
+        self.total += 1
+
+    def etag(self, username=None):
+        """Return a token that changes with ``username``'s tasks (anyone's for None)."""
+        count = self.total if username is None else self.counters.get(username, 0)
+        return f'{self.generation}-{count}'
+
+    def last_modified(self, username):
+        return self.modified.get(username)
+
+
+def _parse_utc(timestamp):
+    """Parse a stored (naive UTC) timestamp into an aware, whole-second datetime."""
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.replace(microsecond=0)
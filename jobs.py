@@ -0,0 +1,73 @@
+"""A small in-process background job queue."""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Run callables on a pool of daemon threads.
+
+    ``observe(kind, seconds)`` is called with every job's latency, measured
+    from submission to completion, so the caller can feed its metrics.
+    """
+
+    def __init__(self, workers=2, name='jobs', observe=None):
+        self.workers = workers
+        self.name = name
+        self.observe = observe
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run, name=f'{self.name}-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, kind, fn, *args):
+        """Queue ``fn(*args)``; ``kind`` labels it in latency metrics."""
+        self._start()
+        self._queue.put((kind, fn, args, time.perf_counter()))
+
+    def _run(self):
+        while True:
+            kind, fn, args, queued = self._queue.get()
+            with self._lock:
+                self._running += 1
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('%s job %s failed', self.name, kind)
+                with self._lock:
+                    self.failed += 1
+            else:
+                with self._lock:
+                    self.completed += 1
+            finally:
+                with self._lock:
+                    self._running -= 1
+                if self.observe is not None:
+                    self.observe(kind, time.perf_counter() - queued)
+                self._queue.task_done()
+
+    def join(self):
+        """Block until every queued job has finished."""
+        self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'running': self._running,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
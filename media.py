@@ -0,0 +1,115 @@
+"""Attachment metadata and thumbnails, computed by background jobs.
+
+Pillow is optional: without it images still get their type and dimensions
+(read from the file header) but no thumbnails.
+"""
+import io
+import mimetypes
+import struct
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - depends on the environment
+    Image = None
+
+# Longest edge, in pixels, of each thumbnail variant.
+THUMBNAIL_SIZES = (320, 960)
+# Larger images get no thumbnails: decoding one could take gigabytes.
+MAX_PIXELS = 40_000_000
+
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+)
+
+
+def sniff_type(header, name=None):
+    """Return the MIME type from the file's magic bytes, else from its name."""
+    for magic, mimetype in _SIGNATURES:
+        if header.startswith(magic):
+            return mimetype
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return (name and mimetypes.guess_type(name)[0]) or 'application/octet-stream'
+
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        (length,) = struct.unpack('>H', f.read(2))
+        # Start-of-frame markers, except DHT (C4), JPG (C8) and DAC (CC).
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>xHH', f.read(5))
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def image_size(f, mimetype):
+    """Return ``(width, height)`` read from the header of an open image file."""
+    f.seek(0)
+    header = f.read(32)
+    if mimetype == 'image/png' and header[12:16] == b'IHDR':
+        return struct.unpack('>II', header[16:24])
+    if mimetype == 'image/gif':
+        return struct.unpack('<HH', header[6:10])
+    if mimetype == 'image/jpeg':
+        return _jpeg_size(f)
+    return None
+
+
+def describe(f, name=None):
+    """Return metadata for the open file ``f``: type and image dimensions."""
+    f.seek(0)
+    mimetype = sniff_type(f.read(32), name)
+    meta = {'type': mimetype}
+    if mimetype.startswith('image/'):
+        try:
+            size = image_size(f, mimetype)
+        except struct.error:
+            size = None
+        if size:
+            meta['width'], meta['height'] = size
+    return meta
+
+
+def thumbnails(f, sizes=THUMBNAIL_SIZES, max_pixels=MAX_PIXELS):
+    """Yield ``(longest edge, width, height, mimetype, bytes)`` per variant.
+
+    Only sizes smaller than the image are produced.  Yields nothing when
+    Pillow is missing or cannot read the image, or when the header declares
+    more than ``max_pixels`` pixels (checked before anything is decoded).
+    """
+    if Image is None:
+        return
+    f.seek(0)
+    try:
+        image = Image.open(f)
+        width, height = image.size
+        if width * height > max_pixels:
+            return
+        image.load()
+    except Exception:
+        return
+    has_alpha = image.mode in ('RGBA', 'LA', 'P')
+    for edge in sorted(sizes):
+        if max(image.size) <= edge:
+            break
+        thumb = image.copy()
+        thumb.thumbnail((edge, edge))
+        out = io.BytesIO()
+        if has_alpha:
+            thumb.save(out, 'PNG', optimize=True)
+            mimetype = 'image/png'
+        else:
+            thumb.convert('RGB').save(out, 'JPEG', quality=80, optimize=True)
+            mimetype = 'image/jpeg'
+        yield edge, thumb.size[0], thumb.size[1], mimetype, out.getvalue()
@@ -0,0 +1,206 @@
+"""Opt-in request profiling exposed in the Prometheus text format.
+
+While a request is being profiled, code marks where its time goes with
+``phase('load')``, ``phase('compute')``, ``phase('render')`` or
+``phase('save')`` (usable as a context manager or decorator) and reports
+quantities with ``count``.  Phases nest: time is charged to the innermost one,
+so a ``load`` inside a ``compute`` is not counted twice.  Outside a profiled
+request both are no-ops.
+
+When a request is finished its totals go into per-route histograms, which
+``Metrics.render`` formats for a ``/metrics`` endpoint.  A sampled fraction
+of requests can also run under ``cProfile``; the profile is dumped as a
+``.prof`` file (readable with ``pstats``) when the request took longer than
+a threshold.  Only one request is under ``cProfile`` at a time: its hooks
+are process-wide on Python 3.12 and later, where a profile also records
+every other thread, so slow-request dumps are only meaningful from a server
+running one worker thread.
+"""
+import contextlib
+import cProfile
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1 << 10, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24, 1 << 26)
+CALLS_BUCKETS = (0, 1, 2, 3, 5, 10, 25)
+
+_local = threading.local()
+# Held while a request runs under cProfile.
+_cprofile_lock = threading.Lock()
+
+
+class _Record:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counts = {}
+        self.stack = []
+        self.mark = self.start
+        self.profile = None
+
+    def _charge(self, now):
+        if self.stack:
+            name = self.stack[-1]
+            self.phases[name] = self.phases.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+
+class phase(contextlib.ContextDecorator):
+    """Charge the time spent inside to phase ``name`` of the current request."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        record = getattr(_local, 'record', None)
+        if record is not None:
+            record._charge(time.perf_counter())
+            record.stack.append(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        record = getattr(_local, 'record', None)
+        if record is not None and record.stack:
+            record._charge(time.perf_counter())
+            record.stack.pop()
+        return False
+
+
+def count(name, amount=1):
+    """Add ``amount`` to counter ``name`` of the current request."""
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record.counts[name] = record.counts.get(name, 0) + amount
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return ','.join(f'{k}="{v}"' for k, v in labels)
+
+
+class Metrics:
+    """Histogram families keyed by label values."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+
+    def observe(self, name, help_text, buckets, labels, value):
+        with self._lock:
+            family = self._families.setdefault(name, (help_text, buckets, {}))
+            series = family[2]
+            key = tuple(labels.items())
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def render(self, extra=()):
+        """Return the text exposition.
+
+        ``extra`` holds single-value series as ``(name, type, help, value)``.
+        """
+        lines = []
+        with self._lock:
+            for name, (help_text, buckets, series) in sorted(self._families.items()):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, n in zip(buckets + ('+Inf',), hist.counts):
+                        cumulative += n
+                        le = _labels(key + (('le', bound),))
+                        lines.append(f'{name}_bucket{{{le}}} {cumulative}')
+                    lines.append(f'{name}_sum{{{_labels(key)}}} {hist.sum}')
+                    lines.append(f'{name}_count{{{_labels(key)}}} {hist.count}')
+        for name, kind, help_text, value in extra:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """Collects per-request records into ``metrics``.
+
+    ``sample_rate`` is the fraction of requests run under ``cProfile``; those
+    slower than ``slow_seconds`` are dumped into ``profile_dir``.
+    """
+
+    PHASES = ('load', 'compute', 'render', 'save')
+
+    def __init__(self, prefix='taskmanager', sample_rate=0.0, slow_seconds=1.0, profile_dir='profiles'):
+        self.prefix = prefix
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.profile_dir = Path(profile_dir)
+        self.metrics = Metrics()
+
+    def start(self):
+        record = _Record()
+        if (self.sample_rate and random.random() < self.sample_rate
+                and _cprofile_lock.acquire(blocking=False)):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler or debugger holds the hooks.
+                _cprofile_lock.release()
+            else:
+                record.profile = profile
+        _local.record = record
+
+    def finish(self, route):
+        """Close the current request's record and fold it into the metrics."""
+        record = getattr(_local, 'record', None)
+        if record is None:
+            return None
+        _local.record = None
+        now = time.perf_counter()
+        while record.stack:
+            record._charge(now)
+            record.stack.pop()
+        elapsed = now - record.start
+        if record.profile is not None:
+            record.profile.disable()
+            _cprofile_lock.release()
+            if elapsed >= self.slow_seconds:
+                self._dump(record.profile, route, elapsed)
+        p = self.prefix
+        labels = {'route': route}
+        self.metrics.observe(f'{p}_request_duration_seconds', 'Request wall time.',
+                             DURATION_BUCKETS, labels, elapsed)
+        for name in self.PHASES:
+            self.metrics.observe(f'{p}_phase_duration_seconds', 'Request time spent per phase.',
+                                 DURATION_BUCKETS, dict(labels, phase=name),
+                                 record.phases.get(name, 0.0))
+        for name in ('bytes_read', 'bytes_written'):
+            self.metrics.observe(f'{p}_request_{name}', f'Storage {name.replace("_", " ")} per request.',
+                                 BYTES_BUCKETS, labels, record.counts.get(name, 0))
+        self.metrics.observe(f'{p}_request_load_users_calls', 'load_users() calls per request.',
+                             CALLS_BUCKETS, labels, record.counts.get('load_users', 0))
+        return record
+
+    def _dump(self, profile, route, elapsed):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        profile.dump_stats(self.profile_dir / f'{stamp}-{slug}-{int(elapsed * 1000)}ms.prof')
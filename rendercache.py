@@ -0,0 +1,90 @@
+"""A size-bounded LRU cache for rendered pages and page fragments."""
+import threading
+from collections import OrderedDict
+
+
+class RenderCache:
+    """Rendered strings kept in least-recently-used order within ``max_bytes``.
+
+    Keys should include everything the output depends on (route, viewer,
+    data version, ...), so stale entries are simply never asked for again
+    and age out.  Entries can also carry tags; ``invalidate(tag)`` drops
+    every entry with that tag straight away, freeing the memory early.
+    Sizes are counted in characters of the rendered text.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, tags)
+        self._tags = {}                # tag -> set of keys
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _drop(self, key):
+        value, tags = self._entries.pop(key)
+        self.size -= len(value)
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def put(self, key, value, tags=()):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, tuple(tags))
+            self.size += len(value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_render(self, key, render, tags=()):
+        """Return the cached value for ``key``, calling ``render()`` on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.put(key, value, tags)
+        return value
+
+    def invalidate(self, tag):
+        """Drop every entry tagged ``tag``."""
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
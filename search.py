@@ -0,0 +1,244 @@
+"""Full-text search over tasks and chat messages.
+
+``InvertedIndex`` maps each token to the documents containing it, with
+term frequencies, plus a sorted vocabulary so a query token also matches
+longer terms it is a prefix of.  Queries match documents containing every
+token and rank them with BM25; work is proportional to the postings of the
+query's terms, not to the size of the corpus.
+
+``TaskSearch`` indexes task descriptions and notes and is kept current like
+the other views in ``indexes.py``; ``MessageSearch`` follows the chat log.
+"""
+import heapq
+import html
+import math
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import Counter
+
+from indexes import MaterializedView
+
+_TOKEN = re.compile(r'\w+')
+_TAG = re.compile(r'<[^>]*>')
+# Longest vocabulary run a prefix token is expanded to; the shortest terms
+# (closest to what was typed) win.
+PREFIX_EXPANSIONS = 64
+# Weight of a prefix match relative to an exact one.
+PREFIX_WEIGHT = 0.5
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    return _TOKEN.findall((text or '').casefold())
+
+
+def plain_text(markup):
+    """Return the text of a chat message's HTML, without tags or entities."""
+    return html.unescape(_TAG.sub(' ', markup or ''))
+
+
+class InvertedIndex:
+    def __init__(self):
+        self.postings = {}  # term -> {doc: term frequency}
+        self.terms = []     # sorted vocabulary
+        self.lengths = {}   # doc -> (terms, token count)
+        self._total = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, doc, text):
+        """Index ``text`` under ``doc``, replacing what it had before."""
+        self.remove(doc)
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                insort(self.terms, term)
+            posting[doc] = tf
+        length = sum(counts.values())
+        self.lengths[doc] = (tuple(counts), length)
+        self._total += length
+
+    def remove(self, doc):
+        entry = self.lengths.pop(doc, None)
+        if entry is None:
+            return
+        terms, length = entry
+        self._total -= length
+        for term in terms:
+            posting = self.postings[term]
+            del posting[doc]
+            if not posting:
+                del self.postings[term]
+                del self.terms[bisect_left(self.terms, term)]
+
+    def expand(self, token):
+        """Return ``[(term, weight)]``: the token itself and terms it prefixes."""
+        matches = []
+        if token in self.postings:
+            matches.append((token, 1.0))
+        i = bisect_left(self.terms, token)
+        end = min(len(self.terms), i + PREFIX_EXPANSIONS)
+        while i < end and self.terms[i].startswith(token):
+            if self.terms[i] != token:
+                matches.append((self.terms[i], PREFIX_WEIGHT))
+            i += 1
+        return matches
+
+    def scores(self, query):
+        """Return ``{doc: score}`` for the documents matching every query token."""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens or not self.lengths:
+            return {}
+        n = len(self.lengths)
+        avg = self._total / n or 1
+        per_token = []
+        for token in tokens:
+            token_scores = {}
+            for term, weight in self.expand(token):
+                posting = self.postings[term]
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc, tf in posting.items():
+                    norm = tf + K1 * (1 - B + B * self.lengths[doc][1] / avg)
+                    score = weight * idf * tf * (K1 + 1) / norm
+                    if score > token_scores.get(doc, 0):
+                        token_scores[doc] = score
+            if not token_scores:
+                return {}
+            per_token.append(token_scores)
+        per_token.sort(key=len)
+        result = dict(per_token[0])
+        for token_scores in per_token[1:]:
+            result = {doc: s + token_scores[doc] for doc, s in result.items() if doc in token_scores}
+        return result
+
+
+def top(scores, accept, limit):
+    """Return the ``limit`` best ``(score, doc)`` pairs accepted by ``accept``.
+
+    Equal scores go to the larger key (for messages, the newer one).
+    """
+    return heapq.nlargest(limit, ((s, doc) for doc, s in scores.items() if accept(doc)))
+
+
+class TaskSearch(MaterializedView):
+    """Search index over active and completed tasks: description and notes.
+
+    Updates arrive under the app's view lock, but queries do not take it,
+    so the index has a lock of its own.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.index = InvertedIndex()
+        self.owners = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _text(task):
+        return ' '.join([task.get('description') or '']
+                        + [n.get('text') or '' for n in task.get('notes', [])])
+
+    @classmethod
+    def _add(cls, index, owners, owner, task):
+        owners[task['id']] = owner
+        index.add(task['id'], cls._text(task))
+
+    def rebuild(self, users):
+        index = InvertedIndex()
+        owners = {}
+        for uname, udata in users.items():
+            for key in ('tasks', 'past_tasks'):
+                for task in udata.get(key, []):
+                    self._add(index, owners, uname, task)
+        with self._lock:
+            self.index = index
+            self.owners = owners
+
+    def apply(self, op, result):
+        task = result['task']
+        kind = op['op']
+        with self._lock:
+            if kind in ('create', 'note'):
+                self._add(self.index, self.owners, op['user'], task)
+            elif kind == 'reassign':
+                self.owners[task['id']] = op['to']
+
+    def search(self, query, owners=None, limit=20):
+        """Return the best ``(score, task_id)`` pairs among tasks owned by ``owners``.
+
+        ``owners=None`` searches everyone's tasks.
+        """
+        if owners is None:
+            def accept(task_id):
+                return True
+        else:
+            def accept(task_id):
+                return self.owners.get(task_id) in owners
+        with self._lock:
+            return top(self.index.scores(query), accept, limit)
+
+
+class MessageSearch:
+    """Search index over chat message text, following a ``ChatLog``.
+
+    Messages are added as they are posted (``add``) and any written by
+    other processes are picked up by ``sync`` before each query.  Only
+    recipients of addressed messages are kept beside the index; the
+    messages themselves are read back from the log.  Like the log's
+    recipient index it covers the hot segments only, so its size does not
+    grow with the history: messages are dropped once they are archived.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.index = InvertedIndex()
+        self.recipients = {}
+        self.indexed = 0
+        self.first = 0
+        self._lock = threading.Lock()
+
+    def _add(self, message):
+        self.index.add(message['id'], plain_text(message.get('text')))
+        if message.get('recipients'):
+            self.recipients[message['id']] = frozenset(message['recipients'])
+        self.indexed = message['id']
+
+    def add(self, message):
+        """Index a message just appended to the log, if nothing is missing before it."""
+        with self._lock:
+            if message['id'] == self.indexed + 1:
+                self._add(message)
+
+    def sync(self, batch=1000):
+        with self._lock:
+            first = self.log.first_hot_id()
+            # Drop messages archived (or removed) by the log.
+            for msg_id in range(self.first + 1, min(first, self.indexed) + 1):
+                self.index.remove(msg_id)
+                self.recipients.pop(msg_id, None)
+            self.first = max(self.first, first)
+            self.indexed = max(self.indexed, first)
+            while True:
+                messages, cursor = self.log.read_since(self.indexed, limit=batch)
+                for message in messages:
+                    self._add(message)
+                self.indexed = cursor
+                if len(messages) < batch:
+                    return
+
+    def search(self, query, username, limit=20):
+        """Return the best ``(score, message_id)`` pairs visible to ``username``."""
+        self.sync()
+
+        def accept(msg_id):
+            recipients = self.recipients.get(msg_id)
+            return recipients is None or username in recipients
+        with self._lock:
+            scores = self.index.scores(query)
+        return top(scores, accept, limit)
@@ -1,12 +1,13 @@
 // Basic drag-and-drop reassignment for tasks
 window.addEventListener('DOMContentLoaded', () => {
-  document.querySelectorAll('.task-item').forEach(item => {
-    item.addEventListener('dragstart', e => {
-      e.dataTransfer.setData('text/plain', JSON.stringify({
-        user: item.dataset.user,
-        index: item.dataset.index
-      }));
-    });
+  // Delegated so task items loaded after the page still drag.
+  document.addEventListener('dragstart', e => {
+    const item = e.target.closest && e.target.closest('.task-item');
+    if (!item) return;
+    e.dataTransfer.setData('text/plain', JSON.stringify({
+      user: item.dataset.user,
+      id: item.dataset.id
+    }));
   });
 
   document.querySelectorAll('.task-list').forEach(list => {
@@ -17,15 +18,24 @@ window.addEventListener('DOMContentLoaded', () => {
       const targetUser = list.dataset.user;
       if (!targetUser) return;
       if (data.user === targetUser) return;
-      fetch('/tasks', {
+      fetch('/tasks/batch', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
-        body: new URLSearchParams({
-          task_index: data.index,
-          user: data.user,
-          reassign: targetUser
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          ops: [{ op: 'reassign', id: data.id, to: targetUser }]
         })
-      }).then(() => window.location.reload());
+      }).then(response => {
+        if (response.status !== 202) {
+          window.location.reload();
+          return;
+        }
+        // Queued by the service worker while offline: show the move now.
+        const item = document.querySelector(`.task-item[data-id="${CSS.escape(data.id)}"]`);
+        if (item) {
+          item.dataset.user = targetUser;
+          list.appendChild(item);
+        }
+      });
     });
   });
 });
@@ -0,0 +1,1051 @@
+"""Persistence backends for the user/task store.
+
+Every backend exposes the same small interface used by ``app.py``: ``load`` and
+``save`` for whole snapshots, ``get_user_tasks``/``get_all_tasks`` for reads
+scoped to one user, ``version`` for cheap change detection and ``apply`` for
+task mutations expressed as operation dicts (see ``apply_op``).
+
+The file-based backends can be shared by several worker processes: writers
+serialise on an ``fcntl`` lock file next to the data and replace files
+atomically, so reads do not take the lock.  The journal store only takes it
+for a read that overlapped a compaction in another process.
+"""
+import contextlib
+import copy
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import quote
+
+import profiling
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def new_task_id():
+    return uuid.uuid4().hex
+
+
+def assign_task_ids(users):
+    """Give every task without an ``id`` a new one; return how many changed."""
+    assigned = 0
+    for udata in users.values():
+        for key in ('tasks', 'past_tasks'):
+            for task in udata.get(key, []):
+                if not task.get('id'):
+                    task['id'] = new_task_id()
+                    assigned += 1
+    return assigned
+
+
+class TaskPositions:
+    """Where each task sits in its owner's active list, by task ``id``.
+
+    Built lazily per user from a ``users`` snapshot and kept current by
+    ``apply_op``, so an operation finds its task with a dict lookup instead
+    of scanning the list.  Only valid while every change to the snapshot's
+    active lists goes through ``apply_op`` with this instance.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self._maps = {}
+
+    def _map(self, username):
+        positions = self._maps.get(username)
+        if positions is None:
+            tasks_list = self.users.get(username, {}).get('tasks', [])
+            positions = self._maps[username] = {
+                task.get('id'): i for i, task in enumerate(tasks_list)}
+        return positions
+
+    def find(self, username, task_id):
+        return self._map(username).get(task_id, -1)
+
+    def appended(self, username, task):
+        if username in self._maps:
+            self._maps[username][task.get('id')] = len(self.users[username]['tasks']) - 1
+
+    def removed(self, username, idx, task):
+        # Everything after ``idx`` moved up one, as it did in the list.
+        positions = self._maps.get(username)
+        if positions is None:
+            return
+        positions.pop(task.get('id'), None)
+        for later in self.users[username]['tasks'][idx:]:
+            positions[later.get('id')] = positions.get(later.get('id'), 0) - 1
+
+
+def _position(tasks_list, op, positions):
+    """Return the list position of the task an operation refers to.
+
+    Operations name a task by its stable ``id``; the list ``index`` form is
+    still accepted for old clients.
+    """
+    task_id = op.get('id')
+    if task_id is None:
+        return op['index']
+    if positions is not None:
+        return positions.find(op['user'], task_id)
+    for i, task in enumerate(tasks_list):
+        if task.get('id') == task_id:
+            return i
+    return -1
+
+
+def apply_op(users, op, positions=None):
+    """Apply one task mutation to the ``users`` snapshot in place.
+
+    Supported operations (existing tasks are addressed by ``id``, or by
+    ``index`` in the owner's active list)::
+
+        {'op': 'create', 'user': ..., 'task': {...}}
+        {'op': 'note', 'user': ..., 'id': ..., 'note': {...}}
+        {'op': 'reassign', 'user': ..., 'id': ..., 'to': ..., 'timestamp': ...}
+        {'op': 'status', 'user': ..., 'id': ..., 'status': ..., 'timestamp': ...}
+
+    Returns a result dict whose ``ok`` flag says whether anything changed;
+    successful results carry the affected ``task`` and, for status changes,
+    the ``previous`` status.  Pass the snapshot's ``TaskPositions`` to find
+    tasks by ``id`` without scanning the owner's list.
+    """
+    kind = op['op']
+    if kind == 'create':
+        target = users.get(op['user'])
+        if target is None:
+            return {'ok': False}
+        target.setdefault('tasks', []).append(op['task'])
+        if positions is not None:
+            positions.appended(op['user'], op['task'])
+        return {'ok': True, 'task': op['task']}
+
+    tasks_list = users.get(op['user'], {}).get('tasks', [])
+    idx = _position(tasks_list, op, positions)
+    if not 0 <= idx < len(tasks_list):
+        return {'ok': False}
+    task = tasks_list[idx]
+    if kind == 'note':
+        task.setdefault('notes', []).append(op['note'])
+    elif kind == 'reassign':
+        new_user = op['to']
+        if new_user not in users:
+            return {'ok': False}
+        tasks_list.pop(idx)
+        task.setdefault('history', []).append({
+            'status': task.get('status'),
+            'timestamp': op['timestamp'],
+            'action': f'reassigned_to_{new_user}'
+        })
+        users[new_user].setdefault('tasks', []).append(task)
+        if positions is not None:
+            positions.removed(op['user'], idx, task)
+            positions.appended(new_user, task)
+    elif kind == 'status':
+        new_status = op['status']
+        previous = task.get('status')
+        task['status'] = new_status
+        task.setdefault('history', []).append({
+            'status': new_status,
+            'timestamp': op['timestamp'],
+            'action': 'status_change'
+        })
+        if new_status == 'Done':
+            users[op['user']].setdefault('past_tasks', []).append(task)
+            tasks_list.pop(idx)
+            if positions is not None:
+                positions.removed(op['user'], idx, task)
+        return {'ok': True, 'task': task, 'previous': previous}
+    else:
+        raise ValueError(f'Unknown operation {kind!r}')
+    return {'ok': True, 'task': task}
+
+
+def rolled_back(results):
+    """Mark the successful results of a batch that was not applied."""
+    return [r if not r['ok'] else {'ok': False, 'rolled_back': True} for r in results]
+
+
+class FileLock:
+    """Exclusive lock shared between processes through ``flock`` on ``path``.
+
+    The lock is reentrant within a process.  ``flock`` locks belong to an
+    open file, so a process must use a single instance per path; get it from
+    ``file_lock``.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+def file_lock(path):
+    """Return this process's ``FileLock`` for the data file at ``path``."""
+    path = Path(path).resolve()
+    with _file_locks_lock:
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = _file_locks[path] = FileLock(path.with_name(path.name + '.lock'))
+        return lock
+
+
+class Storage:
+    """Base class holding the snapshot-based fallbacks."""
+
+    # Held around read-modify-write cycles that other processes must not
+    # interleave with.
+    lock = contextlib.nullcontext()
+    # True when ``load`` leaves completed tasks out; see ``past_tasks``.
+    tiered = False
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, users):
+        raise NotImplementedError
+
+    def version(self):
+        """Return a token that changes whenever the stored data changes."""
+        raise NotImplementedError
+
+    def get_user_tasks(self, username):
+        return self.load().get(username, {}).get('tasks', [])
+
+    def get_all_tasks(self, username):
+        udata = self.load().get(username, {})
+        return udata.get('tasks', []) + udata.get('past_tasks', [])
+
+    def past_tasks(self, users, username):
+        """Return ``username``'s completed tasks for the ``users`` snapshot."""
+        return users.get(username, {}).get('past_tasks', [])
+
+    def update(self, mutate):
+        """Load, call ``mutate(users)`` and save if it returns a truthy value."""
+        with self.lock:
+            users = self.load()
+            changed = mutate(users)
+            if changed:
+                self.save(users)
+            return changed
+
+    def apply(self, ops, atomic=False):
+        return self.apply_versioned(ops, atomic)[0]
+
+    def apply_versioned(self, ops, atomic=False):
+        """Apply ``ops`` and return ``(results, base, version)``.
+
+        ``base`` is the version the operations were applied on top of and
+        ``version`` the one they produced, so callers can tell whether
+        somebody else wrote in between.  With ``atomic`` nothing is stored
+        unless every operation succeeds (see ``rolled_back``).
+        """
+        with self.lock:
+            base = self.version()
+            users = self.load()
+            positions = TaskPositions(users)
+            results = [apply_op(users, op, positions) for op in ops]
+            if atomic and not all(r['ok'] for r in results):
+                return rolled_back(results), base, base
+            if not any(r['ok'] for r in results):
+                return results, base, base
+            self.save(users)
+            return results, base, self.version()
+
+
+class JSONStorage(Storage):
+    """The original layout: one pretty-printed ``users.json`` file.
+
+    ``apply`` is optimistic: operations are applied to a snapshot read
+    without the lock, and the result is written only if the file is still at
+    the version that snapshot was read at.  After ``retries`` conflicts the
+    whole cycle runs under the lock instead.
+    """
+
+    def __init__(self, path, retries=3, backoff=0.005):
+        self.path = Path(path)
+        self.lock = file_lock(self.path)
+        self.retries = retries
+        self.backoff = backoff
+        self.conflicts = 0
+
+    def load(self):
+        data = self.path.read_bytes()
+        profiling.count('bytes_read', len(data))
+        return json.loads(data)
+
+    def save(self, users):
+        with self.lock:
+            atomic_write(self.path, json.dumps(users, indent=2).encode())
+
+    def version(self):
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        # Every save renames a new file into place, so the inode changes
+        # even when the mtime and size happen not to.
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def apply_versioned(self, ops, atomic=False):
+        for attempt in range(self.retries):
+            base = self.version()
+            users = self.load()
+            positions = TaskPositions(users)
+            results = [apply_op(users, op, positions) for op in copy.deepcopy(ops)]
+            if atomic and not all(r['ok'] for r in results):
+                return rolled_back(results), base, base
+            if not any(r['ok'] for r in results):
+                return results, base, base
+            with self.lock:
+                if self.version() == base:
+                    self.save(users)
+                    return results, base, self.version()
+            self.conflicts += 1
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        return super().apply_versioned(copy.deepcopy(ops), atomic)
+
+
+def _completed_at(task):
+    history = task.get('history') or [{}]
+    return history[-1].get('timestamp')
+
+
+class TieredStorage(JSONStorage):
+    """``users.json`` holding only users and active tasks; completed tasks are archived.
+
+    Each user's completed tasks live in ``<archive_dir>/<user>.jsonl.gz``
+    and the hot file keeps a small ``archive`` summary per user (how many
+    tasks, when the last was completed, the archive's size and the IDs in
+    it, so tasks can be found without reading archives).  ``save`` moves
+    any ``past_tasks`` out of the hot data by appending them to the archive
+    as one more gzip member, so archives are never rewritten; anything past
+    the recorded size is a torn append from a crash and is cut off first.
+    Readers skip a damaged member and carry on with the next one.
+
+    ``load`` parses the hot file only.  ``past_tasks`` reads a user's
+    archive when a view needs it, keeping the ``cache_users`` most recently
+    read ones in memory.
+    """
+
+    tiered = True
+
+    def __init__(self, path, archive_dir=None, cache_users=64, **kwargs):
+        super().__init__(path, **kwargs)
+        self.archive_dir = Path(archive_dir) if archive_dir else self.path.with_name('archive')
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_users = cache_users
+        self._archives = OrderedDict()  # username -> (stat key, tasks)
+        self._archive_lock = threading.Lock()
+
+    def archive_path(self, username):
+        return self.archive_dir / f'{quote(username, safe="")}.jsonl.gz'
+
+    def _append_archive(self, username, tasks, size=None):
+        """Append ``tasks`` as one gzip member and return the archive's new size.
+
+        ``size`` is the size recorded after the last complete append.
+        """
+        data = b''.join(json.dumps(t, separators=(',', ':')).encode() + b'\n' for t in tasks)
+        member = gzip.compress(data)
+        with open(self.archive_path(username), 'ab') as f:
+            if size is not None and f.tell() > size:
+                # The tasks of a torn append are still in the hot file.
+                f.truncate(size)
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+        profiling.count('bytes_written', len(member))
+        return end
+
+    def save(self, users):
+        with self.lock:
+            hot = {}
+            for username, udata in users.items():
+                done = udata.get('past_tasks')
+                udata = {k: v for k, v in udata.items() if k != 'past_tasks'}
+                if done:
+                    # Archived before the hot file drops them, so a crash in
+                    # between can only leave a task in both places.
+                    summary = dict(udata.get('archive') or {'count': 0, 'ids': []})
+                    if 'ids' not in summary:
+                        # Summaries written before IDs were recorded.
+                        summary['ids'] = [t.get('id') for t in self._read_archive(username)]
+                    ids = set(summary['ids'])
+                    summary['ids'] = summary['ids'] + [
+                        t.get('id') for t in done if t.get('id') not in ids]
+                    summary['bytes'] = self._append_archive(username, done, summary.get('bytes'))
+                    summary['count'] += len(done)
+                    summary['last'] = max(filter(None, [summary.get('last')]
+                                                 + [_completed_at(t) for t in done]), default=None)
+                    udata['archive'] = summary
+                hot[username] = udata
+            super().save(hot)
+
+    def _read_archive(self, username):
+        path = self.archive_path(username)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return []
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._archive_lock:
+            cached = self._archives.get(username)
+            if cached is not None and cached[0] == key:
+                self._archives.move_to_end(username)
+                return cached[1]
+        tasks = {}
+        profiling.count('archive_loads')
+        data = path.read_bytes()
+        profiling.count('bytes_read', len(data))
+        i = 0
+        for member in _gzip_members(data):
+            for line in member.splitlines():
+                task = json.loads(line)
+                # A task is archived again if a crash left it in the hot
+                # file too; the later copy wins.
+                tasks[task.get('id') or i] = task
+                i += 1
+        tasks = list(tasks.values())
+        with self._archive_lock:
+            self._archives[username] = (key, tasks)
+            self._archives.move_to_end(username)
+            while len(self._archives) > self.cache_users:
+                self._archives.popitem(last=False)
+        return tasks
+
+    def past_tasks(self, users, username):
+        udata = users.get(username, {})
+        # Tasks completed before the store was tiered stay in the hot file
+        # until the next save moves them out.
+        pending = list(udata.get('past_tasks', []))
+        if not udata.get('archive'):
+            return pending
+        return self._read_archive(username) + pending
+
+    def get_all_tasks(self, username):
+        users = self.load()
+        return users.get(username, {}).get('tasks', []) + self.past_tasks(users, username)
+
+
+def _gzip_members(data):
+    """Yield the contents of each intact gzip member in ``data``.
+
+    A damaged or torn member is skipped by resuming at the next gzip header
+    after it.
+    """
+    view = memoryview(data)
+    pos = 0
+    while pos < len(data):
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            content = decompressor.decompress(view[pos:])
+        except zlib.error:
+            content = None
+        if content is not None and decompressor.eof:
+            yield content
+            pos = len(data) - len(decompressor.unused_data)
+            continue
+        pos = data.find(b'\x1f\x8b\x08', pos + 1)
+        if pos < 0:
+            return
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def atomic_write(path, data):
+    """Replace ``path`` with ``data`` so readers never see a torn file."""
+    path = Path(path)
+    profiling.count('bytes_written', len(data))
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(path.parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class JournalStorage(JSONStorage):
+    """``users.json`` snapshot plus an append-only log of task operations.
+
+    Each successful operation is appended to ``<snapshot>.journal`` as one
+    compact JSON line, so write cost no longer depends on the dataset size.
+    Appends are flushed immediately and fsynced in batches (every
+    ``fsync_every`` operations or ``fsync_interval`` seconds, whichever comes
+    first).  Readers replay the journal on top of the snapshot.
+
+    A background thread folds the journal into a fresh snapshot once it holds
+    ``compact_every`` operations.  The journal's first line records the digest
+    of the snapshot it applies to; the new snapshot is renamed into place
+    before the journal is reset, so a crash in between leaves a journal whose
+    base no longer matches and is therefore ignored instead of replayed twice.
+    """
+
+    def __init__(self, path, journal_path=None, fsync_every=64, fsync_interval=0.05,
+                 compact_every=1000):
+        super().__init__(path)
+        self.journal_path = Path(journal_path) if journal_path else self.path.with_name(
+            self.path.name + '.journal')
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._state = None
+        self._positions = None
+        self._snap_key = None
+        self._base = None
+        self._offset = 0
+        self._entries = 0
+        self._stale = False
+        self._log = None
+        self._unsynced = 0
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='journal-compactor', daemon=True)
+        self._thread.start()
+
+    # -- replay ------------------------------------------------------------
+
+    def _stat_key(self):
+        st = self.path.stat()
+        try:
+            journal_ino = self.journal_path.stat().st_ino
+        except FileNotFoundError:
+            journal_ino = None
+        # A journal rewritten by another process (new header) has a new
+        # inode and is replayed from the start.
+        return (st.st_ino, st.st_mtime_ns, st.st_size, journal_ino)
+
+    def _refresh(self):
+        key = self._stat_key()
+        if key != self._snap_key:
+            self._close_log()
+            data = self.path.read_bytes()
+            profiling.count('bytes_read', len(data))
+            self._state = json.loads(data)
+            self._positions = TaskPositions(self._state)
+            self._base = _digest(data)
+            self._snap_key = key
+            self._offset = 0
+            self._entries = 0
+            self._stale = False
+        if not self._stale:
+            self._replay_tail()
+
+    def _replay_tail(self):
+        try:
+            with self.journal_path.open('rb') as f:
+                f.seek(self._offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return
+        profiling.count('bytes_read', len(chunk))
+        pos = 0
+        while True:
+            end = chunk.find(b'\n', pos)
+            if end < 0:
+                # Anything after the last newline is a torn append.
+                break
+            record = json.loads(chunk[pos:end])
+            if self._offset == 0 and pos == 0:
+                if record.get('base') != self._base:
+                    self._stale = True
+                    return
+            else:
+                apply_op(self._state, record, self._positions)
+                self._entries += 1
+            pos = end + 1
+        self._offset += pos
+
+    # -- appends -----------------------------------------------------------
+
+    def _open_log(self):
+        if self._log is None:
+            if self._stale or self._offset == 0:
+                header = json.dumps({'base': self._base}).encode() + b'\n'
+                atomic_write(self.journal_path, header)
+                self._offset = len(header)
+                self._entries = 0
+                self._stale = False
+                self._snap_key = self._stat_key()
+            self._log = self.journal_path.open('ab')
+        if os.fstat(self._log.fileno()).st_size > self._offset:
+            # Drop a torn append (possibly left by another process).
+            self._log.truncate(self._offset)
+        return self._log
+
+    def _sync(self):
+        if self._log is not None and self._unsynced:
+            os.fsync(self._log.fileno())
+            self._unsynced = 0
+
+    def _close_log(self):
+        if self._log is not None:
+            self._sync()
+            self._log.close()
+            self._log = None
+
+    def _append(self, op):
+        line = json.dumps(op, separators=(',', ':')).encode() + b'\n'
+        log = self._open_log()
+        log.write(line)
+        profiling.count('bytes_written', len(line))
+        log.flush()
+        self._offset += len(line)
+        self._entries += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self._sync()
+
+    # -- snapshots ---------------------------------------------------------
+
+    def _write_snapshot(self):
+        data = json.dumps(self._state, indent=2).encode()
+        self._close_log()
+        atomic_write(self.path, data)
+        self._base = _digest(data)
+        self._snap_key = self._stat_key()
+        self._offset = 0
+        self._open_log()
+
+    def compact(self):
+        """Fold the journal into a new snapshot."""
+        with self._lock, self.lock:
+            self._refresh()
+            self._write_snapshot()
+
+    def _run(self):
+        while not self._closed.wait(self.fsync_interval):
+            try:
+                with self._lock:
+                    self._sync()
+                    if self._entries >= self.compact_every:
+                        self.compact()
+            except Exception:
+                logger.exception('journal maintenance failed for %s', self.journal_path)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        with self._lock:
+            self._close_log()
+
+    # -- Storage interface -------------------------------------------------
+
+    def load(self):
+        # Compaction renames a new snapshot and then a new journal into
+        # place, so when neither file changed while they were read, the
+        # snapshot and journal belong together.  Otherwise read again under
+        # the lock, which compaction holds.
+        with self._lock:
+            self._refresh()
+            if self._snap_key == self._stat_key():
+                return copy.deepcopy(self._state)
+        with self._lock, self.lock:
+            self._refresh()
+            return copy.deepcopy(self._state)
+
+    def save(self, users):
+        with self._lock, self.lock:
+            self._state = copy.deepcopy(users)
+            self._positions = TaskPositions(self._state)
+            self._write_snapshot()
+
+    def version(self):
+        try:
+            journal_size = self.journal_path.stat().st_size
+        except FileNotFoundError:
+            journal_size = 0
+        return (JSONStorage.version(self), journal_size)
+
+    def update(self, mutate):
+        # Same lock order as every other journal write: thread lock first.
+        with self._lock:
+            return super().update(mutate)
+
+    def apply_versioned(self, ops, atomic=False):
+        with self._lock, self.lock:
+            self._refresh()
+            base = self.version()
+            try:
+                results = [apply_op(self._state, op, self._positions) for op in ops]
+                if atomic and not all(r['ok'] for r in results):
+                    # Undo the successful ones by re-reading the state.
+                    self._snap_key = None
+                    return rolled_back(results), base, base
+                for op, result in zip(ops, results):
+                    if result['ok']:
+                        self._append(op)
+            except BaseException:
+                # The in-memory state may be ahead of the journal; re-read it.
+                self._snap_key = None
+                raise
+            return results, base, self.version()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT,
+    role TEXT,
+    branches TEXT NOT NULL DEFAULT '[]',
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    uid TEXT,
+    username TEXT NOT NULL REFERENCES users(username),
+    archived INTEGER NOT NULL DEFAULT 0,
+    pos INTEGER NOT NULL,
+    description TEXT,
+    priority TEXT,
+    status TEXT,
+    due_date TEXT,
+    created_at TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS tasks_by_owner ON tasks(username, archived, pos);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    task_id INTEGER NOT NULL REFERENCES tasks(id),
+    status TEXT,
+    timestamp TEXT,
+    action TEXT
+);
+CREATE INDEX IF NOT EXISTS history_by_task ON history(task_id, id);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    task_id INTEGER NOT NULL REFERENCES tasks(id),
+    text TEXT,
+    timestamp TEXT,
+    author TEXT
+);
+CREATE INDEX IF NOT EXISTS notes_by_task ON notes(task_id, id);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+"""
+# Applied after SCHEMA so databases created before the column existed get it.
+SCHEMA_UPGRADES = (
+    ('tasks', 'uid', 'ALTER TABLE tasks ADD COLUMN uid TEXT'),
+)
+SCHEMA_INDEXES = """
+CREATE UNIQUE INDEX IF NOT EXISTS tasks_by_uid ON tasks(uid);
+"""
+
+USER_COLUMNS = ('password', 'role', 'branches')
+TASK_COLUMNS = ('description', 'priority', 'status', 'due_date', 'created_at')
+TASK_LISTS = ('history', 'notes')
+
+
+class SQLiteStorage(Storage):
+    """Row-per-task storage in SQLite (WAL mode).
+
+    Users, tasks, history entries and notes are separate indexed tables, so a
+    single task mutation touches a handful of rows instead of rewriting the
+    whole dataset.  Active tasks keep their list order through ``pos``.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        for table, column, ddl in SCHEMA_UPGRADES:
+            columns = {r['name'] for r in conn.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                conn.execute(ddl)
+        conn.executescript(SCHEMA_INDEXES)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    def version(self):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0]
+
+    # -- reads -------------------------------------------------------------
+
+    def _task_rows(self, conn, where, params):
+        rows = conn.execute(
+            f'SELECT * FROM tasks WHERE {where} ORDER BY username, archived, pos', params
+        ).fetchall()
+        if not rows:
+            return []
+        # The same WHERE as a subquery rather than one bound ID per task,
+        # which a full load would push past SQLITE_MAX_VARIABLE_NUMBER.
+        selected = f'SELECT id FROM tasks WHERE {where}'
+        history = {}
+        for h in conn.execute(
+            f'SELECT * FROM history WHERE task_id IN ({selected}) ORDER BY task_id, id', params
+        ):
+            history.setdefault(h['task_id'], []).append(
+                {'status': h['status'], 'timestamp': h['timestamp'], 'action': h['action']}
+            )
+        notes = {}
+        for n in conn.execute(
+            f'SELECT * FROM notes WHERE task_id IN ({selected}) ORDER BY task_id, id', params
+        ):
+            notes.setdefault(n['task_id'], []).append(
+                {'text': n['text'], 'timestamp': n['timestamp'], 'author': n['author']}
+            )
+        tasks = []
+        for r in rows:
+            task = json.loads(r['extra'])
+            if r['uid'] is not None:
+                task['id'] = r['uid']
+            for col in TASK_COLUMNS:
+                if r[col] is not None or col == 'due_date':
+                    task[col] = r[col]
+            task['notes'] = notes.get(r['id'], [])
+            task['history'] = history.get(r['id'], [])
+            tasks.append((r['username'], r['archived'], task))
+        return tasks
+
+    def load(self):
+        conn = self._conn()
+        conn.execute('BEGIN')
+        try:
+            users = {}
+            for u in conn.execute('SELECT * FROM users ORDER BY rowid'):
+                udata = json.loads(u['extra'])
+                udata.update({
+                    'password': u['password'],
+                    'role': u['role'],
+                    'branches': json.loads(u['branches']),
+                    'tasks': [],
+                    'past_tasks': [],
+                })
+                users[u['username']] = udata
+            for username, archived, task in self._task_rows(conn, '1', ()):
+                users[username]['past_tasks' if archived else 'tasks'].append(task)
+        finally:
+            conn.execute('COMMIT')
+        return users
+
+    def get_user_tasks(self, username):
+        conn = self._conn()
+        return [t for _, _, t in self._task_rows(conn, 'username = ? AND archived = 0', (username,))]
+
+    def get_all_tasks(self, username):
+        conn = self._conn()
+        tasks = self._task_rows(conn, 'username = ?', (username,))
+        return [t for _, _, t in tasks]
+
+    # -- writes ------------------------------------------------------------
+
+    def _bump_version(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def _next_pos(self, conn, username, archived):
+        row = conn.execute(
+            'SELECT MAX(pos) FROM tasks WHERE username = ? AND archived = ?',
+            (username, archived),
+        ).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def _insert_task(self, conn, username, archived, task, pos=None):
+        if pos is None:
+            pos = self._next_pos(conn, username, archived)
+        extra = {k: v for k, v in task.items() if k not in ('id',) + TASK_COLUMNS + TASK_LISTS}
+        cur = conn.execute(
+            'INSERT INTO tasks (uid, username, archived, pos, description, priority, status,'
+            ' due_date, created_at, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (task.get('id'), username, archived, pos, *(task.get(c) for c in TASK_COLUMNS),
+             json.dumps(extra)),
+        )
+        task_id = cur.lastrowid
+        conn.executemany(
+            'INSERT INTO history (task_id, status, timestamp, action) VALUES (?, ?, ?, ?)',
+            [(task_id, h.get('status'), h.get('timestamp'), h.get('action'))
+             for h in task.get('history', [])],
+        )
+        conn.executemany(
+            'INSERT INTO notes (task_id, text, timestamp, author) VALUES (?, ?, ?, ?)',
+            [(task_id, n.get('text'), n.get('timestamp'), n.get('author'))
+             for n in task.get('notes', [])],
+        )
+        return task_id
+
+    def save(self, users):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for table in ('notes', 'history', 'tasks', 'users'):
+                conn.execute(f'DELETE FROM {table}')
+            for username, udata in users.items():
+                extra = {k: v for k, v in udata.items()
+                         if k not in USER_COLUMNS + ('tasks', 'past_tasks')}
+                conn.execute(
+                    'INSERT INTO users (username, password, role, branches, extra)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    (username, udata.get('password'), udata.get('role'),
+                     json.dumps(udata.get('branches', [])), json.dumps(extra)),
+                )
+                for archived, key in ((0, 'tasks'), (1, 'past_tasks')):
+                    for pos, task in enumerate(udata.get(key, [])):
+                        self._insert_task(conn, username, archived, task, pos)
+            self._bump_version(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _locate(self, conn, username, op):
+        if op.get('id') is not None:
+            return conn.execute(
+                'SELECT id, status FROM tasks WHERE uid = ? AND username = ? AND archived = 0',
+                (op['id'], username),
+            ).fetchone()
+        idx = op['index']
+        if idx < 0:
+            return None
+        return conn.execute(
+            'SELECT id, status FROM tasks WHERE username = ? AND archived = 0'
+            ' ORDER BY pos LIMIT 1 OFFSET ?',
+            (username, idx),
+        ).fetchone()
+
+    def _user_exists(self, conn, username):
+        return conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone()
+
+    def _apply_one(self, conn, op):
+        kind = op['op']
+        if kind == 'create':
+            if not self._user_exists(conn, op['user']):
+                return {'ok': False}
+            self._insert_task(conn, op['user'], 0, op['task'])
+            return {'ok': True, 'task': op['task']}
+        row = self._locate(conn, op['user'], op)
+        if row is None:
+            return {'ok': False}
+        task_id = row['id']
+        if kind == 'note':
+            note = op['note']
+            conn.execute(
+                'INSERT INTO notes (task_id, text, timestamp, author) VALUES (?, ?, ?, ?)',
+                (task_id, note.get('text'), note.get('timestamp'), note.get('author')),
+            )
+        elif kind == 'reassign':
+            new_user = op['to']
+            if not self._user_exists(conn, new_user):
+                return {'ok': False}
+            conn.execute(
+                'UPDATE tasks SET username = ?, pos = ? WHERE id = ?',
+                (new_user, self._next_pos(conn, new_user, 0), task_id),
+            )
+            conn.execute(
+                'INSERT INTO history (task_id, status, timestamp, action) VALUES (?, ?, ?, ?)',
+                (task_id, row['status'], op['timestamp'], f'reassigned_to_{new_user}'),
+            )
+        elif kind == 'status':
+            new_status = op['status']
+            conn.execute('UPDATE tasks SET status = ? WHERE id = ?', (new_status, task_id))
+            conn.execute(
+                'INSERT INTO history (task_id, status, timestamp, action) VALUES (?, ?, ?, ?)',
+                (task_id, new_status, op['timestamp'], 'status_change'),
+            )
+            if new_status == 'Done':
+                conn.execute(
+                    'UPDATE tasks SET archived = 1, pos = ? WHERE id = ?',
+                    (self._next_pos(conn, op['user'], 1), task_id),
+                )
+        else:
+            raise ValueError(f'Unknown operation {kind!r}')
+        task = self._task_rows(conn, 'id = ?', (task_id,))[0][2]
+        if kind == 'status':
+            return {'ok': True, 'task': task, 'previous': row['status']}
+        return {'ok': True, 'task': task}
+
+    def apply_versioned(self, ops, atomic=False):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            base = version = self.version()
+            results = [self._apply_one(conn, op) for op in ops]
+            if atomic and not all(r['ok'] for r in results):
+                conn.execute('ROLLBACK')
+                return rolled_back(results), base, base
+            if any(r['ok'] for r in results):
+                self._bump_version(conn)
+                version = base + 1
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return results, base, version
+
+
+def migrate_json_to_sqlite(json_path, db_path):
+    """Copy the contents of a ``users.json`` file into a SQLite store.
+
+    Returns the number of users migrated.  Existing rows are replaced.
+    """
+    users = JSONStorage(json_path).load()
+    SQLiteStorage(db_path).save(users)
+    return len(users)
@@ -0,0 +1,288 @@
+"""Compact in-memory tasks with pre-parsed dates.
+
+Stored tasks are dicts of strings: status and priority names, ISO-8601
+timestamps and due dates.  ``Task.from_dict`` converts one into a
+``__slots__`` object once, with status, priority and history action as
+small interned ints, timestamps as epoch microseconds and the due date as an
+epoch day, so code that groups by day or compares dates does not have to
+parse the same strings again on every call.
+
+The conversion is lossless: ``Task.from_dict(d).to_dict() == d``.  Keys the
+model does not know about are kept as they are, and so is any timestamp that
+would not format back to the exact same string (for example one with a UTC
+offset); its parsed value is still used for computations.
+"""
+from datetime import date, datetime, timedelta
+
+STATUSES = ('Incomplete', 'Doing', 'Done')
+PRIORITIES = ('High', 'Mid', 'Low')
+EPOCH = datetime(1970, 1, 1)
+EPOCH_DAY = date(1970, 1, 1).toordinal()
+DAY_US = 86400 * 10**6
+MICROSECOND = timedelta(microseconds=1)
+
+
+class _Interner:
+    """Map strings to small ints, seeded with the well-known values."""
+
+    def __init__(self, known=()):
+        self.codes = {}
+        self.values = []
+        for value in known:
+            self.code(value)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+statuses = _Interner(STATUSES)
+priorities = _Interner(PRIORITIES)
+actions = _Interner(('created', 'status_change'))
+DONE = statuses.code('Done')
+
+# Slot value for a key the original dict did not have.
+_ABSENT = object()
+
+
+def parse_timestamp(value):
+    """Return the wall-clock time of an ISO timestamp as epoch microseconds.
+
+    Any UTC offset is ignored, so the day is the one written in the string,
+    as ``datetime.fromisoformat(value).date()`` would give.
+    """
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.replace(tzinfo=None)
+    return (parsed - EPOCH) // MICROSECOND
+
+
+def format_timestamp(us):
+    return (EPOCH + timedelta(microseconds=us)).isoformat()
+
+
+def parse_day(value):
+    """Return an ISO date (or the date part of a timestamp) as an epoch day."""
+    try:
+        return date.fromisoformat(value).toordinal() - EPOCH_DAY
+    except ValueError:
+        return datetime.fromisoformat(value).date().toordinal() - EPOCH_DAY
+
+
+def format_day(day):
+    return date.fromordinal(day + EPOCH_DAY).isoformat()
+
+
+def timestamp_day(us):
+    return us // DAY_US
+
+
+def canonical_timestamp(value):
+    """Return True when ``value`` is exactly what ``format_timestamp`` writes.
+
+    That is ``datetime.isoformat()`` of a naive time: no UTC offset, and a
+    six-digit fraction only when it is not zero.  Checking the shape is much
+    cheaper than formatting the parsed value and comparing.
+    """
+    n = len(value)
+    if n == 26:
+        fraction = value[20:]
+        if value[19] != '.' or not fraction.isdigit() or fraction == '000000':
+            return False
+    elif n != 19:
+        return False
+    return (value[4] == value[7] == '-' and value[10] == 'T' and value[13] == value[16] == ':'
+            and value[11:13] != '24')
+
+
+def canonical_day(value):
+    """Return True when ``value`` is exactly what ``format_day`` writes."""
+    return len(value) == 10 and value[4] == value[7] == '-'
+
+
+def _compact(data, key, parse, fmt, canonical, extra):
+    """Return the parsed ``data[key]``, keeping the raw value in ``extra``
+    whenever formatting the parsed value would not give it back.
+
+    Values ``canonical`` accepts are known to format back unchanged, so only
+    the others are formatted and compared.
+    """
+    if key not in data:
+        return _ABSENT
+    value = data[key]
+    if value is None:
+        return None
+    try:
+        parsed = parse(value)
+    except (TypeError, ValueError):
+        extra[key] = value
+        return None
+    if not canonical(value) and fmt(parsed) != value:
+        extra[key] = value
+    return parsed
+
+
+def _code(interner, data, key):
+    return interner.code(data[key]) if key in data else _ABSENT
+
+
+def _name(interner, code):
+    return interner.values[code]
+
+
+_ENTRY_KEYS = ('status', 'timestamp', 'action')
+
+
+class HistoryEntry:
+    __slots__ = ('status', 'at', 'action', 'extra')
+
+    @classmethod
+    def from_dict(cls, data):
+        self = cls()
+        if len(data) == 3 and 'status' in data and 'timestamp' in data and 'action' in data:
+            extra = {}  # the usual shape; skips scanning for other keys
+        else:
+            extra = {k: v for k, v in data.items() if k not in _ENTRY_KEYS}
+        self.status = _code(statuses, data, 'status')
+        self.action = _code(actions, data, 'action')
+        self.at = _compact(data, 'timestamp', parse_timestamp, format_timestamp,
+                           canonical_timestamp, extra)
+        self.extra = extra or None
+        return self
+
+    def to_dict(self):
+        data = {}
+        if self.status is not _ABSENT:
+            data['status'] = _name(statuses, self.status)
+        if self.at is not _ABSENT:
+            data['timestamp'] = None if self.at is None else format_timestamp(self.at)
+        if self.action is not _ABSENT:
+            data['action'] = _name(actions, self.action)
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    @property
+    def day(self):
+        """Epoch day of the entry, or None when it has no usable timestamp."""
+        if self.at is None or self.at is _ABSENT:
+            return None
+        return timestamp_day(self.at)
+
+
+_TASK_KEYS = ('id', 'description', 'status', 'priority', 'due_date', 'created_at', 'history')
+
+
+class Task:
+    __slots__ = ('id', 'description', 'status', 'priority', 'due', 'created', 'history', 'extra')
+
+    @classmethod
+    def from_dict(cls, data):
+        self = cls()
+        extra = {k: v for k, v in data.items() if k not in _TASK_KEYS}
+        self.id = data.get('id', _ABSENT)
+        self.description = data.get('description', _ABSENT)
+        self.status = _code(statuses, data, 'status')
+        self.priority = _code(priorities, data, 'priority')
+        self.due = _compact(data, 'due_date', parse_day, format_day, canonical_day, extra)
+        self.created = _compact(data, 'created_at', parse_timestamp, format_timestamp,
+                                canonical_timestamp, extra)
+        if 'history' in data:
+            self.history = tuple(HistoryEntry.from_dict(h) for h in data['history'])
+        else:
+            self.history = _ABSENT
+        self.extra = extra or None
+        return self
+
+    def to_dict(self):
+        data = {}
+        if self.id is not _ABSENT:
+            data['id'] = self.id
+        if self.description is not _ABSENT:
+            data['description'] = self.description
+        if self.status is not _ABSENT:
+            data['status'] = _name(statuses, self.status)
+        if self.priority is not _ABSENT:
+            data['priority'] = _name(priorities, self.priority)
+        if self.due is not _ABSENT:
+            data['due_date'] = None if self.due is None else format_day(self.due)
+        if self.created is not _ABSENT:
+            data['created_at'] = None if self.created is None else format_timestamp(self.created)
+        if self.history is not _ABSENT:
+            data['history'] = [h.to_dict() for h in self.history]
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    @property
+    def done(self):
+        return self.status == DONE
+
+    @property
+    def created_day(self):
+        if self.created is None or self.created is _ABSENT:
+            return None
+        return timestamp_day(self.created)
+
+    @property
+    def due_day(self):
+        return None if self.due is _ABSENT else self.due
+
+    def completed_days(self):
+        """Yield the epoch day of every history entry that marked the task done."""
+        if self.history is _ABSENT:
+            return
+        for h in self.history:
+            if h.status == DONE and h.day is not None:
+                yield h.day
+
+
+# -- computations over compact tasks --------------------------------------
+
+def _completed_days(tasks):
+    # The inlined form of ``Task.completed_days`` over many tasks.
+    for t in tasks:
+        history = t.history
+        if history is _ABSENT:
+            continue
+        for h in history:
+            if h.status == DONE:
+                at = h.at
+                if at is not None and at is not _ABSENT:
+                    yield at // DAY_US
+
+
+def trend(tasks):
+    """Return ``app.build_trend``-shaped cumulative counts for ``Task`` objects."""
+    created = {}
+    done = {}
+    for t in tasks:
+        at = t.created
+        if at is not None and at is not _ABSENT:
+            day = at // DAY_US
+            created[day] = created.get(day, 0) + 1
+    for day in _completed_days(tasks):
+        done[day] = done.get(day, 0) + 1
+    series = []
+    cumulative_created = 0
+    cumulative_done = 0
+    for day in sorted(set(created) | set(done)):
+        cumulative_created += created.get(day, 0)
+        cumulative_done += done.get(day, 0)
+        series.append({'date': format_day(day), 'created': cumulative_created,
+                       'done': cumulative_done})
+    return series
+
+
+def weekly(tasks, days, today):
+    """Return ``app.weekly_completion``-shaped buckets ending on ``today``."""
+    first = today.toordinal() - EPOCH_DAY - days + 1
+    counts = [0] * days
+    for day in _completed_days(tasks):
+        offset = day - first
+        if 0 <= offset < days:
+            counts[offset] += 1
+    return {'labels': [format_day(first + i) for i in range(days)], 'data': counts}
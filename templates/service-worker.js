@@ -0,0 +1,267 @@
+// Rendered by app.service_worker; VERSION changes with the hashed assets, so
+// a new deploy installs a new worker and drops the caches of the old one.
+const VERSION = {{ version | tojson }};
+const ASSET_CACHE = `task-manager-assets-${VERSION}`;
+const PAGE_CACHE = `task-manager-pages-${VERSION}`;
+const PRECACHE = {{ precache | tojson }}.concat(['/static/manifest.json']);
+const BATCH_MAX_OPS = {{ batch_max_ops }};
+const PAGE_CACHE_ENTRIES = 50;
+const SYNC_TAG = 'replay-tasks';
+// Never cached: session changes, streams and per-request data.
+const PASS_THROUGH = ['/login', '/logout', '/events', '/metrics', '/calendar', '/files', '/uploads'];
+
+self.addEventListener('install', event => {
+  event.waitUntil(
+    caches.open(ASSET_CACHE).then(cache => cache.addAll(PRECACHE))
+  );
+  self.skipWaiting();
+});
+
+self.addEventListener('activate', event => {
+  event.waitUntil(
+    caches.keys().then(keys => Promise.all(
+      keys.filter(key => key !== ASSET_CACHE && key !== PAGE_CACHE)
+        .map(key => caches.delete(key))
+    )).then(replay)
+  );
+  self.clients.claim();
+});
+
+self.addEventListener('fetch', event => {
+  const request = event.request;
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) return;
+  if (url.pathname === '/login' || url.pathname === '/logout') {
+    // Cached pages belong to whoever was logged in.
+    event.waitUntil(caches.delete(PAGE_CACHE));
+    return;
+  }
+  if (request.method === 'POST' && (url.pathname === '/tasks' || url.pathname === '/tasks/batch')) {
+    event.respondWith(sendOrQueue(event, url));
+    return;
+  }
+  if (request.method !== 'GET' || PASS_THROUGH.some(p => url.pathname.startsWith(p))) return;
+  if (url.pathname.startsWith('/assets/') || PRECACHE.includes(url.pathname)) {
+    event.respondWith(cacheFirst(request));
+  } else if (request.mode === 'navigate' || url.pathname.startsWith('/api/')) {
+    event.respondWith(staleWhileRevalidate(event));
+  }
+});
+
+self.addEventListener('message', event => {
+  const data = event.data || {};
+  if (data.type === 'hello') {
+    event.waitUntil(setMeta('user', data.user || null).then(replay));
+  } else if (data.type === 'replay') {
+    event.waitUntil(replay());
+  }
+});
+
+self.addEventListener('sync', event => {
+  if (event.tag === SYNC_TAG) {
+    event.waitUntil(replay().then(pending => {
+      // Rejecting makes the browser retry the sync later.
+      if (pending) throw new Error(`${pending} task changes still queued`);
+    }));
+  }
+});
+
+// -- caching ---------------------------------------------------------------
+
+function offline() {
+  return new Response('Offline', { status: 503, headers: { 'Content-Type': 'text/plain' } });
+}
+
+function cacheFirst(request) {
+  // Hashed assets never change under the same URL.
+  return caches.open(ASSET_CACHE).then(cache => cache.match(request).then(cached =>
+    cached || fetch(request).then(response => {
+      if (response.ok) cache.put(request, response.clone());
+      return response;
+    })
+  )).catch(offline);
+}
+
+function trimPages(cache) {
+  return cache.keys().then(keys => Promise.all(
+    keys.slice(0, Math.max(0, keys.length - PAGE_CACHE_ENTRIES)).map(key => cache.delete(key))
+  ));
+}
+
+function staleWhileRevalidate(event) {
+  // Answer from the cache straight away and refresh it from the network, so
+  // the next visit sees this one's data; wait for the network on a miss.
+  const request = event.request;
+  const update = fetch(request).then(response => {
+    if (response.ok && response.type === 'basic') {
+      const copy = response.clone();
+      event.waitUntil(caches.open(PAGE_CACHE).then(cache =>
+        cache.delete(request).then(() => cache.put(request, copy)).then(() => trimPages(cache))
+      ));
+    }
+    return response;
+  });
+  event.waitUntil(update.catch(() => {}));
+  return caches.open(PAGE_CACHE)
+    .then(cache => cache.match(request))
+    .then(cached => cached || update)
+    .catch(offline);
+}
+
+// -- offline task changes --------------------------------------------------
+
+function newTaskId() {
+  return crypto.randomUUID().replace(/-/g, '');
+}
+
+async function batchItems(pathname, request) {
+  // Translate a task form post, or a /tasks/batch body, into batch operations.
+  // Creates get their ID here so a replay that is retried cannot add the
+  // task twice: the server refuses an ID that already exists.
+  if (pathname === '/tasks/batch') {
+    const body = await request.json().catch(() => ({}));
+    return (Array.isArray(body.ops) ? body.ops : []).map(op =>
+      op && op.op === 'create' && !op.id ? Object.assign({}, op, { id: newTaskId() }) : op);
+  }
+  const form = await request.formData().catch(() => new FormData());
+  const id = form.get('task_id');
+  if (form.get('task')) {
+    return [{
+      op: 'create', id: newTaskId(), description: form.get('task'),
+      priority: form.get('priority') || 'Mid', due_date: form.get('due_date') || null,
+      user: form.get('assignee') || undefined
+    }];
+  }
+  if (!id) return [];
+  if (form.has('note')) return [{ op: 'note', id, text: form.get('note') }];
+  if (form.has('reassign')) return [{ op: 'reassign', id, to: form.get('reassign') }];
+  if (form.has('status')) return [{ op: 'status', id, status: form.get('status') }];
+  return [];
+}
+
+function sendOrQueue(event, url) {
+  const request = event.request;
+  const body = request.clone();
+  return fetch(request).then(response => {
+    // The pages cached before this change no longer show the user's tasks.
+    event.waitUntil(caches.delete(PAGE_CACHE).then(replay));
+    return response;
+  }, async () => {
+    const items = await batchItems(url.pathname, body);
+    if (!items.length) return offline();
+    await enqueue(items);
+    if (self.registration.sync) {
+      self.registration.sync.register(SYNC_TAG).catch(() => {});
+    }
+    await notifyClients(0);
+    if (request.mode === 'navigate') {
+      return Response.redirect(new URL('/tasks', self.location.origin).href, 303);
+    }
+    return new Response(JSON.stringify({ ok: true, queued: items.length }), {
+      status: 202, headers: { 'Content-Type': 'application/json' }
+    });
+  });
+}
+
+let replaying = null;
+
+function replay() {
+  // One replay at a time; resolves to the number of changes still queued.
+  if (!replaying) {
+    replaying = flush().finally(() => { replaying = null; });
+  }
+  return replaying;
+}
+
+async function flush() {
+  const user = await getMeta('user');
+  let replayed = 0;
+  for (;;) {
+    const entries = (await readQueue())
+      .filter(entry => entry.user === null || entry.user === user)
+      .slice(0, BATCH_MAX_OPS);
+    if (!entries.length) break;
+    let response;
+    try {
+      response = await fetch('/tasks/batch', {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ ops: entries.map(entry => entry.item), atomic: false })
+      });
+    } catch (e) {
+      break;  // still offline
+    }
+    if (response.status === 401 || response.status >= 500) break;
+    // Every item was either applied or refused for good (for example a
+    // create whose ID exists because an earlier replay got through).
+    await removeQueued(entries.map(entry => entry.key));
+    await caches.delete(PAGE_CACHE);
+    replayed += entries.length;
+  }
+  return notifyClients(replayed);
+}
+
+async function notifyClients(replayed) {
+  const user = await getMeta('user');
+  const pending = (await readQueue())
+    .filter(entry => entry.user === null || entry.user === user).length;
+  const clients = await self.clients.matchAll({ type: 'window' });
+  clients.forEach(client => client.postMessage({ type: 'queue', pending, replayed }));
+  return pending;
+}
+
+// -- IndexedDB -------------------------------------------------------------
+
+function openDb() {
+  return new Promise((resolve, reject) => {
+    const open = indexedDB.open('task-manager', 1);
+    open.onupgradeneeded = () => {
+      open.result.createObjectStore('queue', { autoIncrement: true });
+      open.result.createObjectStore('meta');
+    };
+    open.onsuccess = () => resolve(open.result);
+    open.onerror = () => reject(open.error);
+  });
+}
+
+function transact(store, mode, work) {
+  // Run work(objectStore) in a transaction; resolves with the value of the
+  // function work returns, read once the transaction has completed.
+  return openDb().then(db => new Promise((resolve, reject) => {
+    const tx = db.transaction(store, mode);
+    const result = work(tx.objectStore(store));
+    tx.oncomplete = () => resolve(result ? result() : undefined);
+    tx.onerror = () => reject(tx.error);
+  }));
+}
+
+function getMeta(key) {
+  return transact('meta', 'readonly', store => {
+    const request = store.get(key);
+    return () => (request.result === undefined ? null : request.result);
+  });
+}
+
+function setMeta(key, value) {
+  return transact('meta', 'readwrite', store => { store.put(value, key); });
+}
+
+async function enqueue(items) {
+  const user = await getMeta('user');
+  return transact('queue', 'readwrite', store => {
+    items.forEach(item => store.add({ user, item }));
+  });
+}
+
+function readQueue() {
+  return transact('queue', 'readonly', store => {
+    const values = store.getAll();
+    const keys = store.getAllKeys();
+    return () => keys.result.map((key, i) => Object.assign({ key }, values.result[i]));
+  });
+}
+
+function removeQueued(keys) {
+  return transact('queue', 'readwrite', store => { keys.forEach(key => store.delete(key)); });
+}
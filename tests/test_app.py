@@ -1,10 +1,12 @@
 import json
 import io
+import re
+import shutil
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 import pytest
-from app import app, load_users
+from app import app, load_users, users_cache_stats
 
 @pytest.fixture
 def client(tmp_path, monkeypatch):
@@ -40,6 +42,8 @@ def client(tmp_path, monkeypatch):
     monkeypatch.setattr('app.DATA_PATH', data_file)
     monkeypatch.setattr('app.CHAT_PATH', messages_file)
     monkeypatch.setattr('app.UPLOAD_FOLDER', upload_dir)
+    monkeypatch.setattr('app.BLOB_PATH', tmp_path / 'blobs')
+    monkeypatch.setattr('app.ASSET_PATH', tmp_path / 'assets')
     with app.test_client() as client:
         client.upload_dir = upload_dir
         yield client
@@ -155,8 +159,9 @@ def test_chat_visibility_and_attachments(client):
     resp = client.get('/chat/messages')
     msgs = resp.get_json()['messages']
     assert any(m['text'] == '@owner secret' for m in msgs)
-    attachment_path = client.upload_dir / 'note.txt'
-    assert attachment_path.exists()
+    attachment = next(m for m in msgs if m['text'] == '@owner secret')['attachments'][0]
+    assert attachment['name'] == 'note.txt'
+    assert client.get(f"/files/{attachment['hash']}").data == b'hello'
     client.get('/logout')
 
     client.post('/login', data={'username': 'other', 'password': 'secret'}, follow_redirects=True)
@@ -190,3 +195,692 @@ def test_dashboard_and_calendar(client):
     assert b'BEGIN:VCALENDAR' in resp.data
     assert b'Task1' in resp.data
 
+
+
+def test_user_cache_parses_once_per_request(client):
+    client.post('/login', data={'username': 'owner', 'password': 'secret'}, follow_redirects=True)
+    load_users()
+    before = users_cache_stats()
+    client.get('/graph')
+    client.get('/dashboard')
+    after = users_cache_stats()
+    assert after['misses'] == before['misses']
+    assert after['hits'] > before['hits']
+
+    client.post('/tasks', data={'task': 'Fresh', 'priority': 'Low'})
+    assert users_cache_stats()['misses'] == after['misses'] + 1
+    users = load_users()
+    assert users['owner']['tasks'][0]['description'] == 'Fresh'
+    with pytest.raises(TypeError):
+        users['owner']['tasks'].append({})
+
+
+def test_chat_messages_since_cursor(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    ids = []
+    for i in range(5):
+        resp = client.post('/chat/messages', data={'message': f'msg {i}'})
+        ids.append(resp.get_json()['id'])
+    assert ids == sorted(ids)
+    client.post('/chat/messages', data={'message': '@owner private'})
+
+    data = client.get(f'/chat/messages?since={ids[1]}&limit=2').get_json()
+    assert [m['text'] for m in data['messages']] == ['msg 2', 'msg 3']
+    assert data['more']
+    data = client.get(f"/chat/messages?since={data['cursor']}").get_json()
+    assert [m['text'] for m in data['messages']] == ['msg 4', '@owner private']
+    assert not data['more']
+    client.get('/logout')
+
+    client.post('/login', data={'username': 'other', 'password': 'secret'}, follow_redirects=True)
+    data = client.get(f'/chat/messages?since={ids[-1]}').get_json()
+    assert data['messages'] == []
+    assert data['cursor'] == ids[-1] + 1
+
+
+def test_events_stream_chat_messages(client, monkeypatch):
+    assert client.get('/events').status_code == 401
+    monkeypatch.setattr('app.EVENTS_HEARTBEAT', 0.01)
+    client.post('/login', data={'username': 'other', 'password': 'secret'}, follow_redirects=True)
+    resp = client.get('/events', buffered=False)
+    assert resp.mimetype == 'text/event-stream'
+    stream = iter(resp.response)
+    assert next(stream).startswith(b'retry:')
+
+    with app.test_client() as sender:
+        sender.post('/login', data={'username': 'worker', 'password': 'secret'})
+        sender.post('/chat/messages', data={'message': '@owner hidden'})
+        sender.post('/chat/messages', data={'message': 'everyone'})
+    chunk = next(stream)
+    while chunk.startswith(b':'):
+        chunk = next(stream)
+    assert b'everyone' in chunk
+    resp.close()
+
+
+def test_chat_branch_tags_reach_branch_members(client):
+    client.post('/login', data={'username': 'owner', 'password': 'secret'}, follow_redirects=True)
+    client.post('/chat/messages', data={'message': '@Mzone stand-up'})
+    client.get('/logout')
+    for username, sees in (('worker', True), ('other', False)):
+        client.post('/login', data={'username': username, 'password': 'secret'}, follow_redirects=True)
+        msgs = client.get('/chat/messages').get_json()['messages']
+        assert any(m['text'] == '@Mzone stand-up' for m in msgs) is sees
+        client.get('/logout')
+
+
+def test_user_stats_follow_writes_and_verify(client):
+    from app import UserStats, get_user_performance, progress_today, sync_view, user_stats
+    client.post('/login', data={'username': 'owner', 'password': 'secret'}, follow_redirects=True)
+    assert get_user_performance('worker')['total'] == 0
+    synced = user_stats.version
+
+    client.post('/tasks', data={'task': 'A', 'priority': 'High', 'assignee': 'worker'})
+    client.post('/tasks', data={'task': 'B', 'priority': 'Low', 'assignee': 'worker'})
+    client.post('/tasks', data={'task_index': '0', 'status': 'Done', 'user': 'worker'})
+    client.post('/tasks', data={'task_index': '0', 'user': 'worker', 'reassign': 'other'})
+    # Updated in place rather than rebuilt from the snapshot.
+    assert user_stats.version != synced
+    assert sync_view(user_stats).users['worker']['total'] == 1
+
+    perf = get_user_performance('worker')
+    assert (perf['total'], perf['done'], perf['priority']['High']) == (1, 1, 1)
+    assert get_user_performance('other')['priority']['Low'] == 1
+    assert progress_today('worker') == {'total': 1, 'done': 0}
+    assert progress_today('other') == {'total': 1, 'done': 0}
+
+    fresh = UserStats()
+    fresh.rebuild(load_users())
+    assert fresh.diff(user_stats) == []
+    result = app.test_cli_runner().invoke(args=['rebuild-stats'])
+    assert result.exit_code == 0
+    assert 'verified for 3 users' in result.output
+
+
+def test_tasks_have_stable_ids(client):
+    from app import DATA_PATH, locate_task
+    data = json.loads(DATA_PATH.read_text())
+    data['worker']['tasks'].append({'description': 'Legacy', 'priority': 'Mid', 'status': 'Incomplete'})
+    DATA_PATH.write_text(json.dumps(data))
+
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    client.post('/tasks', data={'task': 'Second', 'priority': 'High'})
+    legacy, second = load_users()['worker']['tasks']
+    assert legacy['id'] and second['id'] and legacy['id'] != second['id']
+    assert json.loads(DATA_PATH.read_text())['worker']['tasks'][0]['id'] == legacy['id']
+
+    resp = client.get('/tasks/worker/1')
+    assert resp.headers['Location'].endswith(f"/tasks/{second['id']}")
+    resp = client.get(f"/tasks/{second['id']}")
+    assert b'Second' in resp.data
+
+    # Completing the first task no longer shifts what the ID refers to.
+    client.post('/tasks', data={'task_id': legacy['id'], 'status': 'Done'})
+    client.post('/tasks', data={'task_id': second['id'], 'note': 'still me'})
+    assert load_users()['worker']['tasks'][0]['notes'][0]['text'] == 'still me'
+    assert locate_task(legacy['id'])[:2] == ('worker', 'past_tasks')
+    assert locate_task(second['id'])[:2] == ('worker', 'tasks')
+
+
+def test_task_api_pages_and_filters(client, monkeypatch):
+    assert client.get('/api/tasks').status_code == 401
+    client.post('/login', data={'username': 'owner', 'password': 'secret'}, follow_redirects=True)
+    for i in range(5):
+        client.post('/tasks', data={'task': f'W{i}', 'priority': 'High' if i % 2 else 'Low',
+                                    'assignee': 'worker'})
+    client.post('/tasks', data={'task': 'Mine', 'priority': 'Mid', 'assignee': 'owner'})
+
+    seen = []
+    after = ''
+    while True:
+        data = client.get(f'/api/tasks?user=worker&limit=2&after={after}').get_json()
+        seen += [t['description'] for t in data['tasks']]
+        if not data['next']:
+            break
+        after = data['next']
+    assert seen == [f'W{i}' for i in range(5)]
+
+    # A key whose task the other views do not know yet (written by another
+    # process between the syncs) is skipped.
+    from app import created_order
+    from bisect import insort
+    insort(created_order.active['worker'], ('0000', 'f' * 32))
+    data = client.get('/api/tasks?user=worker').get_json()
+    assert [t['description'] for t in data['tasks']] == [f'W{i}' for i in range(5)]
+
+    data = client.get('/api/tasks?priority=High').get_json()
+    assert [t['description'] for t in data['tasks']] == ['W1', 'W3']
+    data = client.get('/api/tasks?branch=UNIPRO').get_json()
+    assert [t['description'] for t in data['tasks']] == ['Mine']
+    assert client.get('/api/tasks?after=bogus').status_code == 400
+
+    done_id = data['tasks'][0]['id']
+    client.post('/tasks', data={'task_id': done_id, 'status': 'Done'})
+    past = client.get('/api/tasks?user=owner&past=1').get_json()['tasks']
+    assert [t['description'] for t in past] == ['Mine']
+    assert 'history' not in past[0]
+    client.get('/logout')
+
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    data = client.get('/api/tasks?user=owner&past=1').get_json()
+    assert data['tasks'] == []
+
+
+def test_manager_view_defers_sections(client, monkeypatch):
+    monkeypatch.setattr('app.MANAGER_EAGER_SECTIONS', 1)
+    monkeypatch.setattr('app.MANAGER_PAGE_SIZE', 1)
+    client.post('/login', data={'username': 'owner', 'password': 'secret'}, follow_redirects=True)
+    client.post('/tasks', data={'task': 'Own1', 'assignee': 'owner'})
+    client.post('/tasks', data={'task': 'Own2', 'assignee': 'owner'})
+    client.post('/tasks', data={'task': 'Theirs', 'assignee': 'worker'})
+    resp = client.get('/tasks')
+    assert b'Own1' in resp.data
+    assert b'Own2' not in resp.data
+    assert b'Theirs' not in resp.data
+    assert b'data-loaded="false"' in resp.data
+    resp = client.get('/tasks?branch=Other')
+    assert b"Other's Tasks" in resp.data
+    assert b"Worker's Tasks" not in resp.data
+
+
+def test_calendar_feed_validators_and_token(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    long_name = 'Call back, re; budget \\ ' + 'x' * 80
+    client.post('/tasks', data={'task': long_name, 'due_date': '2030-01-01'})
+    resp = client.get('/calendar.ics')
+    body = resp.get_data(as_text=True)
+    assert all(len(line.encode()) <= 75 for line in body.split('\r\n'))
+    assert 'SUMMARY:Call back\\, re\\; budget \\\\ ' in body
+    assert 'DTEND;VALUE=DATE:20300102' in body
+    task_id = load_users()['worker']['tasks'][0]['id']
+    assert f'UID:{task_id}@' in body
+
+    etag = resp.headers['ETag']
+    assert client.get('/calendar.ics', headers={'If-None-Match': etag}).status_code == 304
+    client.post('/tasks', data={'task': 'Later', 'due_date': '2030-02-01'})
+    assert client.get('/calendar.ics', headers={'If-None-Match': etag}).status_code == 200
+
+    feed_url = client.get('/dashboard').get_data(as_text=True).split('value="')[1].split('"')[0]
+    client.get('/logout')
+    resp = client.get(feed_url.replace('http://localhost', ''))
+    assert resp.status_code == 200
+    assert 'Later' in resp.get_data(as_text=True)
+    assert client.get('/calendar/forged.ics').status_code == 404
+
+
+def test_calendar_feed_skips_bad_dates_and_shares_etags(client):
+    import app as app_module
+    from indexes import FeedVersions
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    client.post('/tasks', data={'task': 'Good', 'due_date': '2030-01-01'})
+    users = app_module.thaw(load_users())
+    users['worker']['tasks'].append({'id': 'bad', 'description': 'Bad', 'due_date': 'soon',
+                                     'priority': 'Mid', 'status': 'Incomplete', 'history': []})
+    app_module.save_users(users)
+    resp = client.get('/calendar.ics')
+    body = resp.get_data(as_text=True)
+    assert resp.status_code == 200 and 'SUMMARY:Good' in body and 'Bad' not in body
+    # Another worker restores the persisted view and issues the same ETag.
+    other = app_module.sync_view(FeedVersions())
+    assert other.etag('worker') == app_module.feed_versions.etag('worker')
+
+
+def test_profiling_metrics_and_slow_dumps(client, monkeypatch, tmp_path):
+    import pstats
+    assert client.get('/metrics').status_code == 404
+    monkeypatch.setattr('app.PROFILING', True)
+    monkeypatch.setattr('app.PROFILE_SAMPLE_RATE', 1.0)
+    monkeypatch.setattr('app.PROFILE_SLOW_SECONDS', 0.0)
+    monkeypatch.setattr('app.PROFILE_DIR', tmp_path / 'profiles')
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    client.post('/tasks', data={'task': 'Measured', 'priority': 'High'})
+    client.get('/dashboard')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'taskmanager_request_duration_seconds_count{route="/dashboard"} 1' in text
+    assert 'taskmanager_phase_duration_seconds_bucket{route="/dashboard",phase="render",le="+Inf"} 1' in text
+    assert 'taskmanager_users_cache_hits_total' in text
+
+    def value(series):
+        return float(next(line for line in text.splitlines() if line.startswith(series + ' ')).split()[-1])
+
+    assert value('taskmanager_phase_duration_seconds_sum{route="/tasks",phase="save"}') > 0
+    assert value('taskmanager_request_bytes_written_sum{route="/tasks"}') > 0
+    assert value('taskmanager_request_load_users_calls_sum{route="/tasks"}') >= 1
+    dumps = list((tmp_path / 'profiles').glob('*-dashboard-*.prof'))
+    assert dumps and pstats.Stats(str(dumps[0])).total_calls > 0
+
+
+def test_profiler_runs_one_cprofile_at_a_time():
+    import threading
+    from profiling import Profiler
+    profiler = Profiler(sample_rate=1.0, slow_seconds=60)
+    profiler.start()
+    other = []
+    thread = threading.Thread(target=lambda: (profiler.start(), other.append(profiler.finish('/b'))))
+    thread.start()
+    thread.join()
+    assert other[0].profile is None
+    assert profiler.finish('/a').profile is not None
+
+
+def test_blob_uploads_dedup_resume_and_ranges(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    first = client.post('/files?name=a.txt', data=b'same bytes').get_json()
+    second = client.post('/chat/messages', data={
+        'message': 'again', 'file': (io.BytesIO(b'same bytes'), 'b.txt')},
+        content_type='multipart/form-data')
+    assert second.status_code == 200
+    blobs = [p for p in (client.upload_dir.parent / 'blobs').glob('??/*')]
+    assert [p.name for p in blobs] == [first['hash']]
+
+    payload = bytes(range(256)) * 40
+    upload = client.post('/uploads', json={'name': 'big.bin', 'size': len(payload)}).get_json()
+    url = f"/uploads/{upload['id']}"
+    resp = client.patch(url, data=payload[:4000], headers={'Upload-Offset': '0'})
+    assert resp.get_json() == {'offset': 4000}
+    resp = client.patch(url, data=payload[4000:], headers={'Upload-Offset': '0'})
+    assert resp.status_code == 409 and resp.get_json()['offset'] == 4000
+    assert client.get(url).get_json() == {'offset': 4000, 'size': len(payload)}
+    done = client.patch(url, data=payload[4000:], headers={'Upload-Offset': '4000'}).get_json()
+    attachment = done['attachment']
+    assert attachment['size'] == len(payload)
+    resp = client.post('/chat/messages', data={'message': '', 'attachment': json.dumps(attachment)})
+    assert resp.status_code == 200
+
+    resp = client.get(f"/files/{attachment['hash']}", headers={'Range': 'bytes=10-19'})
+    assert resp.status_code == 206 and resp.data == payload[10:20]
+    assert 'immutable' in resp.headers['Cache-Control']
+    resp = client.get(f"/files/{attachment['hash']}", headers={'If-None-Match': f'"{attachment["hash"]}"'})
+    assert resp.status_code == 304
+    assert client.post('/uploads', json={'name': 'huge', 'size': 10 ** 12}).status_code == 413
+
+
+def test_downloads_take_their_type_from_the_content(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    svg = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+    digest = client.post('/files?name=x.svg', data=svg).get_json()['hash']
+    for name in ('x.svg', 'x.png'):
+        resp = client.get(f'/files/{digest}?name={name}')
+        assert resp.headers['Content-Disposition'].startswith('attachment')
+        assert not resp.mimetype.startswith('image/')
+        assert resp.headers['Content-Security-Policy'] == 'sandbox'
+        assert resp.headers['X-Content-Type-Options'] == 'nosniff'
+    digest = client.post('/files?name=p.png', data=tiny_png(2, 2)).get_json()['hash']
+    resp = client.get(f'/files/{digest}?name=p.html')
+    assert resp.mimetype == 'image/png'
+    assert resp.headers['Content-Disposition'].startswith('inline')
+
+
+def test_abandoned_uploads_expire(client):
+    import time
+    from app import get_blob_store
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    upload_id = client.post('/uploads', json={'name': 'a.bin', 'size': 10}).get_json()['id']
+    client.patch(f'/uploads/{upload_id}', data=b'12345', headers={'Upload-Offset': '0'})
+    store = get_blob_store()
+    assert store.expire_uploads(now=time.time()) == 0
+    assert store.expire_uploads(now=time.time() + store.upload_ttl + 1) == 1
+    assert client.get(f'/uploads/{upload_id}').status_code == 404
+
+
+def test_slow_upload_does_not_block_other_uploads(client, monkeypatch):
+    import threading
+    import time
+    from app import get_blob_store
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    slow_id = client.post('/uploads', json={'name': 'slow', 'size': 10}).get_json()['id']
+    fast_id = client.post('/uploads', json={'name': 'fast', 'size': 4}).get_json()['id']
+    store = get_blob_store()
+    release = threading.Event()
+
+    class SlowClient:
+        def __init__(self):
+            self.sent = False
+
+        def read(self, size):
+            if self.sent:
+                return b''
+            release.wait(5)
+            self.sent = True
+            return b'0123456789'
+
+    slow = threading.Thread(target=store.append, args=(slow_id, 0, SlowClient()))
+    slow.start()
+    try:
+        resp = client.patch(f'/uploads/{fast_id}', data=b'fast', headers={'Upload-Offset': '0'})
+        assert 'attachment' in resp.get_json()
+        assert store.expire_uploads(now=time.time()) == 0
+        assert slow.is_alive()
+    finally:
+        release.set()
+        slow.join(5)
+    assert client.get(f'/uploads/{slow_id}').status_code == 404
+
+    resp = client.post('/files', data=b'x' * 100)
+    assert resp.status_code == 201
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 50)
+    assert client.post('/files', data=b'x' * 100).status_code == 413
+
+
+def tiny_png(width, height):
+    import struct
+    import zlib
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\x00' + b'\x00\x00\x00' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def test_attachment_metadata_computed_in_background(client):
+    from app import attachment_jobs, event_bus
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    sub = event_bus.subscribe('worker')
+    try:
+        resp = client.post('/chat/messages', data={
+            'message': 'photo', 'file': (io.BytesIO(tiny_png(400, 300)), 'photo.bin')},
+            content_type='multipart/form-data')
+        assert resp.status_code == 200
+        attachment_jobs.join()
+        kinds = []
+        while not sub.queue.empty():
+            kinds.append(sub.queue.get_nowait())
+    finally:
+        event_bus.unsubscribe(sub)
+    event = next(data for kind, data in kinds if kind == 'attachment')
+    assert (event['width'], event['height']) == (400, 300)
+    msg = client.get('/chat/messages').get_json()['messages'][-1]
+    attachment = msg['attachments'][0]
+    assert attachment['type'] == 'image/png'
+    assert (attachment['width'], attachment['height']) == (400, 300)
+    assert 'variants' in attachment
+    assert attachment_jobs.stats()['completed'] >= 1
+
+
+def test_no_thumbnails_above_the_pixel_cap():
+    pytest.importorskip('PIL')
+    import media
+    assert list(media.thumbnails(io.BytesIO(tiny_png(400, 300))))
+    assert not list(media.thumbnails(io.BytesIO(tiny_png(400, 300)), max_pixels=400 * 299))
+
+
+def test_attachment_thumbnails_with_pillow(client):
+    pytest.importorskip('PIL')
+    from app import attachment_jobs
+    client.post('/login', data={'username': 'worker', 'password': 'secret'}, follow_redirects=True)
+    client.post('/chat/messages', data={
+        'message': 'big', 'file': (io.BytesIO(tiny_png(1200, 600)), 'big.png')},
+        content_type='multipart/form-data')
+    attachment_jobs.join()
+    attachment = client.get('/chat/messages').get_json()['messages'][-1]['attachments'][0]
+    assert [(v['width'], v['height']) for v in attachment['variants']] == [(320, 160), (960, 480)]
+    assert client.get(f"/files/{attachment['variants'][0]['hash']}").status_code == 200
+
+
+def test_batch_operations_apply_atomically(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    task_id = 'a' * 32
+    resp = client.post('/tasks/batch', json={'ops': [
+        {'op': 'create', 'description': 'Batched', 'id': task_id},
+        {'op': 'note', 'id': task_id, 'text': 'first note'},
+        {'op': 'status', 'id': task_id, 'status': 'Doing'},
+    ]})
+    assert resp.status_code == 200
+    results = resp.get_json()['results']
+    assert [r['ok'] for r in results] == [True, True, True]
+    assert results[-1]['task']['status'] == 'Doing'
+    task = load_users()['worker']['tasks'][0]
+    assert (task['id'], task['notes'][0]['text'], task['status']) == (task_id, 'first note', 'Doing')
+
+    # One invalid operation rejects the whole batch.
+    resp = client.post('/tasks/batch', json={'ops': [
+        {'op': 'status', 'id': task_id, 'status': 'Done'},
+        {'op': 'reassign', 'id': task_id, 'to': 'owner'},
+    ]})
+    assert resp.status_code == 400
+    assert resp.get_json()['results'] == [
+        {'ok': False, 'rolled_back': True},
+        {'ok': False, 'error': 'not allowed to reassign tasks'},
+    ]
+    assert load_users()['worker']['tasks'][0]['status'] == 'Doing'
+
+    resp = client.post('/tasks/batch', json={'atomic': False, 'ops': [
+        {'op': 'status', 'id': task_id, 'status': 'Done'},
+        {'op': 'create', 'description': 'Not mine', 'user': 'owner'},
+    ]})
+    assert resp.status_code == 200
+    assert [r['ok'] for r in resp.get_json()['results']] == [True, False]
+    assert load_users()['worker']['past_tasks'][0]['id'] == task_id
+    assert client.post('/tasks/batch', json={'ops': []}).status_code == 400
+
+    for due in (['x'], 'soon', 12345, '01/02/2030', '2030-02-30', '20300101'):
+        resp = client.post('/tasks/batch', json={'ops': [
+            {'op': 'create', 'description': 'Dated', 'due_date': due}]})
+        assert resp.status_code == 400, due
+    resp = client.post('/tasks/batch', json={'ops': [
+        {'op': 'create', 'description': 'Dated', 'due_date': '2030-02-28'}]})
+    assert resp.get_json()['results'][0]['task']['due_date'] == '2030-02-28'
+    assert client.get('/calendar.ics').status_code == 200
+
+
+def test_csv_import_creates_tasks_for_branch(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    csv_data = b'description,priority,due_date,assignee\nStocktake,High,2030-01-01,\n'
+    resp = client.post('/tasks/import', data={'branch': 'Mzone', 'file': (io.BytesIO(csv_data), 't.csv')})
+    assert resp.status_code == 403
+
+    client.post('/login', data={'username': 'owner', 'password': 'secret'})
+    csv_data += b'Clean up,,,worker\n'
+    resp = client.post('/tasks/import', data={'branch': 'Mzone', 'file': (io.BytesIO(csv_data), 't.csv')})
+    assert resp.status_code == 200
+    assert len(resp.get_json()['results']) == 3
+    users = load_users()
+    assert [t['description'] for t in users['owner']['tasks']] == ['Stocktake']
+    assert [t['description'] for t in users['worker']['tasks']] == ['Stocktake', 'Clean up']
+    assert users['worker']['tasks'][0]['priority'] == 'High'
+    assert users['worker']['tasks'][0]['due_date'] == '2030-01-01'
+
+    for bad in (b'description,assignee\nFine,worker\nBroken,nobody\n',
+                b'description,assignee\nFine,worker\nElsewhere,other\n',
+                b'description,due_date\nFine,2030-01-01\nSoon,soon\n'):
+        resp = client.post('/tasks/import', data={'branch': 'Mzone', 'file': (io.BytesIO(bad), 't.csv')})
+        assert resp.status_code == 400
+    assert len(load_users()['worker']['tasks']) == 2
+    assert load_users()['other']['tasks'] == []
+
+
+def test_search_respects_visibility_and_pages(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    client.post('/tasks', data={'task': 'Inventory count', 'priority': 'High'})
+    client.post('/chat/messages', data={'message': 'inventory is due friday'})
+    client.post('/login', data={'username': 'owner', 'password': 'secret'})
+    client.post('/tasks', data={'task': 'Inventory audit', 'priority': 'Low', 'assignee': 'owner'})
+    client.post('/chat/messages', data={'message': '@owner private inventory note'})
+
+    data = client.get('/api/search?q=invent').get_json()
+    assert sorted(r['type'] for r in data['results']) == ['message', 'message', 'task', 'task']
+    assert data['next'] is None
+
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    data = client.get('/api/search?q=inventory').get_json()
+    assert sorted(r['type'] for r in data['results']) == ['message', 'task']
+    assert data['results'][[r['type'] for r in data['results']].index('task')]['task']['user'] == 'worker'
+
+    task_id = load_users()['worker']['tasks'][0]['id']
+    client.post('/tasks', data={'task_id': task_id, 'note': 'counted the shelves'})
+    data = client.get('/api/search?q=shelves&type=tasks').get_json()
+    assert [r['task']['id'] for r in data['results']] == [task_id]
+
+    first = client.get('/api/search?q=inventory&limit=1').get_json()
+    assert len(first['results']) == 1 and first['next'] == 1
+    second = client.get('/api/search?q=inventory&limit=1&offset=1').get_json()
+    assert second['next'] is None and second['results'] != first['results']
+
+    resp = client.get('/search?q=shelves')
+    assert b'Inventory count' in resp.data
+    assert client.get('/api/search?q=').get_json()['results'] == []
+
+
+def test_pages_cached_with_etags_until_tasks_change(client, monkeypatch):
+    from app import render_cache
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    for route in ('/tasks', '/dashboard', '/graph'):
+        first = client.get(route)
+        assert first.status_code == 200 and first.headers['ETag']
+        hits = render_cache.stats()['hits']
+        second = client.get(route)
+        assert second.data == first.data
+        assert render_cache.stats()['hits'] == hits + 1
+        resp = client.get(route, headers={'If-None-Match': first.headers['ETag']})
+        assert resp.status_code == 304 and not resp.data
+
+    etags = {route: client.get(route).headers['ETag'] for route in ('/tasks', '/dashboard', '/graph')}
+    client.post('/tasks', data={'task': 'Fresh task'})
+    for route, etag in etags.items():
+        resp = client.get(route, headers={'If-None-Match': etag})
+        assert resp.status_code == 200, route
+    assert b'Fresh task' in client.get('/tasks').data
+
+    # Another user's write changes the shared graph but not this dashboard.
+    etags = {route: client.get(route).headers['ETag'] for route in ('/dashboard', '/graph')}
+    client.post('/login', data={'username': 'other', 'password': 'secret'})
+    client.post('/tasks', data={'task': 'Elsewhere'})
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    assert client.get('/dashboard', headers={'If-None-Match': etags['/dashboard']}).status_code == 304
+    misses = render_cache.stats()['misses']
+    assert client.get('/graph', headers={'If-None-Match': etags['/graph']}).status_code == 200
+    # The page and the changed user's card are rendered; the other cards are reused.
+    assert render_cache.stats()['misses'] == misses + 2
+
+    monkeypatch.setattr('app.PROFILING', True)
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'taskmanager_render_cache_hits_total' in text
+    assert 'taskmanager_render_cache_evictions_total' in text
+
+
+def test_tiered_store_loads_archives_only_when_needed(client, monkeypatch, tmp_path):
+    import app as app_module
+    monkeypatch.setattr('app.STORAGE_BACKEND', 'tiered')
+    monkeypatch.setattr('app.ARCHIVE_PATH', tmp_path / 'archive')
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    client.post('/tasks', data={'task': 'Ship it', 'priority': 'High'})
+    task_id = load_users()['worker']['tasks'][0]['id']
+    client.post('/tasks', data={'task_id': task_id, 'status': 'Done'})
+
+    users = load_users()
+    assert 'past_tasks' not in users['worker'] and users['worker']['archive']['count'] == 1
+    assert (tmp_path / 'archive' / 'worker.jsonl.gz').exists()
+    loads = app_module.get_storage()._archives
+    loads.clear()
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    client.post('/chat/messages', data={'message': 'no archive needed'})
+    assert not loads
+
+    # Views that show old detail read the archive.
+    assert b'Ship it' in client.get('/tasks').data
+    assert client.get(f'/tasks/{task_id}').status_code == 200
+    data = client.get('/api/tasks?past=1').get_json()
+    assert [t['id'] for t in data['tasks']] == [task_id]
+    assert app_module.get_user_performance('worker')['done'] == 1
+    assert 'worker' in loads
+
+    # A worker's task page reads their own archive only.
+    client.post('/login', data={'username': 'other', 'password': 'secret'})
+    client.post('/tasks', data={'task': 'Theirs'})
+    other_id = load_users()['other']['tasks'][0]['id']
+    client.post('/tasks', data={'task_id': other_id, 'status': 'Done'})
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    loads.clear()
+    client.post('/tasks', data={'task': 'Next'})
+    assert b'Ship it' in client.get('/tasks').data
+    assert list(loads) == ['worker']
+
+    # After a restart a task is found from the archive summaries, and a
+    # completed one is read from its owner's archive only.
+    for view in app_module.VIEWS:
+        view.version = None
+    loads.clear()
+    assert client.get(f'/tasks/{task_id}').status_code == 200
+    assert list(loads) == ['worker']
+    assert app_module.locate_task(other_id)[:2] == ('other', 'past_tasks')
+    assert app_module.task_ids.restore(app_module.view_path(app_module.task_ids),
+                                       app_module.get_storage().version())
+
+    result = app.test_cli_runner().invoke(args=['archive-tasks'])
+    assert 'Archived 0 completed tasks' in result.output
+
+
+def test_trend_and_weekly_from_compact_tasks(client, monkeypatch):
+    from taskmodel import Task
+    from app import build_trend, get_compact_tasks, weekly_completion
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    client.post('/tasks', data={'task': 'Compact', 'priority': 'Low'})
+    task_id = load_users()['worker']['tasks'][0]['id']
+    client.post('/tasks', data={'task_id': task_id, 'status': 'Done'})
+    tasks = get_compact_tasks('worker')
+    assert [t.to_dict() for t in tasks] == load_users()['worker']['past_tasks']
+    trend = build_trend(tasks)
+    assert (trend[-1]['created'], trend[-1]['done']) == (1, 1)
+    assert weekly_completion(tasks)['data'][-1] == 1
+    assert f'"date": "{trend[-1]["date"]}"'.encode() in client.get('/tasks').data
+
+    # Once converted, a write converts only the task it changed.
+    converted = []
+    from_dict = Task.from_dict
+    monkeypatch.setattr(Task, 'from_dict',
+                        classmethod(lambda cls, d: converted.append(d) or from_dict(d)))
+    client.post('/tasks', data={'task': 'Another'})
+    assert len(get_compact_tasks('worker')) == 2
+    assert [t['description'] for t in converted] == ['Another']
+
+
+def test_hashed_assets_and_versioned_service_worker(client, monkeypatch, tmp_path):
+    import gzip
+    import app as app_module
+    from assets import AssetPipeline
+    static = tmp_path / 'static'
+    shutil.copytree(app.static_folder, static)
+    monkeypatch.setitem(app_module._asset_pipelines, tmp_path / 'assets',
+                        AssetPipeline(static, tmp_path / 'assets'))
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    page = client.get('/tasks').get_data(as_text=True)
+    css = re.search(r'href="(/assets/styles\.[0-9a-f]{12}\.css)"', page).group(1)
+    assert re.search(r'src="/assets/dragdrop\.[0-9a-f]{12}\.js"', page)
+
+    resp = client.get(css, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert resp.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    source = (static / 'styles.css').read_bytes()
+    assert gzip.decompress(resp.data) == source
+    plain = client.get(css, headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers and plain.data == source
+    assert client.get('/assets/styles.css').status_code == 404
+    assert client.get('/assets/styles.000000000000.css').status_code == 404
+
+    worker = client.get('/service-worker.js')
+    assert worker.headers['Cache-Control'] == 'no-cache'
+    script = worker.get_data(as_text=True)
+    assert css in script and 'task-manager-cache-v1' not in script
+    version = re.search(r'const VERSION = "([0-9a-f]+)"', script).group(1)
+
+    # Editing a source gives it a new name and the worker a new version.
+    (static / 'styles.css').write_text('body { color: red; }')
+    page = client.get('/tasks').get_data(as_text=True)
+    assert css not in page
+    assert client.get(css).status_code == 200  # older pages keep working
+    assert version not in client.get('/service-worker.js').get_data(as_text=True)
+
+
+def test_replayed_offline_batch_does_not_duplicate_creates(client):
+    client.post('/login', data={'username': 'worker', 'password': 'secret'})
+    queued = {'ops': [{'op': 'create', 'id': 'ab' * 16, 'description': 'Offline'}], 'atomic': False}
+    assert client.post('/tasks/batch', json=queued).get_json()['ok']
+    # The service worker retries when it never saw the first response.
+    again = client.post('/tasks/batch', json=queued)
+    assert again.status_code == 200
+    assert again.get_json()['results'] == [{'ok': False, 'error': 'task already exists'}]
+    assert [t['description'] for t in load_users()['worker']['tasks']] == ['Offline']
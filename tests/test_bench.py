@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from bench.run import compare, run
+from bench import search as search_bench
+from bench import taskmodel as taskmodel_bench
+
+
+def test_benchmark_smoke(tmp_path):
+    results = run(tmp_path, users=3, tasks=5, messages=20, iterations=3, concurrency=2)
+    assert set(results['test_client']) == set(results['http'])
+    assert results['functions']['build_trend']['count'] == 3
+    assert results['peak_rss_kb'] > 0
+    slower = {'functions': {'build_trend': dict(results['functions']['build_trend'], p50_ms=1e9)}}
+    lines, regressed = compare(slower, results, tolerance=0.2)
+    assert regressed and 'REGRESSION' in lines[0]
+
+
+def test_search_benchmark_smoke():
+    results = search_bench.run(sizes=(200, 400), iterations=3)
+    assert set(results) == {'200', '400'}
+    assert results['400']['two_words']['count'] == 3
+
+
+def test_taskmodel_benchmark_smoke():
+    results = taskmodel_bench.run(tasks=300, iterations=2)
+    assert results['memory']['compact_mb'] < results['memory']['dict_mb']
+    assert results['build_trend']['compact']['count'] == 2
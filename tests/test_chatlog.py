@@ -0,0 +1,147 @@
+import gzip
+import json
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from chatlog import ChatLog
+
+
+def test_imports_legacy_messages(tmp_path):
+    legacy = tmp_path / 'messages.json'
+    legacy.write_text(json.dumps([
+        {'sender': 'a', 'text': 'one', 'recipients': [], 'attachments': []},
+        {'sender': 'b', 'text': 'two', 'recipients': ['a'], 'attachments': []},
+    ]))
+    log = ChatLog(tmp_path / 'messages', legacy_path=legacy)
+    messages, cursor = log.read_since(0)
+    assert [(m['id'], m['text']) for m in messages] == [(1, 'one'), (2, 'two')]
+    assert cursor == 2
+    assert log.append({'sender': 'a', 'text': 'three'})['id'] == 3
+
+
+def test_imports_single_file_log(tmp_path):
+    legacy = tmp_path / 'messages.jsonl'
+    legacy.write_text('{"text":"one","id":1}\n{"text":"two","id":2}\n{"text":"to')
+    log = ChatLog(tmp_path / 'messages', legacy_path=legacy, segment_size=1)
+    assert [(m['id'], m['text']) for m in log.read_since(0)[0]] == [(1, 'one'), (2, 'two')]
+
+
+def test_recovers_from_torn_append(tmp_path):
+    root = tmp_path / 'messages'
+    log = ChatLog(root)
+    for i in range(3):
+        log.append({'text': str(i)})
+    path = log.segment_path(0)
+    with path.open('ab') as f:
+        f.write(b'{"text": "tor')
+    # Index entry for a line that never made it to the log.
+    with path.with_name(path.name + '.idx').open('ab') as f:
+        f.write((path.stat().st_size + 10).to_bytes(8, 'little'))
+
+    log = ChatLog(root)
+    assert log.last_id() == 3
+    assert [m['text'] for m in log.read_since(1)[0]] == ['1', '2']
+    assert log.append({'text': '3'})['id'] == 4
+    assert [m['text'] for m in log.read_since(3)[0]] == ['3']
+
+
+def test_second_instance_sees_appends(tmp_path):
+    path = tmp_path / 'messages'
+    writer, reader = ChatLog(path), ChatLog(path)
+    writer.append({'text': 'hi'})
+    assert reader.read_since(0)[0][0]['text'] == 'hi'
+    assert reader.append({'text': 'there'})['id'] == 2
+
+
+def test_read_visible_uses_recipient_index(tmp_path):
+    path = tmp_path / 'messages'
+    log = ChatLog(path)
+    log.append({'text': 'all', 'recipients': []})
+    log.append({'text': 'to a', 'recipients': ['a', 'b']})
+    log.append({'text': 'to c', 'recipients': ['c']})
+    log.append({'text': 'all again', 'recipients': []})
+
+    messages, cursor, more = log.read_visible('a')
+    assert [m['text'] for m in messages] == ['all', 'to a', 'all again']
+    assert (cursor, more) == (4, False)
+
+    messages, cursor, more = log.read_visible('c', since=0, limit=1)
+    assert [m['text'] for m in messages] == ['all']
+    assert (cursor, more) == (1, True)
+    messages, cursor, more = log.read_visible('c', since=cursor, limit=1)
+    assert [m['text'] for m in messages] == ['to c']
+    assert more
+
+    # Messages written by another process are indexed on the next read.
+    ChatLog(path).append({'text': 'late', 'recipients': ['c']})
+    assert [m['text'] for m in log.read_visible('c', since=4)[0]] == ['late']
+    assert log.read_visible('a', since=4)[0] == []
+
+
+def test_segments_roll_over_and_archive(tmp_path):
+    root = tmp_path / 'messages'
+    log = ChatLog(root, segment_size=3, hot_segments=2)
+    for i in range(10):
+        recipients = ['a'] if i % 2 else []
+        assert log.append({'text': str(i), 'recipients': recipients})['id'] == i + 1
+    log.wait_archived()
+
+    # Segments 0 and 1 are archived; 2 and 3 stay plain and indexed.
+    assert sorted(p.name for p in root.glob('*.jsonl*') if not p.name.endswith('.idx')) == [
+        '00000000.jsonl.gz', '00000001.jsonl.gz', '00000002.jsonl', '00000003.jsonl']
+    with gzip.open(root / '00000001.jsonl.gz') as f:
+        assert [json.loads(line)['id'] for line in f] == [4, 5, 6]
+    assert log._indexed == 10 and min(log._broadcast) > 6
+
+    assert [m['text'] for m in log.read_since(0)[0]] == [str(i) for i in range(10)]
+    assert [m['id'] for m in log.read_since(8)[0]] == [9, 10]
+    assert [m['id'] for m in log.get([2, 5, 9])] == [2, 5, 9]
+    messages, cursor, more = log.read_visible('b', since=0, limit=3)
+    assert ([m['id'] for m in messages], cursor, more) == ([1, 3, 5], 5, True)
+    messages, cursor, more = log.read_visible('b', since=cursor, limit=3)
+    assert ([m['id'] for m in messages], cursor, more) == ([7, 9], 10, False)
+
+    # Another process opening the directory sees the same history.
+    other = ChatLog(root)
+    assert other.segment_size == 3
+    assert other.append({'text': '10'})['id'] == 11
+    assert log.read_since(10)[0][0]['text'] == '10'
+
+
+def test_retention_drops_old_archives(tmp_path):
+    root = tmp_path / 'messages'
+    log = ChatLog(root, segment_size=2, hot_segments=1, retain_days=30)
+    for i in range(4):
+        log.append({'text': str(i), 'timestamp': '2000-01-01T00:00:00'})
+    log.append({'text': 'recent', 'timestamp': '2999-01-01T00:00:00'})
+    log.wait_archived()
+
+    assert not list(root.glob('*.gz'))
+    assert log.first_id() == 4
+    messages, cursor = log.read_since(0)
+    assert [m['text'] for m in messages] == ['recent'] and cursor == 5
+    assert [m['text'] for m in log.read_visible('a')[0]] == ['recent']
+
+
+def test_archiving_does_not_hold_up_appends(tmp_path, monkeypatch):
+    import shutil
+    import threading
+    release = threading.Event()
+    copy = shutil.copyfileobj
+
+    def slow_copy(src, dst):
+        release.wait(5)
+        copy(src, dst)
+
+    monkeypatch.setattr(shutil, 'copyfileobj', slow_copy)
+    log = ChatLog(tmp_path / 'messages', segment_size=2, hot_segments=1)
+    for i in range(5):
+        log.append({'text': str(i)})
+    # Segment 0 is still being compressed, yet appends and reads go on.
+    assert not release.is_set() and log.last_id() == 5
+    assert [m['text'] for m in log.read_since(0)[0]] == [str(i) for i in range(5)]
+    release.set()
+    log.wait_archived()
+    assert sorted(p.name for p in (tmp_path / 'messages').glob('*.gz')) == [
+        '00000000.jsonl.gz', '00000001.jsonl.gz']
+    assert [m['text'] for m in log.read_since(0)[0]] == [str(i) for i in range(5)]
@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from events import EventBus
+
+
+def test_events_respect_visibility():
+    bus = EventBus()
+    worker = bus.subscribe('worker')
+    other = bus.subscribe('other')
+    manager = bus.subscribe('owner', can_see_all=True)
+
+    bus.publish('message', {'id': 1}, users=['worker', 'owner'])
+    bus.publish('task', {'user': 'worker'}, users={'worker'}, managers=True)
+    bus.publish('message', {'id': 2})
+
+    assert [worker.queue.get_nowait()[1] for _ in range(3)] == [{'id': 1}, {'user': 'worker'}, {'id': 2}]
+    assert [manager.queue.get_nowait()[1] for _ in range(3)] == [{'id': 1}, {'user': 'worker'}, {'id': 2}]
+    assert other.queue.get_nowait()[1] == {'id': 2}
+    assert other.queue.empty()
+
+
+def test_overflow_triggers_resync_and_heartbeat():
+    bus = EventBus(queue_size=2)
+    sub = bus.subscribe('worker')
+    for i in range(5):
+        bus.publish('message', {'id': i})
+    stream = sub.stream(heartbeat=0.01)
+    assert next(stream).startswith('retry:')
+    assert next(stream).startswith('event: resync')
+    assert next(stream) == ': heartbeat\n\n'
+    bus.publish('message', {'id': 9})
+    assert next(stream) == 'event: message\ndata: {"id": 9}\n\n'
+    bus.unsubscribe(sub)
+    assert bus.subscriber_count() == 0
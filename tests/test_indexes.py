@@ -0,0 +1,59 @@
+import copy
+import random
+import sys
+from datetime import date
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from indexes import CreatedOrder, TaskOrder, created_key
+from storage import apply_op
+
+
+def sorted_tasks(tasks):
+    rank = {'High': 0, 'Mid': 1, 'Low': 2}
+    return sorted(tasks, key=lambda t: (rank.get(t.get('priority', 'Mid'), 1),
+                                        t.get('due_date') or '9999-12-31'))
+
+
+def test_task_order_matches_full_sort_under_random_ops():
+    rng = random.Random(7)
+    users = {name: {'tasks': [], 'past_tasks': []} for name in ('a', 'b')}
+    order = TaskOrder()
+    order.rebuild(users)
+    created = CreatedOrder()
+    created.rebuild(users)
+    for i in range(300):
+        user = rng.choice('ab')
+        active = users[user]['tasks']
+        choice = rng.random()
+        if choice < 0.5 or not active:
+            op = {'op': 'create', 'user': user, 'task': {
+                'id': f't{i}',
+                'description': f't{i}',
+                'priority': rng.choice(['High', 'Mid', 'Low']),
+                'status': 'Incomplete',
+                'due_date': rng.choice([None, '2030-01-0%d' % rng.randint(1, 9)]),
+                'created_at': '2029-12-%02dT00:00:00' % rng.randint(1, 31),
+                'history': [],
+            }}
+        elif choice < 0.75:
+            op = {'op': 'status', 'user': user, 'id': rng.choice(active)['id'],
+                  'status': rng.choice(['Doing', 'Done']), 'timestamp': '2030-01-01T00:00:00'}
+        else:
+            op = {'op': 'reassign', 'user': user, 'id': rng.choice(active)['id'],
+                  'to': 'b' if user == 'a' else 'a', 'timestamp': '2030-01-01T00:00:00'}
+        result = apply_op(users, copy.deepcopy(op))
+        order.apply(op, result)
+        created.apply(op, result)
+
+    for user in 'ab':
+        active = users[user]['tasks']
+        assert order.top_tasks(user, 5) == sorted_tasks(active)[:5]
+        due = sorted((t for t in active if t['due_date']), key=lambda t: t['due_date'])
+        assert order.due_between(user) == due
+        window = [t for t in due if '2030-01-03' <= t['due_date'] <= '2030-01-05']
+        assert order.due_between(user, '2030-01-03', '2030-01-05') == window
+        assert order.overdue(user, today=date(2030, 1, 4)) == [
+            t for t in due if t['due_date'] < '2030-01-04']
+        assert created.keys(user) == sorted(map(created_key, active))
+        assert created.keys(user, past=True) == sorted(
+            map(created_key, users[user]['past_tasks']))
@@ -0,0 +1,26 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from rendercache import RenderCache
+
+
+def test_lru_eviction_and_tags():
+    cache = RenderCache(max_bytes=10)
+    cache.put('a', 'aaaa', tags=('ann',))
+    cache.put('b', 'bbbb', tags=('bob',))
+    assert cache.get('a') == 'aaaa'  # a is now the most recently used
+    cache.put('c', 'cccc', tags=('ann',))
+    assert cache.get('b') is None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 8
+
+    cache.invalidate('ann')
+    assert cache.get('a') is None and cache.get('c') is None
+    assert cache.stats()['invalidations'] == 2 and cache.stats()['entries'] == 0
+
+    cache.put('huge', 'x' * 11)
+    assert cache.get('huge') is None
+    calls = []
+    assert cache.get_or_render('d', lambda: calls.append(1) or 'dd') == 'dd'
+    assert cache.get_or_render('d', lambda: calls.append(1) or 'dd') == 'dd'
+    assert len(calls) == 1
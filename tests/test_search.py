@@ -0,0 +1,72 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from chatlog import ChatLog
+from search import InvertedIndex, MessageSearch, TaskSearch, plain_text
+
+
+def test_index_matches_prefixes_and_ranks():
+    index = InvertedIndex()
+    index.add('a', 'Order printer paper')
+    index.add('b', 'paper paper paper for the office printer')
+    index.add('c', 'Printing schedule')
+    index.add('d', 'Call the printer company about the order')
+
+    assert set(index.scores('printer')) == {'a', 'b', 'd'}
+    # "print" is a prefix of printer and printing; exact words rank higher.
+    assert set(index.scores('print')) == {'a', 'b', 'c', 'd'}
+    assert set(index.scores('printer ord')) == {'a', 'd'}
+    scores = index.scores('paper')
+    assert scores['b'] > scores['a']
+    assert index.scores('nothing here') == {}
+
+    index.add('b', 'replaced text')
+    assert set(index.scores('paper')) == {'a'}
+    index.remove('a')
+    assert index.scores('paper') == {}
+    assert 'paper' not in index.terms
+
+
+def test_task_search_follows_operations():
+    tasks = TaskSearch()
+    tasks.rebuild({
+        'ann': {'tasks': [{'id': 't1', 'description': 'Fix the fridge', 'notes': []}],
+                'past_tasks': [{'id': 't2', 'description': 'Fridge order', 'notes': []}]},
+        'bob': {'tasks': []},
+    })
+    assert sorted(d for _, d in tasks.search('fridge')) == ['t1', 't2']
+    assert tasks.search('fridge', owners={'bob'}) == []
+
+    task = {'id': 't3', 'description': 'Stock check', 'notes': []}
+    tasks.apply({'op': 'create', 'user': 'bob'}, {'ok': True, 'task': task})
+    task = dict(task, notes=[{'text': 'fridge is empty'}])
+    tasks.apply({'op': 'note', 'user': 'bob', 'id': 't3'}, {'ok': True, 'task': task})
+    assert [d for _, d in tasks.search('fridge', owners={'bob'})] == ['t3']
+    tasks.apply({'op': 'reassign', 'user': 'bob', 'to': 'ann', 'id': 't3'}, {'ok': True, 'task': task})
+    assert tasks.search('fridge', owners={'bob'}) == []
+
+
+def test_message_search_respects_recipients_and_catches_up(tmp_path):
+    log = ChatLog(tmp_path / 'messages')
+    log.append({'text': '<b>Lunch</b> at noon', 'recipients': []})
+    log.append({'text': 'lunch plans?', 'recipients': ['ann', 'bob']})
+    messages = MessageSearch(log)
+    assert [d for _, d in messages.search('lunch', 'ann')] == [2, 1]
+    assert [d for _, d in messages.search('lunch', 'cat')] == [1]
+    assert messages.search('b', 'ann') == []  # markup is not indexed
+
+    # Written elsewhere: picked up on the next query.
+    ChatLog(tmp_path / 'messages').append({'text': 'late lunch', 'recipients': ['cat']})
+    assert [d for _, d in messages.search('lunch', 'cat')] == [3, 1]
+
+
+def test_message_search_covers_hot_segments_only(tmp_path):
+    log = ChatLog(tmp_path / 'messages', segment_size=2, hot_segments=1)
+    messages = MessageSearch(log)
+    for i in range(3):
+        log.append({'text': f'report {i}', 'recipients': []})
+    log.wait_archived()
+    # Segment 0 (messages 1 and 2) is archived; segment 1 stays searchable.
+    assert [d for _, d in messages.search('report', 'ann')] == [3]
+    assert len(messages.index) == 1
+    assert plain_text('a&amp;b<br>c') == 'a&b c'
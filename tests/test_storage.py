@@ -0,0 +1,373 @@
+import gzip
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import pytest
+from storage import (JSONStorage, JournalStorage, SQLiteStorage, TaskPositions, TieredStorage,
+                     apply_op, migrate_json_to_sqlite)
+
+
+def sample_users():
+    return {
+        'owner': {
+            'password': 'secret',
+            'role': 'Owner',
+            'branches': ['Mzone'],
+            'tasks': [
+                {'description': 'Legacy', 'priority': 'High', 'status': 'Incomplete',
+                 'due_date': '2099-12-31'},
+            ],
+            'past_tasks': [],
+        },
+        'worker': {
+            'password': 'secret',
+            'role': 'Worker',
+            'branches': ['Mzone'],
+            'tasks': [],
+            'past_tasks': [],
+        },
+    }
+
+
+def new_task(description, now='2024-01-01T10:00:00'):
+    return {
+        'id': f'id-{description}',
+        'description': description,
+        'priority': 'Mid',
+        'status': 'Incomplete',
+        'notes': [],
+        'due_date': None,
+        'created_at': now,
+        'history': [{'status': 'Incomplete', 'timestamp': now, 'action': 'created'}],
+    }
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def store(request, tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    if request.param == 'json':
+        return JSONStorage(json_path)
+    db_path = tmp_path / 'tasks.db'
+    migrate_json_to_sqlite(json_path, db_path)
+    return SQLiteStorage(db_path)
+
+
+def test_task_positions_follow_operations():
+    users = sample_users()
+    users['owner']['tasks'] = [new_task(str(i)) for i in range(6)]
+    positions = TaskPositions(users)
+    ops = [
+        {'op': 'status', 'user': 'owner', 'id': 'id-1', 'status': 'Done', 'timestamp': 't'},
+        {'op': 'reassign', 'user': 'owner', 'id': 'id-3', 'to': 'worker', 'timestamp': 't'},
+        {'op': 'create', 'user': 'owner', 'task': new_task('6')},
+        {'op': 'status', 'user': 'owner', 'index': 0, 'status': 'Done', 'timestamp': 't'},
+        {'op': 'note', 'user': 'worker', 'id': 'id-3', 'note': {'text': 'n'}},
+        {'op': 'status', 'user': 'owner', 'id': 'id-6', 'status': 'Doing', 'timestamp': 't'},
+        {'op': 'status', 'user': 'owner', 'id': 'id-1', 'status': 'Doing', 'timestamp': 't'},
+    ]
+    assert [apply_op(users, op, positions)['ok'] for op in ops] == [True] * 6 + [False]
+    for uname, udata in users.items():
+        for i, task in enumerate(udata['tasks']):
+            assert positions.find(uname, task['id']) == i
+    assert [t['id'] for t in users['owner']['tasks']] == ['id-2', 'id-4', 'id-5', 'id-6']
+
+
+def test_migration_round_trips(tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    assert migrate_json_to_sqlite(json_path, tmp_path / 'tasks.db') == 2
+    users = SQLiteStorage(tmp_path / 'tasks.db').load()
+    assert users['owner']['branches'] == ['Mzone']
+    assert users['owner']['tasks'][0]['description'] == 'Legacy'
+    assert users['owner']['tasks'][0]['due_date'] == '2099-12-31'
+    assert users['worker']['tasks'] == []
+
+
+def test_sqlite_load_binds_no_parameter_per_task(tmp_path):
+    import sqlite3
+    json_path = tmp_path / 'users.json'
+    users = sample_users()
+    users['worker']['tasks'] = [new_task(f'T{i}') for i in range(50)]
+    json_path.write_text(json.dumps(users))
+    migrate_json_to_sqlite(json_path, tmp_path / 'tasks.db')
+    store = SQLiteStorage(tmp_path / 'tasks.db')
+    # Far below the number of tasks, as on SQLite builds before 3.32.
+    store._conn().setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 10)
+    loaded = store.load()['worker']['tasks']
+    assert len(loaded) == 50 and loaded[49]['history'][0]['action'] == 'created'
+
+
+def test_operations_apply_to_backend(store):
+    before = store.version()
+    results = store.apply([
+        {'op': 'create', 'user': 'worker', 'task': new_task('First')},
+        {'op': 'create', 'user': 'worker', 'task': new_task('Second')},
+    ])
+    assert all(r['ok'] for r in results)
+    assert store.version() != before
+
+    note = {'text': 'hello', 'timestamp': '2024-01-01T11:00:00', 'author': 'worker'}
+    assert store.apply([{'op': 'note', 'user': 'worker', 'id': 'id-Second', 'note': note}])[0]['ok']
+    assert not store.apply([{'op': 'note', 'user': 'owner', 'id': 'id-Second', 'note': note}])[0]['ok']
+    assert store.apply([{'op': 'reassign', 'user': 'worker', 'index': 0, 'to': 'owner',
+                         'timestamp': '2024-01-01T12:00:00'}])[0]['ok']
+    assert store.apply([{'op': 'status', 'user': 'worker', 'index': 0, 'status': 'Done',
+                         'timestamp': '2024-01-01T13:00:00'}])[0]['ok']
+    assert not store.apply([{'op': 'status', 'user': 'worker', 'index': 5, 'status': 'Done',
+                             'timestamp': '2024-01-01T13:00:00'}])[0]['ok']
+
+    users = store.load()
+    assert users['worker']['tasks'] == []
+    done = users['worker']['past_tasks'][0]
+    assert done['description'] == 'Second'
+    assert done['notes'][0]['text'] == 'hello'
+    assert [h['action'] for h in done['history']] == ['created', 'status_change']
+    moved = users['owner']['tasks'][-1]
+    assert moved['description'] == 'First'
+    assert moved['history'][-1]['action'] == 'reassigned_to_owner'
+    assert [t['description'] for t in store.get_all_tasks('worker')] == ['Second']
+    assert done['id'] == 'id-Second'
+
+
+@pytest.mark.parametrize('backend', ['json', 'journal', 'sqlite'])
+def test_atomic_batch_applies_all_or_nothing(tmp_path, backend):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    if backend == 'sqlite':
+        migrate_json_to_sqlite(json_path, tmp_path / 'tasks.db')
+        store = SQLiteStorage(tmp_path / 'tasks.db')
+    else:
+        store = (JSONStorage if backend == 'json' else JournalStorage)(json_path)
+    before = store.version()
+    results, base, after = store.apply_versioned([
+        {'op': 'create', 'user': 'worker', 'task': new_task('Kept?')},
+        {'op': 'status', 'user': 'worker', 'id': 'missing', 'status': 'Done',
+         'timestamp': '2024-01-01T13:00:00'},
+    ], atomic=True)
+    assert results == [{'ok': False, 'rolled_back': True}, {'ok': False}]
+    assert base == after == before == store.version()
+    assert store.load()['worker']['tasks'] == []
+
+    results = store.apply([
+        {'op': 'create', 'user': 'worker', 'task': new_task('One')},
+        {'op': 'status', 'user': 'worker', 'id': 'id-One', 'status': 'Doing',
+         'timestamp': '2024-01-01T13:00:00'},
+    ], atomic=True)
+    assert all(r['ok'] for r in results)
+    assert [t['status'] for t in store.load()['worker']['tasks']] == ['Doing']
+
+
+def test_tiered_store_archives_completed_tasks(tmp_path):
+    json_path = tmp_path / 'users.json'
+    users = sample_users()
+    users['worker']['past_tasks'] = [dict(new_task('Old'), status='Done')]
+    json_path.write_text(json.dumps(users))
+    store = TieredStorage(json_path, tmp_path / 'archive')
+    # Completed tasks from before tiering are served until the next save.
+    assert [t['description'] for t in store.past_tasks(store.load(), 'worker')] == ['Old']
+
+    store.apply([
+        {'op': 'create', 'user': 'worker', 'task': new_task('Finish')},
+        {'op': 'status', 'user': 'worker', 'id': 'id-Finish', 'status': 'Done',
+         'timestamp': '2024-01-02T09:00:00'},
+    ])
+    hot = json.loads(json_path.read_text())
+    assert 'past_tasks' not in hot['worker'] and hot['worker']['tasks'] == []
+    size = store.archive_path('worker').stat().st_size
+    assert hot['worker']['archive'] == {'count': 2, 'last': '2024-01-02T09:00:00', 'bytes': size,
+                                        'ids': ['id-Old', 'id-Finish']}
+    assert 'archive' not in hot['owner']
+    users = store.load()
+    assert [t['description'] for t in store.past_tasks(users, 'worker')] == ['Old', 'Finish']
+    assert store.past_tasks(users, 'owner') == []
+    assert [t['description'] for t in store.get_all_tasks('worker')] == ['Old', 'Finish']
+
+    # Later completions are appended as another gzip member; a torn append
+    # after a crash loses nothing that was written before it.
+    store.apply([
+        {'op': 'create', 'user': 'worker', 'task': new_task('Later')},
+        {'op': 'status', 'user': 'worker', 'id': 'id-Later', 'status': 'Done',
+         'timestamp': '2024-01-03T09:00:00'},
+    ])
+    with store.archive_path('worker').open('ab') as f:
+        f.write(b'\x1f\x8b\x08\x00torn')
+    fresh = TieredStorage(json_path, tmp_path / 'archive')
+    assert [t['description'] for t in fresh.past_tasks(fresh.load(), 'worker')] == ['Old', 'Finish', 'Later']
+
+    # The next append cuts the torn member off first.
+    fresh.apply([
+        {'op': 'create', 'user': 'worker', 'task': new_task('Last')},
+        {'op': 'status', 'user': 'worker', 'id': 'id-Last', 'status': 'Done',
+         'timestamp': '2024-01-04T09:00:00'},
+    ])
+    assert b'torn' not in fresh.archive_path('worker').read_bytes()
+    assert fresh.load()['worker']['archive']['ids'] == ['id-Old', 'id-Finish', 'id-Later', 'id-Last']
+    assert [t['description'] for t in fresh.past_tasks(fresh.load(), 'worker')] == [
+        'Old', 'Finish', 'Later', 'Last']
+
+    # Summaries written before IDs were recorded get them on the next save.
+    hot = json.loads(json_path.read_text())
+    del hot['worker']['archive']['ids']
+    json_path.write_text(json.dumps(hot))
+    fresh.apply([{'op': 'create', 'user': 'worker', 'task': new_task('Final')},
+                 {'op': 'status', 'user': 'worker', 'id': 'id-Final', 'status': 'Done',
+                  'timestamp': '2024-01-05T09:00:00'}])
+    assert fresh.load()['worker']['archive']['ids'] == [
+        'id-Old', 'id-Finish', 'id-Later', 'id-Last', 'id-Final']
+
+    # A damaged member in the middle (written before sizes were recorded)
+    # only loses its own tasks.
+    path = fresh.archive_path('worker')
+    intact = path.read_bytes()
+    torn = gzip.compress(b'{"id":"lost"}\n')
+    path.write_bytes(torn[:-8] + intact)
+    assert [t['description'] for t in TieredStorage(json_path, tmp_path / 'archive').past_tasks(
+        fresh.load(), 'worker')] == ['Old', 'Finish', 'Later', 'Last', 'Final']
+
+
+def test_app_runs_on_sqlite(tmp_path, monkeypatch):
+    import app as app_module
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    db_path = tmp_path / 'tasks.db'
+    migrate_json_to_sqlite(json_path, db_path)
+    monkeypatch.setattr('app.STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setattr('app.SQLITE_PATH', db_path)
+    monkeypatch.setattr('app.DATA_PATH', json_path)
+    with app_module.app.test_client() as client:
+        client.post('/login', data={'username': 'worker', 'password': 'secret'})
+        resp = client.post('/tasks', data={'task': 'Stored in rows', 'priority': 'Low'})
+        assert b'Stored in rows' in resp.data
+        client.post('/tasks', data={'task_index': '0', 'status': 'Done', 'user': 'worker'})
+    users = app_module.load_users()
+    assert users['worker']['past_tasks'][0]['description'] == 'Stored in rows'
+
+
+def test_journal_replays_and_compacts(tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    snapshot = json_path.read_bytes()
+    store = JournalStorage(json_path, compact_every=10**6)
+    store.apply([{'op': 'create', 'user': 'worker', 'task': new_task('Logged')}])
+    store.apply([{'op': 'status', 'user': 'worker', 'index': 0, 'status': 'Doing',
+                  'timestamp': '2024-01-01T11:00:00'}])
+    store.close()
+    # Mutations only touch the journal; the snapshot is left alone.
+    assert json_path.read_bytes() == snapshot
+    assert len(store.journal_path.read_text().splitlines()) == 3
+
+    # A torn trailing append is ignored on replay.
+    with store.journal_path.open('a') as f:
+        f.write('{"op": "create", "us')
+    reopened = JournalStorage(json_path, compact_every=10**6)
+    task = reopened.load()['worker']['tasks'][0]
+    assert (task['description'], task['status']) == ('Logged', 'Doing')
+
+    reopened.compact()
+    reopened.close()
+    assert json.loads(json_path.read_text())['worker']['tasks'][0]['status'] == 'Doing'
+    assert len(reopened.journal_path.read_text().splitlines()) == 1
+    assert JournalStorage(json_path).load()['worker']['tasks'][0]['description'] == 'Logged'
+
+
+def test_journal_ignored_after_snapshot_replaced(tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    store = JournalStorage(json_path, compact_every=10**6)
+    store.apply([{'op': 'create', 'user': 'worker', 'task': new_task('Folded')}])
+    folded = store.load()
+    store.close()
+    # Simulate a crash after the compacted snapshot was renamed into place
+    # but before the journal was reset.
+    json_path.write_text(json.dumps(folded))
+    users = JournalStorage(json_path).load()
+    assert [t['description'] for t in users['worker']['tasks']] == ['Folded']
+
+
+def test_journal_reads_without_the_file_lock(tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    store = JournalStorage(json_path, compact_every=10**6)
+    store.apply([{'op': 'create', 'user': 'worker', 'task': new_task('Unlocked')}])
+    writer = JournalStorage(json_path, compact_every=10**6)
+    with store.lock:
+        # Another process holding the lock does not block readers.
+        reader = threading.Thread(target=lambda: writer.load())
+        reader.start()
+        reader.join(5)
+        assert not reader.is_alive()
+    assert writer.load()['worker']['tasks'][0]['description'] == 'Unlocked'
+    store.close()
+    writer.close()
+
+
+def test_journal_update_and_apply_do_not_deadlock(tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    store = JournalStorage(json_path, compact_every=10**6)
+    mutating = threading.Event()
+
+    def slow_mutate(users):
+        mutating.set()
+        time.sleep(0.2)
+        users['worker']['tasks'].append(new_task('Updated'))
+        return True
+
+    updater = threading.Thread(target=store.update, args=(slow_mutate,), daemon=True)
+    applier = threading.Thread(target=store.apply, args=(
+        [{'op': 'create', 'user': 'worker', 'task': new_task('Applied')}],), daemon=True)
+    updater.start()
+    mutating.wait(5)
+    applier.start()
+    updater.join(5)
+    applier.join(5)
+    assert not updater.is_alive() and not applier.is_alive()
+    descriptions = [t['description'] for t in store.load()['worker']['tasks']]
+    assert sorted(descriptions) == ['Applied', 'Updated']
+    store.close()
+
+
+def test_journal_compacts_in_background(tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    store = JournalStorage(json_path, compact_every=3, fsync_interval=0.01)
+    for i in range(3):
+        store.apply([{'op': 'create', 'user': 'worker', 'task': new_task(f'T{i}')}])
+    deadline = time.time() + 5
+    while len(json.loads(json_path.read_text())['worker']['tasks']) < 3:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    store.close()
+    assert len(store.journal_path.read_text().splitlines()) == 1
+
+
+@pytest.mark.parametrize('backend', ['json', 'journal'])
+def test_concurrent_processes_lose_nothing(tmp_path, backend):
+    from bench.stress import run
+    summary = run(tmp_path, backend, workers=3, ops=5)
+    assert summary['requests'] == 45
+
+
+def test_optimistic_apply_retries_on_conflict(tmp_path):
+    json_path = tmp_path / 'users.json'
+    json_path.write_text(json.dumps(sample_users()))
+    store = JSONStorage(json_path)
+    other = JSONStorage(json_path)
+    real_load = store.load
+
+    def racing_load():
+        users = real_load()
+        if not store.conflicts:
+            other.apply([{'op': 'create', 'user': 'worker', 'task': new_task('Theirs')}])
+        return users
+
+    store.load = racing_load
+    results, base, version = store.apply_versioned(
+        [{'op': 'create', 'user': 'worker', 'task': new_task('Mine')}])
+    assert results[0]['ok'] and store.conflicts == 1
+    assert version == store.version()
+    assert [t['description'] for t in store.load()['worker']['tasks']] == ['Theirs', 'Mine']
@@ -0,0 +1,68 @@
+import json
+import random
+import sys
+from datetime import date, datetime
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import taskmodel
+from bench.dataset import _task
+from taskmodel import HistoryEntry, Task
+
+
+def test_round_trips_generated_tasks():
+    rng = random.Random(1)
+    now = datetime.utcnow()
+    tasks = json.loads(json.dumps([_task(rng, now, 4) for _ in range(200)]))
+    for t in tasks:
+        compact = Task.from_dict(t)
+        assert compact.to_dict() == t
+        assert json.loads(json.dumps(compact.to_dict())) == t
+
+
+def test_round_trips_unusual_values():
+    odd = [
+        {'description': 'legacy', 'priority': 'Mid', 'status': 'Incomplete'},
+        {'id': 'x', 'priority': 'Urgent', 'status': 'Blocked', 'due_date': None,
+         'created_at': None, 'history': [], 'notes': [{'text': 'n'}], 'assigned_by': 'boss'},
+        {'id': 'y', 'due_date': 'soon', 'created_at': '2024-03-01T10:00:00+03:30',
+         'history': [{'status': 'Done', 'timestamp': '2024-03-02 08:00', 'action': 'odd',
+                      'by': 'me'}, {'status': 'Done'}]},
+        {'id': 'z', 'due_date': '2024-02-29', 'created_at': '2024-02-01T00:00:00.000001'},
+        # Close to the canonical form, but isoformat() would not write them.
+        {'id': 'w', 'due_date': '20240229', 'created_at': '2024-02-01T00:00:00.000000',
+         'history': [{'status': 'Done', 'timestamp': '2024-02-01T10:00:00,500000'},
+                     {'status': 'Done', 'timestamp': '2024-02-01T10:00+03'}]},
+    ]
+    for t in odd:
+        assert Task.from_dict(t).to_dict() == t
+
+
+def test_parses_dates_once():
+    t = Task.from_dict({'status': 'Done', 'due_date': '1970-01-03',
+                        'created_at': '1970-01-02T00:00:01.5',
+                        'history': [{'status': 'Done', 'timestamp': '2024-03-01T23:00:00+05:00'}]})
+    assert t.done and t.due_day == 2
+    assert t.created == 86401 * 10**6 + 500000
+    assert t.created_day == 1
+    # The day written in the string, as datetime.fromisoformat(...).date() gives.
+    assert list(t.completed_days()) == [date(2024, 3, 1).toordinal() - taskmodel.EPOCH_DAY]
+    h = HistoryEntry.from_dict({'status': 'Doing', 'timestamp': 'never'})
+    assert h.day is None and h.to_dict() == {'status': 'Doing', 'timestamp': 'never'}
+
+
+def test_trend_and_weekly():
+    today = date(2024, 3, 10)
+    tasks = [Task.from_dict(t) for t in (
+        {'created_at': '2024-03-08T09:00:00', 'history': [
+            {'status': 'Done', 'timestamp': '2024-03-09T10:00:00'}]},
+        {'created_at': '2024-03-09T09:00:00', 'history': [
+            {'status': 'Doing', 'timestamp': '2024-03-10T10:00:00'},
+            {'status': 'Done', 'timestamp': '2024-03-10T11:00:00'}]},
+    )]
+    assert taskmodel.trend(tasks) == [
+        {'date': '2024-03-08', 'created': 1, 'done': 0},
+        {'date': '2024-03-09', 'created': 2, 'done': 1},
+        {'date': '2024-03-10', 'created': 2, 'done': 2},
+    ]
+    assert taskmodel.weekly(tasks, 3, today) == {
+        'labels': ['2024-03-08', '2024-03-09', '2024-03-10'], 'data': [0, 1, 1]}